@@ -18,7 +18,8 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 #
-# This is used for dumping the bb_cache.dat, the output format is:
+# This is used for dumping the bb_cache.dat index and its shards, the
+# output format is:
 # recipe_path PN PV PACKAGES
 #
 import os
@@ -27,7 +28,7 @@ import warnings
 
 # For importing bb.cache
 sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(sys.argv[0])), '../lib'))
-from bb.cache import CoreRecipeInfo
+from bb.cache import CoreRecipeInfo, DependsCache
 
 import cPickle as pickle
 
@@ -41,27 +42,32 @@ def main(argv=None):
 
     cachefile = argv[0]
 
-    with open(cachefile, "rb") as cachefile:
-        pickled = pickle.Unpickler(cachefile)
-        while cachefile:
-            try:
-                key = pickled.load()
-                val = pickled.load()
-            except Exception:
-                break
-            if isinstance(val, CoreRecipeInfo) and (not val.skipped):
-                pn = val.pn
-                # Filter out the native recipes.
-                if key.startswith('virtual:native:') or pn.endswith("-native"):
-                    continue
+    cachedir = os.path.dirname(cachefile)
+    data_hash = os.path.basename(cachefile).split('.')[-1]
+    depends_cache = DependsCache(cachedir, data_hash, [CoreRecipeInfo])
 
-                # 1.0 is the default version for a no PV recipe.
-                if val.__dict__.has_key("pv"):
-                    pv = val.pv
-                else:
-                    pv = "1.0"
+    with open(cachefile, "rb") as f:
+        pickled = pickle.Unpickler(f)
+        # cache version, bitbake version, cache classes and shard sizes
+        for i in range(4):
+            pickled.load()
+        depends_cache.index = pickled.load()
 
-                print("%s %s %s %s" % (key, pn, pv, ' '.join(val.packages)))
+    for key in sorted(depends_cache.keys()):
+        val = depends_cache[key][0]
+        if isinstance(val, CoreRecipeInfo) and (not val.skipped):
+            pn = val.pn
+            # Filter out the native recipes.
+            if key.startswith('virtual:native:') or pn.endswith("-native"):
+                continue
+
+            # 1.0 is the default version for a no PV recipe.
+            if val.__dict__.has_key("pv"):
+                pv = val.pv
+            else:
+                pv = "1.0"
+
+            print("%s %s %s %s" % (key, pn, pv, ' '.join(val.packages)))
 
 if __name__ == "__main__":
     sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+#
+# Simulate a number of builders asking a PR server for PR values at the
+# same time, the way package_get_auto_pr does during a build, and report
+# the request rate and latencies seen.
+#
+# Without --host a server with a temporary database is started for the
+# duration of the test.
+#
+import os
+import sys
+import optparse
+import multiprocessing
+import random
+import shutil
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.abspath(os.path.dirname(sys.argv[0])), '../lib'))
+import prserv.serv
+
+def client(host, port, clientnum, options, results):
+    conn = prserv.serv.PRServerConnection(host, port)
+    rand = random.Random(clientnum)
+    queries = []
+    for i in range(options.requests):
+        # Most packages are shared between the builders, some are new
+        if rand.random() < options.new:
+            checksum = "%d-%d" % (clientnum, i)
+        else:
+            checksum = str(rand.randint(0, options.requests))
+        queries.append(("1.0-r0", "arch%d" % rand.randint(0, 9), checksum))
+
+    latencies = []
+    batch = max(options.batch, 1)
+    for i in range(0, len(queries), batch):
+        start = time.time()
+        if options.batch:
+            values = conn.getPRs(queries[i:i + batch])
+        else:
+            values = [conn.getPR(*queries[i])]
+        latencies.append(time.time() - start)
+        if None in values:
+            results.put((clientnum, "no value returned for %s" % (queries[i:i + batch],)))
+            return
+    results.put((clientnum, latencies))
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--host", help="PR server to test (default: start a temporary one)",
+                      action="store", dest="host", type="string")
+    parser.add_option("--port", help="PR server port", action="store",
+                      dest="port", type="int", default=8585)
+    parser.add_option("-c", "--clients", help="number of concurrent clients (default: 20)",
+                      action="store", dest="clients", type="int", default=20)
+    parser.add_option("-n", "--requests", help="PR values asked for by each client (default: 500)",
+                      action="store", dest="requests", type="int", default=500)
+    parser.add_option("-b", "--batch", help="ask for this many values per call with getPRs, 0 uses getPR (default: 0)",
+                      action="store", dest="batch", type="int", default=0)
+    parser.add_option("--new", help="fraction of requests for unseen checksums (default: 0.2)",
+                      action="store", dest="new", type="float", default=0.2)
+    options, args = parser.parse_args()
+
+    tempdir = None
+    server = None
+    host, port = options.host, options.port
+    if not host:
+        tempdir = tempfile.mkdtemp(prefix="prserv-loadtest.")
+        server = prserv.serv.PRServer(os.path.join(tempdir, "prserv.sqlite3"),
+                                      os.path.join(tempdir, "prserv.log"),
+                                      ("localhost", 0), daemon=False)
+        server.start()
+        host, port = server.getinfo()
+        for i in range(50):
+            try:
+                prserv.serv.PRServerConnection(host, port).ping()
+                break
+            except Exception:
+                time.sleep(0.1)
+
+    try:
+        results = multiprocessing.Queue()
+        clients = [multiprocessing.Process(target=client, args=(host, port, i, options, results))
+                   for i in range(options.clients)]
+        start = time.time()
+        for c in clients:
+            c.start()
+        latencies = []
+        failed = 0
+        for c in clients:
+            clientnum, result = results.get()
+            if isinstance(result, str):
+                sys.stderr.write("Client %d: %s\n" % (clientnum, result))
+                failed += 1
+            else:
+                latencies.extend(result)
+        elapsed = time.time() - start
+        for c in clients:
+            c.join()
+    finally:
+        if server:
+            prserv.serv.PRServerConnection(host, port).terminate()
+            os.waitpid(server.pid, 0)
+            shutil.rmtree(tempdir)
+
+    values = options.requests * (options.clients - failed)
+    latencies.sort()
+    print("%d clients, %d PR values in %.2fs: %.0f values/s" %
+          (options.clients, values, elapsed, values / elapsed))
+    if latencies:
+        print("Latency per call: median %.1fms, 90%% %.1fms, max %.1fms" %
+              (latencies[len(latencies) / 2] * 1000,
+               latencies[len(latencies) * 9 / 10] * 1000,
+               latencies[-1] * 1000))
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
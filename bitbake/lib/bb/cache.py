@@ -31,6 +31,10 @@
 
 import os
 import logging
+import hashlib
+import mmap
+import struct
+import zlib
 from collections import defaultdict
 import bb.utils
 
@@ -43,11 +47,31 @@ except ImportError:
     logger.info("Importing cPickle failed. "
                 "Falling back to a very slow implementation.")
 
-__cache_version__ = "149"
+__cache_version__ = "152"
+
+# Number of shards each cache class is split into. All the variants of a
+# recipe end up in the same shard, so reparsing one .bb file only rewrites
+# the shard containing it.
+CACHE_SHARDS = 64
 
 def getCacheFile(path, filename, data_hash):
     return os.path.join(path, filename + "." + data_hash)
 
+def intern_values(value):
+    """
+    Return a copy of value with every string in it (recursing into lists,
+    tuples and dicts) replaced by its interned equivalent
+    """
+    if isinstance(value, str):
+        return intern(value)
+    if isinstance(value, list):
+        return [intern_values(v) for v in value]
+    if isinstance(value, tuple):
+        return tuple(intern_values(v) for v in value)
+    if type(value) is dict:
+        return dict((intern_values(k), intern_values(v)) for (k, v) in value.iteritems())
+    return value
+
 # RecipeInfoCommon defines common data retrieving methods
 # from meta data for caches. CoreRecipeInfo as well as other
 # Extra RecipeInfo needs to inherit this class
@@ -88,6 +112,13 @@ class RecipeInfoCommon(object):
     def getvar(cls, var, metadata, expand = True):
         return metadata.getVar(var, expand) or ''
 
+    def __setstate__(self, state):
+        # RecipeInfo objects are always unpickled, either from the cache or
+        # from the parser processes. The same dependency, package, task and
+        # path strings appear in thousands of them, so intern them to have
+        # the CacheData built from them share a single copy of each.
+        self.__dict__.update(intern_values(state))
+
 
 class CoreRecipeInfo(RecipeInfoCommon):
     __slots__ = ()
@@ -241,7 +272,7 @@ class CoreRecipeInfo(RecipeInfoCommon):
 
         cachedata.hashfn[fn] = self.hashfilename
         for task, taskhash in self.basetaskhashes.iteritems():
-            identifier = '%s.%s' % (fn, task)
+            identifier = intern('%s.%s' % (fn, task))
             cachedata.basetaskhash[identifier] = taskhash
 
         cachedata.inherits[fn] = self.inherits
@@ -252,6 +283,147 @@ class CoreRecipeInfo(RecipeInfoCommon):
 
 
 
+class DependsCache(object):
+    """
+    Mapping of cache keys (virtual filenames) to their info arrays, backed
+    by sharded cache files.
+
+    The index records, for each key, the shard it is stored in and the
+    offset of its pickled RecipeInfo within the shard file of each cache
+    class. Info arrays are only unpickled when they are first accessed, so
+    commands that need a handful of recipes don't pay for loading them all.
+    """
+
+    def __init__(self, cachedir, data_hash, caches_array):
+        self.cachedir = cachedir
+        self.data_hash = data_hash
+        self.cache_classes = [cache_class for cache_class in caches_array or []
+                              if type(cache_class) is type and issubclass(cache_class, RecipeInfoCommon)]
+        self.classnames = [cache_class.__name__ for cache_class in self.cache_classes]
+        # key -> (shard, [offset for each cache class])
+        self.index = {}
+        # shard -> [(size, mtime) for each cache class]
+        self.shardsizes = {}
+        self.loaded = {}
+        self.dirty = set()
+        self.files = {}
+
+    @staticmethod
+    def shard(key):
+        realfn = Cache.virtualfn2realfn(key)[0]
+        return int(hashlib.md5(realfn).hexdigest()[:8], 16) % CACHE_SHARDS
+
+    def shardfile(self, cache_class, shard):
+        return getCacheFile(self.cachedir, cache_class.cachefile, self.data_hash) + ".%02x" % shard
+
+    def shardstats(self, shard):
+        stats = []
+        for cache_class in self.cache_classes:
+            try:
+                st = os.stat(self.shardfile(cache_class, shard))
+            except OSError:
+                return None
+            stats.append((st.st_size, st.st_mtime))
+        return stats
+
+    def mark_dirty(self, key):
+        self.dirty.add(self.shard(key))
+
+    def _load(self, key):
+        shard, offsets = self.index[key]
+        info_array = []
+        for cache_class, offset in zip(self.cache_classes, offsets):
+            shardfile = self.shardfile(cache_class, shard)
+            if shardfile not in self.files:
+                self.files[shardfile] = open(shardfile, "rb")
+            f = self.files[shardfile]
+            f.seek(offset)
+            info_array.append(pickle.load(f))
+        self.loaded[key] = info_array
+        return info_array
+
+    def close(self):
+        for f in self.files.itervalues():
+            f.close()
+        self.files = {}
+
+    def __contains__(self, key):
+        return key in self.loaded or key in self.index
+
+    has_key = __contains__
+
+    def __getitem__(self, key):
+        if key in self.loaded:
+            return self.loaded[key]
+        if key in self.index:
+            return self._load(key)
+        raise KeyError(key)
+
+    def __setitem__(self, key, info_array):
+        self.loaded[key] = info_array
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.loaded.pop(key, None)
+        self.index.pop(key, None)
+        self.mark_dirty(key)
+
+    def keys(self):
+        return list(set(self.loaded).union(self.index))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def iteritems(self):
+        for key in self.keys():
+            yield key, self[key]
+
+    def write(self, cachefile):
+        """
+        Rewrite the dirty shards and then the index pointing into them.
+        Shards which haven't changed are left alone.
+        """
+        groups = defaultdict(list)
+        for key in self.keys():
+            shard = self.shard(key)
+            if shard in self.dirty:
+                groups[shard].append(key)
+                if key not in self.loaded:
+                    self._load(key)
+        self.close()
+
+        index = dict((k, v) for (k, v) in self.index.iteritems() if v[0] not in self.dirty)
+        for shard in self.dirty:
+            offsets = defaultdict(list)
+            for i, cache_class in enumerate(self.cache_classes):
+                shardfile = self.shardfile(cache_class, shard)
+                with open(shardfile + ".tmp", "wb") as f:
+                    for key in groups[shard]:
+                        offsets[key].append(f.tell())
+                        # Each entry is pickled on its own so it can be
+                        # loaded without reading the rest of the shard
+                        pickle.dump(self.loaded[key][i], f, pickle.HIGHEST_PROTOCOL)
+                os.rename(shardfile + ".tmp", shardfile)
+            for key in groups[shard]:
+                index[key] = (shard, offsets[key])
+            self.shardsizes[shard] = self.shardstats(shard)
+
+        with open(cachefile + ".tmp", "wb") as f:
+            pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+            pickler.dump(__cache_version__)
+            pickler.dump(bb.__version__)
+            pickler.dump(self.classnames)
+            pickler.dump(self.shardsizes)
+            pickler.dump(index)
+        os.rename(cachefile + ".tmp", cachefile)
+
+        self.index = index
+        self.dirty = set()
+
 class Cache(object):
     """
     BitBake Cache implementation
@@ -264,12 +436,17 @@ class Cache(object):
         self.caches_array = caches_array
         self.cachedir = data.getVar("CACHE", True)
         self.clean = set()
-        self.checked = set()
-        self.depends_cache = {}
+        # fn -> appends it was last validated with
+        self.checked = {}
         self.data = None
         self.data_fn = None
         self.cacheclean = True
         self.data_hash = data_hash
+        self.depends_cache = DependsCache(self.cachedir, self.data_hash, self.caches_array)
+        # fn -> seconds it last took to parse, kept across configuration
+        # changes so the parser can schedule the expensive recipes first
+        self.parsetimes = {}
+        self.parsetimes_dirty = False
 
         if self.cachedir in [None, '']:
             self.has_cache = False
@@ -283,22 +460,25 @@ class Cache(object):
         logger.debug(1, "Using cache in '%s'", self.cachedir)
         bb.utils.mkdirhier(self.cachedir)
 
-        cache_ok = True
         if self.caches_array:
             for cache_class in self.caches_array:
                 if type(cache_class) is type and issubclass(cache_class, RecipeInfoCommon):
-                    cachefile = getCacheFile(self.cachedir, cache_class.cachefile, self.data_hash)
-                    cache_ok = cache_ok and os.path.exists(cachefile)
                     cache_class.init_cacheData(self)
-        if cache_ok:
+        if os.path.isfile(self.cachefile):
             self.load_cachefile()
-        elif os.path.isfile(self.cachefile):
-            logger.info("Out of date cache found, rebuilding...")
+
+        self.parsetimesfile = os.path.join(self.cachedir, "bb_parsetimes.dat")
+        try:
+            with open(self.parsetimesfile, "rb") as f:
+                self.parsetimes = pickle.load(f)
+        except Exception:
+            pass
 
     def load_cachefile(self):
-        # Firstly, using core cache file information for
-        # valid checking
+        # Only the index is read here, the recipe information itself is
+        # unpickled from the shard files on first access
         with open(self.cachefile, "rb") as cachefile:
+            cachesize = os.fstat(cachefile.fileno()).st_size
             pickled = pickle.Unpickler(cachefile)
             try:
                 cache_ver = pickled.load()
@@ -314,44 +494,32 @@ class Cache(object):
                 logger.info('Bitbake version mismatch, rebuilding...')
                 return
 
+            try:
+                classes = pickled.load()
+                shardsizes = pickled.load()
+                index = pickled.load()
+            except Exception:
+                logger.info('Invalid cache index, rebuilding...')
+                return
 
-        cachesize = 0
-        previous_progress = 0
-        previous_percent = 0
-
-        # Calculate the correct cachesize of all those cache files
-        for cache_class in self.caches_array:
-            if type(cache_class) is type and issubclass(cache_class, RecipeInfoCommon):
-                cachefile = getCacheFile(self.cachedir, cache_class.cachefile, self.data_hash)
-                with open(cachefile, "rb") as cachefile:
-                    cachesize += os.fstat(cachefile.fileno()).st_size
+        if classes != self.depends_cache.classnames:
+            logger.info('Cache classes changed, rebuilding...')
+            return
 
         bb.event.fire(bb.event.CacheLoadStarted(cachesize), self.data)
-        
-        for cache_class in self.caches_array:
-            if type(cache_class) is type and issubclass(cache_class, RecipeInfoCommon):
-                cachefile = getCacheFile(self.cachedir, cache_class.cachefile, self.data_hash)
-                with open(cachefile, "rb") as cachefile:
-                    pickled = pickle.Unpickler(cachefile)                    
-                    while cachefile:
-                        try:
-                            key = pickled.load()
-                            value = pickled.load()
-                        except Exception:
-                            break
-                        if self.depends_cache.has_key(key):
-                            self.depends_cache[key].append(value)
-                        else:
-                            self.depends_cache[key] = [value]
-                        # only fire events on even percentage boundaries
-                        current_progress = cachefile.tell() + previous_progress
-                        current_percent = 100 * current_progress / cachesize
-                        if current_percent > previous_percent:
-                            previous_percent = current_percent
-                            bb.event.fire(bb.event.CacheLoadProgress(current_progress, cachesize),
-                                          self.data)
-
-                    previous_progress += current_progress
+
+        # A shard which doesn't match the size and mtime recorded in the index
+        # was rewritten without the index being updated, drop its entries
+        valid = set()
+        for shard, stats in shardsizes.iteritems():
+            if stats == self.depends_cache.shardstats(shard):
+                valid.add(shard)
+            else:
+                logger.debug(1, "Cache shard %02x is inconsistent, ignoring", shard)
+        for key, (shard, offsets) in index.iteritems():
+            if shard in valid:
+                self.depends_cache.index[key] = (shard, offsets)
+        self.depends_cache.shardsizes = dict((k, v) for (k, v) in shardsizes.iteritems() if k in valid)
 
         # Note: depends cache number is corresponding to the parsing file numbers.
         # The same file has several caches, still regarded as one item in the cache
@@ -359,7 +527,6 @@ class Cache(object):
                                                   len(self.depends_cache)),
                       self.data)
 
-    
     @staticmethod
     def virtualfn2realfn(virtualfn):
         """
@@ -465,7 +632,7 @@ class Cache(object):
         Is the cache valid for fn?
         Fast version, no timestamps checked.
         """
-        if fn not in self.checked:
+        if fn not in self.checked or self.checked[fn] != appends:
             self.cacheValidUpdate(fn, appends)
 
         # Is cache enabled?
@@ -484,7 +651,7 @@ class Cache(object):
         if not self.has_cache:
             return False
 
-        self.checked.add(fn)
+        self.checked[fn] = appends
 
         # File isn't in depends_cache
         if not fn in self.depends_cache:
@@ -578,6 +745,40 @@ class Cache(object):
         self.clean.add(fn)
         return True
 
+    def invalidate(self, fns):
+        """
+        Forget that the given (real) filenames were validated, so that the
+        next cacheValid() call checks them against their dependencies again.
+        Used by a resident server to only revalidate the recipes affected by
+        a file change while keeping the rest of the cache live.
+        """
+        for fn in fns:
+            if fn in self.depends_cache:
+                for cls in self.depends_cache[fn][0].variants:
+                    self.clean.discard(self.realfn2virtual(fn, cls))
+            self.clean.discard(fn)
+            self.checked.pop(fn, None)
+
+    def parsetime(self, fn):
+        """
+        Return how many seconds the last parse of fn took, or None
+        """
+        return self.parsetimes.get(fn)
+
+    def record_parsetime(self, fn, seconds):
+        self.parsetimes[fn] = seconds
+        self.parsetimes_dirty = True
+
+    def prune_parsetimes(self, fns):
+        """
+        Forget the parse times of the recipes which aren't in fns any more
+        """
+        fns = set(fns)
+        for fn in self.parsetimes.keys():
+            if fn not in fns:
+                del self.parsetimes[fn]
+                self.parsetimes_dirty = True
+
     def remove(self, fn):
         """
         Remove a fn from the cache
@@ -590,45 +791,33 @@ class Cache(object):
             logger.debug(1, "Marking %s as unclean", fn)
             self.clean.remove(fn)
 
-    def sync(self):
+    def sync(self, release=True):
         """
         Save the cache
         Called from the parser when complete (or exiting)
+
+        Unless release is False, the loaded recipe information is dropped
+        once it has been written.
         """
 
         if not self.has_cache:
             return
 
-        if self.cacheclean:
+        if self.parsetimes_dirty:
+            with open(self.parsetimesfile + ".tmp", "wb") as f:
+                pickle.dump(self.parsetimes, f, -1)
+            os.rename(self.parsetimesfile + ".tmp", self.parsetimesfile)
+            self.parsetimes_dirty = False
+
+        if self.cacheclean and not self.depends_cache.dirty:
             logger.debug(2, "Cache is clean, not saving.")
             return
 
-        file_dict = {}
-        pickler_dict = {}
-        for cache_class in self.caches_array:
-            if type(cache_class) is type and issubclass(cache_class, RecipeInfoCommon):
-                cache_class_name = cache_class.__name__
-                cachefile = getCacheFile(self.cachedir, cache_class.cachefile, self.data_hash)
-                file_dict[cache_class_name] = open(cachefile, "wb")
-                pickler_dict[cache_class_name] =  pickle.Pickler(file_dict[cache_class_name], pickle.HIGHEST_PROTOCOL)
-                   
-        pickler_dict['CoreRecipeInfo'].dump(__cache_version__)
-        pickler_dict['CoreRecipeInfo'].dump(bb.__version__)
-
-        try:
-            for key, info_array in self.depends_cache.iteritems():
-                for info in info_array:
-                    if isinstance(info, RecipeInfoCommon):
-                        cache_class_name = info.__class__.__name__
-                        pickler_dict[cache_class_name].dump(key)
-                        pickler_dict[cache_class_name].dump(info)
-        finally:
-            for cache_class in self.caches_array:
-                if type(cache_class) is type and issubclass(cache_class, RecipeInfoCommon):
-                    cache_class_name = cache_class.__name__
-                    file_dict[cache_class_name].close()
+        self.depends_cache.write(self.cachefile)
+        self.cacheclean = True
 
-        del self.depends_cache
+        if release:
+            del self.depends_cache
 
     @staticmethod
     def mtime(cachefile):
@@ -647,6 +836,7 @@ class Cache(object):
         if (info_array[0].skipped or 'SRCREVINACTION' not in info_array[0].pv) and not info_array[0].nocache:
             if parsed:
                 self.cacheclean = False
+                self.depends_cache.mark_dirty(filename)
             self.depends_cache[filename] = info_array
 
     def add(self, file_name, data, cacheData, parsed=None):
@@ -740,6 +930,7 @@ class CacheData(object):
         self.bbfile_priority = {}
 
     def add_from_recipeinfo(self, fn, info_array):
+        fn = intern(fn)
         for info in info_array:
             info.add_cacheData(self, fn)
 
@@ -747,7 +938,7 @@ class MultiProcessCache(object):
     """
     BitBake multi-process cache implementation
 
-    Used by the codeparser & file checksum caches
+    Used by the file checksum cache
     """
 
     def __init__(self):
@@ -789,6 +980,9 @@ class MultiProcessCache(object):
         if not self.cachefile:
             return
 
+        if not any(self.cachedata_extras):
+            return
+
         glf = bb.utils.lockfile(self.cachefile + ".lock", shared=True)
 
         i = os.getpid()
@@ -809,6 +1003,13 @@ class MultiProcessCache(object):
         bb.utils.unlockfile(lf)
         bb.utils.unlockfile(glf)
 
+        # Long lived parser processes save their extras once per parse, so
+        # move what was just written into the main data. The dictionaries
+        # are emptied in place as subclasses hold references to them.
+        self.merge_data(self.cachedata_extras, self.cachedata)
+        for extras in self.cachedata_extras:
+            extras.clear()
+
     def merge_data(self, source, dest):
         for j in range(0,len(dest)):
             for h in source[j]:
@@ -823,6 +1024,12 @@ class MultiProcessCache(object):
 
         data = self.cachedata
 
+        # Entries gathered by this process itself, e.g. the cooker's file
+        # checksums from building the runqueue
+        self.merge_data(self.cachedata_extras, data)
+        for extras in self.cachedata_extras:
+            extras.clear()
+
         for f in [y for y in os.listdir(os.path.dirname(self.cachefile)) if y.startswith(os.path.basename(self.cachefile) + '-')]:
             f = os.path.join(os.path.dirname(self.cachefile), f)
             try:
@@ -846,3 +1053,213 @@ class MultiProcessCache(object):
 
         bb.utils.unlockfile(glf)
 
+
+class AppendOnlyCache(object):
+    """
+    BitBake multi-process cache kept in a log of records which processes
+    append their new entries to
+
+    Each record is a pickled (CACHE_VERSION, [(index, key, value), ...])
+    with a header holding a marker, its length and CRC. The log is read
+    incrementally through mmap, so merging what other processes found only
+    costs reading what they appended. Records which are incomplete or
+    corrupt are skipped. The first entry for a key wins, as in
+    MultiProcessCache.
+
+    Used by the codeparser cache
+    """
+    RECORD = struct.Struct("<4sII")
+    MAGIC = b"BBc\x01"
+    # Longer records can only be a marker found inside another record
+    MAX_RECORD = 256 * 1024 * 1024
+    # Files of older formats of the cache, removed when the log is created
+    obsolete_files = ()
+
+    def __init__(self):
+        self.cachefile = None
+        self.cachedata = self.create_cachedata()
+        self.cachedata_extras = self.create_cachedata()
+        # Identity of the log read so far and where to continue reading
+        self.logid = None
+        self.offset = 0
+        # Entries in the part of the log read so far
+        self.entries = 0
+
+    def create_cachedata(self):
+        data = [{}]
+        return data
+
+    def init_cache(self, d):
+        cachedir = (d.getVar("PERSISTENT_DIR", True) or
+                    d.getVar("CACHE", True))
+        if cachedir in [None, '']:
+            return
+        bb.utils.mkdirhier(cachedir)
+        cachefile = os.path.join(cachedir, self.__class__.cache_file_name)
+        if cachefile != self.cachefile:
+            logger.debug(1, "Using cache in '%s'", cachefile)
+            self.cachefile = cachefile
+            self.logid = None
+            if not os.path.exists(cachefile):
+                for pattern in self.obsolete_files:
+                    bb.utils.remove(os.path.join(cachedir, pattern))
+        self.read_log()
+
+    def read_log(self):
+        """Add the entries appended to the log since it was last read"""
+        try:
+            f = open(self.cachefile, "rb")
+        except IOError:
+            return
+
+        with f:
+            st = os.fstat(f.fileno())
+            if (st.st_dev, st.st_ino) != self.logid:
+                # New or rewritten since last time
+                self.logid = (st.st_dev, st.st_ino)
+                self.offset = 0
+                self.entries = 0
+            if st.st_size <= self.offset:
+                return
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                self.offset = self._read_records(mm, self.offset)
+            finally:
+                mm.close()
+
+    def _check_record(self, mm, pos):
+        """Return the payload of the complete and intact record at pos, or None"""
+        header = self.RECORD.size
+        if pos + header > len(mm):
+            return None
+        magic, length, crc = self.RECORD.unpack_from(mm, pos)
+        if magic != self.MAGIC or length > self.MAX_RECORD or pos + header + length > len(mm):
+            return None
+        payload = mm[pos + header:pos + header + length]
+        if zlib.crc32(payload) & 0xffffffff != crc:
+            return None
+        return payload
+
+    def _next_record(self, mm, pos):
+        """Return the offset of the first intact record from pos on, or -1"""
+        while True:
+            pos = mm.find(self.MAGIC, pos)
+            if pos < 0 or self._check_record(mm, pos) is not None:
+                return pos
+            pos += 1
+
+    def _read_records(self, mm, pos):
+        header = self.RECORD.size
+        end = len(mm)
+        while pos + header <= end:
+            payload = self._check_record(mm, pos)
+            if payload is None:
+                # Left by an interrupted writer, continue with the next
+                # intact record. A marker found inside a record isn't
+                # trusted on its own as it is just pickled data.
+                found = self._next_record(mm, pos + 1)
+                if found < 0:
+                    # Possibly still being written
+                    break
+                pos = found
+                continue
+            pos += header + len(payload)
+            try:
+                version, entries = pickle.loads(payload)
+            except Exception:
+                continue
+            self.entries += len(entries)
+            if version != self.__class__.CACHE_VERSION:
+                continue
+            for index, key, value in entries:
+                self.cachedata[index].setdefault(key, value)
+        return pos
+
+    def _record(self, entries):
+        payload = pickle.dumps((self.__class__.CACHE_VERSION, entries), -1)
+        return self.RECORD.pack(self.MAGIC, len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+
+    def save_extras(self, d):
+        """Append the entries this process added to the log"""
+        if not self.cachefile:
+            return
+
+        # Leave out what others added meanwhile. Entries they add while
+        # this record is prepared may end up in the log twice.
+        self.read_log()
+        entries = []
+        for index, extras in enumerate(self.cachedata_extras):
+            for key, value in extras.iteritems():
+                if key not in self.cachedata[index]:
+                    self.cachedata[index][key] = value
+                    entries.append((index, key, value))
+            # Emptied in place as subclasses hold references to them
+            extras.clear()
+        if not entries:
+            return
+        record = self._record(entries)
+
+        glf = bb.utils.lockfile(self.cachefile + ".lock")
+        try:
+            self.read_log()
+            with open(self.cachefile, "ab") as f:
+                st = os.fstat(f.fileno())
+                if self.logid == (st.st_dev, st.st_ino) and self._partial_record(st.st_size):
+                    # Left by an interrupted writer, as nobody else is
+                    # writing
+                    f.truncate(self.offset)
+                # Readers take a record running past the end of the file
+                # as still being written
+                f.write(record)
+                f.flush()
+                st = os.fstat(f.fileno())
+            if self.logid == (st.st_dev, st.st_ino):
+                self.offset = st.st_size
+                self.entries += len(entries)
+        finally:
+            bb.utils.unlockfile(glf)
+
+    def _partial_record(self, size):
+        """
+        Is what follows the part of the log read so far the start of a
+        record running past its end? Anything else is left alone so that
+        no intact record after it is discarded.
+        """
+        header = self.RECORD.size
+        if size < self.offset + header:
+            return size > self.offset
+        with open(self.cachefile, "rb") as f:
+            f.seek(self.offset)
+            magic, length, _ = self.RECORD.unpack(f.read(header))
+        return (magic == self.MAGIC and length <= self.MAX_RECORD and
+                self.offset + header + length > size)
+
+    def save_merge(self, d):
+        """
+        Append the entries of this process and pick up those of the
+        others. The log is only rewritten once most of it is made up of
+        duplicate or outdated entries.
+        """
+        if not self.cachefile:
+            return
+
+        self.save_extras(d)
+
+        glf = bb.utils.lockfile(self.cachefile + ".lock")
+        try:
+            self.read_log()
+            live = sum(len(data) for data in self.cachedata)
+            if self.entries <= 2 * live:
+                return
+
+            entries = [(index, key, value) for index, data in enumerate(self.cachedata)
+                                           for key, value in data.iteritems()]
+            with open(self.cachefile + ".new", "wb") as f:
+                f.write(self._record(entries))
+                st = os.fstat(f.fileno())
+            os.rename(self.cachefile + ".new", self.cachefile)
+            self.logid = (st.st_dev, st.st_ino)
+            self.offset = st.st_size
+            self.entries = len(entries)
+        finally:
+            bb.utils.unlockfile(glf)
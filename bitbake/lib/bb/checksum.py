@@ -15,6 +15,9 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
+import glob
+import hashlib
+import operator
 import os
 import stat
 import bb.utils
@@ -56,35 +59,143 @@ class FileMtimeCache(object):
     def clear(self):
         self.cache.clear()
 
-# Checksum + mtime cache (persistent)
+def stat_key(st):
+    """
+    The part of a stat result which changes whenever the file's contents
+    are replaced or modified: inode, size and mtime in nanoseconds
+    """
+    mtime_ns = getattr(st, "st_mtime_ns", None)
+    if mtime_ns is None:
+        mtime_ns = int(round(st.st_mtime * 1000000000))
+    return (st.st_ino, st.st_size, mtime_ns)
+
+# Files at least this many to hash are spread over a pool of threads,
+# hashlib releases the GIL while digesting
+THREADED_HASH_MIN = 4
+
+def md5_files(paths):
+    """Return the MD5 checksums of paths, hashing them in parallel"""
+    if len(paths) < THREADED_HASH_MIN:
+        return [bb.utils.md5_file(f) for f in paths]
+    import multiprocessing.pool
+    pool = multiprocessing.pool.ThreadPool(min(len(paths), bb.utils.cpu_count(), 8))
+    try:
+        return pool.map(bb.utils.md5_file, paths)
+    finally:
+        pool.close()
+        pool.join()
+
+# Checksum cache (persistent) of files keyed by stat_key() and of
+# directories keyed by the stat_key() of everything within them
 class FileChecksumCache(MultiProcessCache):
     cache_file_name = "local_file_checksum_cache.dat"
-    CACHE_VERSION = 1
+    CACHE_VERSION = 2
+
+    def create_cachedata(self):
+        # path -> (stat_key, checksum) for files and
+        # path -> (signature, [(path, checksum), ...]) for directories
+        data = [{}, {}]
+        return data
 
-    def __init__(self):
-        self.mtime_cache = FileMtimeCache()
-        MultiProcessCache.__init__(self)
+    def _lookup(self, index, path, key):
+        for cachedata in (self.cachedata_extras, self.cachedata):
+            entry = cachedata[index].get(path)
+            if entry and entry[0] == key:
+                return entry[1]
+        return None
 
     def get_checksum(self, f):
-        entry = self.cachedata[0].get(f)
-        cmtime = self.mtime_cache.cached_mtime(f)
-        if entry:
-            (mtime, hashval) = entry
-            if cmtime == mtime:
-                return hashval
+        key = stat_key(os.stat(f))
+        hashval = self._lookup(0, f, key)
+        if hashval is None:
+            hashval = bb.utils.md5_file(f)
+            self.cachedata_extras[0][f] = (key, hashval)
+        return hashval
+
+    def checksum_dir(self, pth, pn):
+        """
+        Return (path, checksum) for each file below directory pth. If
+        nothing within pth changed since the last call the previous
+        result is returned without looking at the individual files.
+        """
+        entries = []
+        signature = hashlib.md5()
+        complete = True
+        for root, dirs, files in os.walk(pth):
+            for name in files:
+                fullpth = os.path.join(root, name)
+                try:
+                    key = stat_key(os.stat(fullpth))
+                except OSError as e:
+                    bb.warn("Unable to get checksum for %s SRC_URI entry %s: %s" % (pn, name, e))
+                    complete = False
+                    continue
+                signature.update("%s\0%d\0%d\0%d\n" % ((fullpth,) + key))
+                entries.append((fullpth, key))
+        signature = signature.hexdigest()
+
+        dirchecksums = self._lookup(1, pth, signature)
+        if dirchecksums is not None:
+            return dirchecksums
+
+        checksums = [self._lookup(0, f, key) for f, key in entries]
+        missing = [i for i, checksum in enumerate(checksums) if checksum is None]
+        for i, checksum in zip(missing, md5_files([entries[i][0] for i in missing])):
+            checksums[i] = checksum
+            self.cachedata_extras[0][entries[i][0]] = (entries[i][1], checksum)
+
+        dirchecksums = [(f, checksum) for (f, _), checksum in zip(entries, checksums) if checksum]
+        # Files which couldn't be looked at must be warned about next time
+        if complete:
+            self.cachedata_extras[1][pth] = (signature, dirchecksums)
+        return dirchecksums
+
+    def get_checksums(self, filelist, pn):
+        """Get a list of the checksums for a list of local files
+
+        Returns the checksums for a list of local files, caching the results as
+        it proceeds
+
+        """
+
+        def checksum_file(f):
+            try:
+                checksum = self.get_checksum(f)
+            except OSError as e:
+                bb.warn("Unable to get checksum for %s SRC_URI entry %s: %s" % (pn, os.path.basename(f), e))
+                return None
+            return checksum
+
+        checksums = []
+        for pth in filelist.split():
+            exist = pth.split(":")[1]
+            if exist == "False":
+                continue
+            pth = pth.split(":")[0]
+            if '*' in pth:
+                # Handle globs
+                for f in glob.glob(pth):
+                    if os.path.isdir(f):
+                        checksums.extend(self.checksum_dir(f, pn))
+                    else:
+                        checksum = checksum_file(f)
+                        checksums.append((f, checksum))
+            elif os.path.isdir(pth):
+                checksums.extend(self.checksum_dir(pth, pn))
             else:
-                bb.debug(2, "file %s changed mtime, recompute checksum" % f)
+                checksum = checksum_file(pth)
+                checksums.append((pth, checksum))
 
-        hashval = bb.utils.md5_file(f)
-        self.cachedata_extras[0][f] = (cmtime, hashval)
-        return hashval
+        checksums.sort(key=operator.itemgetter(1))
+        return checksums
 
     def merge_data(self, source, dest):
         for h in source[0]:
-            if h in dest:
-                (smtime, _) = source[0][h]
-                (dmtime, _) = dest[0][h]
-                if smtime > dmtime:
+            if h in dest[0]:
+                (skey, _) = source[0][h]
+                (dkey, _) = dest[0][h]
+                if skey[2] > dkey[2]:
                     dest[0][h] = source[0][h]
             else:
                 dest[0][h] = source[0][h]
+        dest[1].update(source[1])
@@ -5,7 +5,7 @@ import os.path
 import bb.utils, bb.data
 from itertools import chain
 from pysh import pyshyacc, pyshlex, sherrors
-from bb.cache import MultiProcessCache
+from bb.cache import AppendOnlyCache
 
 
 logger = logging.getLogger('BitBake.CodeParser')
@@ -115,12 +115,13 @@ class shellCacheLine(object):
     def __repr__(self):
         return str(self.execs)
 
-class CodeParserCache(MultiProcessCache):
-    cache_file_name = "bb_codeparser.dat"
-    CACHE_VERSION = 7
+class CodeParserCache(AppendOnlyCache):
+    cache_file_name = "bb_codeparser.log"
+    CACHE_VERSION = 8
+    obsolete_files = ("bb_codeparser.dat", "bb_codeparser.dat-*")
 
     def __init__(self):
-        MultiProcessCache.__init__(self)
+        AppendOnlyCache.__init__(self)
         self.pythoncache = self.cachedata[0]
         self.shellcache = self.cachedata[1]
         self.pythoncacheextras = self.cachedata_extras[0]
@@ -147,17 +148,6 @@ class CodeParserCache(MultiProcessCache):
         self.shellcachelines[h] = cacheline
         return cacheline
 
-    def init_cache(self, d):
-        # Check if we already have the caches
-        if self.pythoncache:
-            return
-
-        MultiProcessCache.init_cache(self, d)
-
-        # cachedata gets re-assigned in the parent
-        self.pythoncache = self.cachedata[0]
-        self.shellcache = self.cachedata[1]
-
     def create_cachedata(self):
         data = [{}, {}]
         return data
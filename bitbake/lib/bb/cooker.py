@@ -149,6 +149,13 @@ class BBCooker:
 
         self.inotify_modified_files = []
 
+        # When running as a resident server, the recipe cache is kept live
+        # between parses and only the recipes depending on files we were
+        # notified about are revalidated
+        self.file_dependents = defaultdict(set)
+        self.inotify_modified_recipes = set()
+        self.warm_cache = None
+
         def _process_inotify_updates(server, notifier_list, abort):
             for n in notifier_list:
                 if n.check_events(timeout=0):
@@ -189,6 +196,7 @@ class BBCooker:
         self.state = state.initial
 
         self.parser = None
+        self.parserpool = None
 
         signal.signal(signal.SIGTERM, self.sigterm_exception)
         # Let SIGHUP exit as SIGTERM
@@ -204,8 +212,16 @@ class BBCooker:
     def notifications(self, event):
         if not event.path in self.inotify_modified_files:
             self.inotify_modified_files.append(event.path)
+        if not event.pathname in self.inotify_modified_files:
+            self.inotify_modified_files.append(event.pathname)
+        self.inotify_modified_recipes.update(self.file_dependents.get(event.pathname, ()))
         self.parsecache_valid = False
 
+    def add_file_dependents(self, virtualfn, deps):
+        fn = bb.cache.Cache.virtualfn2realfn(virtualfn)[0]
+        for i in deps or []:
+            self.file_dependents[i[0]].add(fn)
+
     def add_filewatch(self, deps, watcher=None):
         if not watcher:
             watcher = self.watcher
@@ -1505,6 +1521,9 @@ class BBCooker:
             self.initConfigurationData()
             self.baseconfig_valid = True
             self.parsecache_valid = False
+            self.warm_cache = None
+            self.file_dependents = defaultdict(set)
+            self.inotify_modified_recipes = set()
 
     # This is called for all async commands when self.state != running
     def updateCache(self):
@@ -1637,6 +1656,9 @@ class BBCooker:
 
         if self.parser:
             self.parser.shutdown(clean=not force, force=force)
+        if self.parserpool:
+            self.parserpool.shutdown(clean=not force, force=force)
+            self.parserpool = None
 
     def finishcommand(self):
         self.state = state.initial
@@ -1866,40 +1888,12 @@ class ParsingFailure(Exception):
         self.recipe = recipe
         Exception.__init__(self, realexception, recipe)
 
-class Feeder(multiprocessing.Process):
-    def __init__(self, jobs, to_parsers, quit):
-        self.quit = quit
-        self.jobs = jobs
-        self.to_parsers = to_parsers
-        multiprocessing.Process.__init__(self)
-
-    def run(self):
-        while True:
-            try:
-                quit = self.quit.get_nowait()
-            except Queue.Empty:
-                pass
-            else:
-                if quit == 'cancel':
-                    self.to_parsers.cancel_join_thread()
-                break
-
-            try:
-                job = self.jobs.pop()
-            except IndexError:
-                break
-
-            try:
-                self.to_parsers.put(job, timeout=0.5)
-            except Queue.Full:
-                self.jobs.insert(0, job)
-                continue
-
 class Parser(multiprocessing.Process):
-    def __init__(self, jobs, results, quit, init, profile):
+    def __init__(self, jobs, results, control, generation, init, profile):
         self.jobs = jobs
         self.results = results
-        self.quit = quit
+        self.control = control
+        self.generation = generation
         self.init = init
         multiprocessing.Process.__init__(self)
         self.context = bb.utils.get_context().copy()
@@ -1927,32 +1921,48 @@ class Parser(multiprocessing.Process):
         if self.init:
             self.init()
 
-        pending = []
+        lastgeneration = None
         while True:
             try:
-                self.quit.get_nowait()
+                command = self.control.get_nowait()
             except Queue.Empty:
                 pass
             else:
-                self.results.cancel_join_thread()
-                break
-
-            if pending:
-                result = pending.pop()
-            else:
-                try:
-                    job = self.jobs.get(timeout=0.25)
-                except Queue.Empty:
+                if command == 'flush':
+                    # Save the codeparser and checksum cache entries we
+                    # gathered so the parent can merge them without us
+                    # having to exit
+                    bb.codeparser.parser_cache_save(self.cfg)
+                    bb.fetch.fetcher_parse_save(self.cfg)
+                    bb.parse.instrument.save(self.name)
+                    self.results.put((None, self.name))
                     continue
-
-                if job is None:
+                else:
+                    self.results.cancel_join_thread()
                     break
-                result = self.parse(*job)
 
             try:
-                self.results.put(result, timeout=0.25)
-            except Queue.Full:
-                pending.append(result)
+                job = self.jobs.get(timeout=0.25)
+            except Queue.Empty:
+                continue
+
+            if job is None:
+                break
+
+            generation, chunk = job
+            if generation != lastgeneration:
+                # Included files and classes may have changed since the
+                # previous parse this process took part in
+                bb.parse.clear_cache()
+                lastgeneration = generation
+            for filename, appends, caches_array in chunk:
+                # Jobs left over from a cancelled parse are dropped
+                if generation != self.generation.value:
+                    break
+                start = time.time()
+                with bb.parse.instrument.timed("recipe", filename):
+                    result = self.parse(filename, appends, caches_array)
+                self.results.put((generation, filename, time.time() - start, result))
 
     def parse(self, filename, appends, caches_array):
         try:
@@ -1971,6 +1981,141 @@ class Parser(multiprocessing.Process):
         except BaseException as exc:
             return True, ParsingFailure(exc, filename)
 
+class ParserPool(object):
+    """
+    A set of parser processes forked from one base configuration.
+
+    The memory resident server keeps the pool between parses for as long as
+    the configuration hash stays the same so that reparsing a handful of
+    changed recipes doesn't pay for forking and initialising a process per
+    cpu every time. Jobs are tagged with a generation number so that
+    anything left over from a cancelled parse is discarded.
+    """
+    def __init__(self, cfgdata, cfghash, num_processes, profile):
+        self.cfghash = cfghash
+        self.num_processes = num_processes
+        self.profile = profile
+        self.instrument = cfgdata.getVar("BB_PARSE_INSTRUMENT", True) == "1"
+        self.generation = multiprocessing.Value('i', 0)
+        self.jobs = multiprocessing.Queue(maxsize=num_processes)
+        self.results = multiprocessing.Queue()
+        self.feeder = None
+        self.processes = []
+        self.process_names = []
+
+        def init():
+            Parser.cfg = cfgdata
+            bb.utils.set_process_name(multiprocessing.current_process().name)
+            multiprocessing.util.Finalize(None, bb.codeparser.parser_cache_save, args=(cfgdata,), exitpriority=1)
+            multiprocessing.util.Finalize(None, bb.fetch.fetcher_parse_save, args=(cfgdata,), exitpriority=1)
+            if self.instrument:
+                bb.parse.instrument.enable()
+                multiprocessing.util.Finalize(None, bb.parse.instrument.save, args=(multiprocessing.current_process().name,), exitpriority=1)
+
+        for i in range(0, num_processes):
+            parser = Parser(self.jobs, self.results, multiprocessing.Queue(maxsize=1),
+                            self.generation, init, profile)
+            parser.start()
+            self.processes.append(parser)
+            self.process_names.append(parser.name)
+
+    def usable(self, cfghash):
+        if cfghash != self.cfghash:
+            return False
+        return all(process.is_alive() for process in self.processes)
+
+    def submit(self, chunks):
+        """
+        Queue a list of chunks, each a list of (filename, appends,
+        caches_array) jobs handed to a single process, returning the
+        generation their results will be tagged with.
+        """
+        self.cancel()
+        generation = self.generation.value
+        self.feeder = threading.Thread(target=self.feed, args=(generation, list(chunks)))
+        self.feeder.daemon = True
+        self.feeder.start()
+        return generation
+
+    def feed(self, generation, chunks):
+        chunks.reverse()
+        while chunks and generation == self.generation.value:
+            chunk = chunks.pop()
+            try:
+                self.jobs.put((generation, chunk), timeout=0.5)
+            except Queue.Full:
+                chunks.append(chunk)
+
+    def cancel(self):
+        with self.generation.get_lock():
+            self.generation.value += 1
+        if self.feeder:
+            self.feeder.join()
+            self.feeder = None
+
+    def get(self, generation, timeout):
+        """
+        Return the next (filename, seconds, result) for the given generation
+        or None if nothing arrived within the timeout.
+        """
+        while True:
+            try:
+                result = self.results.get(timeout=timeout)
+            except Queue.Empty:
+                return None
+            if result[0] == generation:
+                return result[1:]
+
+    def flush(self):
+        """
+        Have every process save its codeparser and checksum cache entries
+        so the parent can merge them while the processes stay around.
+        """
+        waiting = set()
+        for process in self.processes:
+            process.control.put('flush')
+            waiting.add(process.name)
+        while waiting:
+            try:
+                result = self.results.get(timeout=0.25)
+            except Queue.Empty:
+                if not all(process.is_alive() for process in self.processes):
+                    return False
+                continue
+            if result[0] is None:
+                waiting.discard(result[1])
+        return True
+
+    def shutdown(self, clean=True, force=False):
+        self.cancel()
+        if clean:
+            for process in self.processes:
+                self.jobs.put(None)
+        else:
+            for process in self.processes:
+                process.control.cancel_join_thread()
+                process.control.put(None)
+            self.jobs.cancel_join_thread()
+
+        for process in self.processes:
+            if force:
+                process.join(.1)
+                process.terminate()
+            else:
+                process.join()
+        self.processes = []
+
+        if self.profile:
+            profiles = []
+            for i in self.process_names:
+                logfile = "profile-parse-%s.log" % i
+                if os.path.exists(logfile):
+                    profiles.append(logfile)
+
+            pout = "profile-parse.log.processed"
+            bb.utils.process_profilelog(profiles, pout = pout)
+            print("Processed parsing statistics saved to %s" % (pout))
+
 class CookerParser(object):
     def __init__(self, cooker, filelist, masked):
         self.filelist = filelist
@@ -1989,9 +2134,21 @@ class CookerParser(object):
         self.total = len(filelist)
 
         self.current = 0
-        self.process_names = []
 
-        self.bb_cache = bb.cache.Cache(self.cfgdata, self.cfghash, cooker.caches_array)
+        self.bb_cache = cooker.warm_cache
+        if self.bb_cache and self.bb_cache.data_hash == self.cfghash:
+            # Wait for the previous parse's cache sync before reusing it
+            if cooker.parser and cooker.parser.syncthread:
+                cooker.parser.syncthread.join()
+            logger.debug(1, "Revalidating %d recipes in the resident cache", len(cooker.inotify_modified_recipes))
+            self.bb_cache.invalidate(cooker.inotify_modified_recipes)
+        else:
+            self.bb_cache = bb.cache.Cache(self.cfgdata, self.cfghash, cooker.caches_array)
+        cooker.inotify_modified_recipes = set()
+        if cooker.configuration.server_only:
+            cooker.warm_cache = self.bb_cache
+        self.syncthread = None
+        self.parsetimes = {}
         self.fromcache = []
         self.willparse = []
         for filename in self.filelist:
@@ -2003,37 +2160,78 @@ class CookerParser(object):
         self.toparse = self.total - len(self.fromcache)
         self.progress_chunk = max(self.toparse / 100, 1)
 
-        self.num_processes = min(int(self.cfgdata.getVar("BB_NUMBER_PARSE_THREADS", True) or
-                                 multiprocessing.cpu_count()), len(self.willparse))
+        self.num_processes = int(self.cfgdata.getVar("BB_NUMBER_PARSE_THREADS", True) or
+                                 multiprocessing.cpu_count())
+        if not cooker.configuration.server_only:
+            self.num_processes = min(self.num_processes, len(self.willparse))
 
         self.start()
         self.haveshutdown = False
 
     def start(self):
         self.results = self.load_cached()
-        self.processes = []
+        self.pool = None
         if self.toparse:
             bb.event.fire(bb.event.ParseStarted(self.toparse), self.cfgdata)
-            def init():
-                Parser.cfg = self.cfgdata
-                bb.utils.set_process_name(multiprocessing.current_process().name)
-                multiprocessing.util.Finalize(None, bb.codeparser.parser_cache_save, args=(self.cfgdata,), exitpriority=1)
-                multiprocessing.util.Finalize(None, bb.fetch.fetcher_parse_save, args=(self.cfgdata,), exitpriority=1)
-
-            self.feeder_quit = multiprocessing.Queue(maxsize=1)
-            self.parser_quit = multiprocessing.Queue(maxsize=self.num_processes)
-            self.jobs = multiprocessing.Queue(maxsize=self.num_processes)
-            self.result_queue = multiprocessing.Queue()
-            self.feeder = Feeder(self.willparse, self.jobs, self.feeder_quit)
-            self.feeder.start()
-            for i in range(0, self.num_processes):
-                parser = Parser(self.jobs, self.result_queue, self.parser_quit, init, self.cooker.configuration.profile)
-                parser.start()
-                self.process_names.append(parser.name)
-                self.processes.append(parser)
+
+            pool = self.cooker.parserpool
+            if pool and not pool.usable(self.cfghash):
+                pool.shutdown(clean=False, force=True)
+                pool = None
+            if not pool:
+                # The parser processes inherit the configuration's expansions
+                # so each recipe doesn't have to repeat them
+                self.cfgdata.share_expand_cache()
+                pool = ParserPool(self.cfgdata, self.cfghash, self.num_processes,
+                                  self.cooker.configuration.profile)
+            if self.cooker.configuration.server_only:
+                self.cooker.parserpool = pool
+            self.pool = pool
+            self.generation = pool.submit(self.schedule(pool.num_processes))
 
             self.results = itertools.chain(self.results, self.parse_generator())
 
+    def schedule(self, num_processes):
+        """
+        Split the recipes to parse into chunks for the parser processes.
+
+        Recipes are ordered by how long they took to parse last time, most
+        expensive first, so that the big ones don't end up being parsed
+        while the other processes sit idle at the end. Chunks hold roughly
+        half of a process' share of the remaining work, so they start out
+        large and shrink to single cheap recipes towards the end. Recipes
+        without a recorded time are assumed to cost the median.
+        """
+        known = sorted(t for t in (self.bb_cache.parsetime(job[0]) for job in self.willparse) if t is not None)
+        if known:
+            default = known[len(known) // 2]
+        else:
+            default = 1.0
+
+        costs = []
+        for job in self.willparse:
+            cost = self.bb_cache.parsetime(job[0])
+            if cost is None:
+                cost = default
+            costs.append((cost, job))
+        costs.sort(key=lambda c: c[0], reverse=True)
+
+        remaining = sum(cost for cost, _ in costs)
+        chunks = []
+        chunk = []
+        chunkcost = 0
+        for cost, job in costs:
+            chunk.append(job)
+            chunkcost += cost
+            if chunkcost >= remaining / (2 * num_processes):
+                chunks.append(chunk)
+                remaining -= chunkcost
+                chunk = []
+                chunkcost = 0
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
     def shutdown(self, clean=True, force=False):
         if not self.toparse:
             return
@@ -2048,41 +2246,36 @@ class CookerParser(object):
                                             self.total)
 
             bb.event.fire(event, self.cfgdata)
-            self.feeder_quit.put(None)
-            for process in self.processes:
-                self.jobs.put(None)
-        else:
-            self.feeder_quit.put('cancel')
 
-            self.parser_quit.cancel_join_thread()
-            for process in self.processes:
-                self.parser_quit.put(None)
+            if self.parsetimes:
+                event = bb.event.ParseTimes(self.parsetimes)
+                for fn, seconds in event.slowest:
+                    parselog.debug(1, "Parsing %s took %.2fs", fn, seconds)
+                bb.event.fire(event, self.cfgdata)
 
-            self.jobs.cancel_join_thread()
+            self.bb_cache.prune_parsetimes(self.filelist)
 
-        for process in self.processes:
-            if force:
-                process.join(.1)
-                process.terminate()
-            else:
-                process.join()
-        self.feeder.join()
+        # Anything still queued is of no further interest
+        self.pool.cancel()
+        if self.pool is self.cooker.parserpool and not force:
+            # Keep the processes for the next parse
+            if clean:
+                self.pool.flush()
+        else:
+            if self.pool is self.cooker.parserpool:
+                self.cooker.parserpool = None
+            self.pool.shutdown(clean, force)
 
-        sync = threading.Thread(target=self.bb_cache.sync)
+        sync = threading.Thread(target=self.bb_cache.sync, args=(self.bb_cache is not self.cooker.warm_cache,))
         sync.start()
+        self.syncthread = sync
         multiprocessing.util.Finalize(None, sync.join, exitpriority=-100)
         bb.codeparser.parser_cache_savemerge(self.cooker.data)
         bb.fetch.fetcher_parse_done(self.cooker.data)
-        if self.cooker.configuration.profile:
-            profiles = []
-            for i in self.process_names:
-                logfile = "profile-parse-%s.log" % i
-                if os.path.exists(logfile):
-                    profiles.append(logfile)
-
-            pout = "profile-parse.log.processed"
-            bb.utils.process_profilelog(profiles, pout = pout)
-            print("Processed parsing statistics saved to %s" % (pout))
+        if self.pool.instrument:
+            reports = bb.parse.instrument.process_reports(self.pool.process_names)
+            if reports:
+                parselog.info("Parse instrumentation saved to %s", " and ".join(reports))
 
     def load_cached(self):
         for filename, appends in self.fromcache:
@@ -2094,15 +2287,15 @@ class CookerParser(object):
             if self.parsed >= self.toparse:
                 break
 
-            try:
-                result = self.result_queue.get(timeout=0.25)
-            except Queue.Empty:
-                pass
-            else:
+            result = self.pool.get(self.generation, 0.25)
+            if result is not None:
+                filename, seconds, result = result
                 value = result[1]
                 if isinstance(value, BaseException):
                     raise value
                 else:
+                    self.parsetimes[filename] = seconds
+                    self.bb_cache.record_parsetime(filename, seconds)
                     yield result
 
     def parse_next(self):
@@ -2164,6 +2357,7 @@ class CookerParser(object):
                 self.cooker.skiplist[virtualfn] = SkippedPackage(info_array[0])
             self.bb_cache.add_info(virtualfn, info_array, self.cooker.recipecache,
                                         parsed=parsed, watcher = self.cooker.add_filewatch)
+            self.cooker.add_file_dependents(virtualfn, info_array[0].file_depends)
         return True
 
     def reparse(self, filename):
@@ -74,6 +74,13 @@ def createCopy(source):
     """
     return source.createCopy()
 
+def createOverlay(source):
+    """Like createCopy() but in constant time, the override data is
+    shared with the source until either of them is modified. Use for
+    the throwaway copies made in loops.
+    """
+    return source.createOverlay()
+
 def initVar(var, d):
     """Non-destructive var init for data structure"""
     d.initVar(var)
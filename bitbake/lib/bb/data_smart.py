@@ -29,6 +29,8 @@ BitBake build tools.
 # Based on functions from the base bb module, Copyright 2003 Holger Schurig
 
 import copy, re, sys, traceback
+import ast
+import itertools
 from collections import MutableMapping
 import logging
 import hashlib
@@ -42,6 +44,35 @@ __setvar_keyword__ = ["_append", "_prepend", "_remove"]
 __setvar_regexp__ = re.compile('(?P<base>.*?)(?P<keyword>_append|_prepend|_remove)(_(?P<add>.*))?$')
 __expand_var_regexp__ = re.compile(r"\${[^{}@\n\t ]+}")
 __expand_python_regexp__ = re.compile(r"\${@.+?}")
+# Functions inline python may call without making its expansion depend on
+# anything but the variables it references
+__pure_python_funcs__ = frozenset(["int", "str", "len", "bool", "float", "min", "max",
+                                   "sorted", "set", "list", "tuple", "abs"])
+__tracked_python_calls__ = ("getVar", "appendVar", "prependVar", "expand", "contains", "contains_any", "base_contains")
+__untracked_python_cache__ = {}
+
+def untracked_python(code, execs):
+    """
+    Whether inline python may read variables which the codeparser can't
+    see, either in functions it calls or by passing a non-literal name to
+    the datastore
+    """
+    if execs - __pure_python_funcs__:
+        return True
+
+    untracked = __untracked_python_cache__.get(code)
+    if untracked is None:
+        untracked = False
+        for node in ast.walk(ast.parse(code.strip(), mode="eval")):
+            if not isinstance(node, ast.Call):
+                continue
+            func = node.func
+            name = func.attr if isinstance(func, ast.Attribute) else getattr(func, "id", None)
+            if name in __tracked_python_calls__ and not (node.args and isinstance(node.args[0], ast.Str)):
+                untracked = True
+                break
+        __untracked_python_cache__[code] = untracked
+    return untracked
 
 def infer_caller_details(loginfo, parent = False, varval = True):
     """Save the caller the trouble of specifying everything."""
@@ -94,22 +125,32 @@ class VariableParse:
         self.varname = varname
         self.d = d
         self.value = val
+        self.unexpanded = None
 
         self.references = set()
         self.execs = set()
         self.contains = {}
 
+        # Whether the value may change without any referenced variable
+        # changing, e.g. inline python calling functions which read the
+        # datastore themselves
+        self.volatile = False
+        # Whether the value depends on which OVERRIDES are active
+        self.overridedep = False
+        # Variables referenced by the _remove values applied to the value,
+        # not references of the value itself
+        self.removerefs = set()
+
     def var_sub(self, match):
             key = match.group()[2:-1]
             if self.varname and key:
                 if self.varname == key:
                     raise Exception("variable %s references itself!" % self.varname)
-            if key in self.d.expand_cache:
-                varparse = self.d.expand_cache[key]
-                var = varparse.value
-            else:
-                var = self.d.getVarFlag(key, "_content", True)
+            # Goes through the expansion cache, which checks the cached
+            # expansion is of the variable's current value
+            var = self.d.getVarFlag(key, "_content", True)
             self.references.add(key)
+            self.overridedep = self.overridedep or self.d._ref_overridedep(key)
             if var is not None:
                 return var
             else:
@@ -136,6 +177,14 @@ class VariableParse:
                 else:
                     self.contains[k].update(parser.contains[k])
             value = utils.better_eval(codeobj, DataContext(self.d))
+
+            if untracked_python(code, parser.execs):
+                self.volatile = True
+            if not self.overridedep:
+                for ref in itertools.chain(parser.references, parser.contains):
+                    if self.d._ref_overridedep(ref):
+                        self.overridedep = True
+                        break
             return str(value)
 
 
@@ -213,14 +262,22 @@ class IncludeHistory(object):
             child.emit(o, level)
 
 class VariableHistory(object):
-    def __init__(self, dataroot):
+    def __init__(self, dataroot, variables=None):
         self.dataroot = dataroot
-        self.variables = COWDictBase.copy()
+        # A copy starts out using the variables of the history it was
+        # copied from and only makes its own COW copy once it is used, most
+        # copies never are
+        self.shared = variables is not None
+        if variables is None:
+            variables = COWDictBase.copy()
+        self.variables = variables
 
     def copy(self):
-        new = VariableHistory(self.dataroot)
-        new.variables = self.variables.copy()
-        return new
+        return VariableHistory(self.dataroot, self.variables)
+
+    def _unshare(self):
+        self.variables = self.variables.copy()
+        self.shared = False
 
     def record(self, *kwonly, **loginfo):
         if not self.dataroot._tracking:
@@ -238,6 +295,8 @@ class VariableHistory(object):
             raise ValueError("record() missing variable or file.")
         var = loginfo['variable']
 
+        if self.shared:
+            self._unshare()
         if var not in self.variables:
             self.variables[var] = []
         if not isinstance(self.variables[var], list):
@@ -247,6 +306,8 @@ class VariableHistory(object):
         self.variables[var].append(loginfo.copy())
 
     def variable(self, var):
+        if self.shared:
+            self._unshare()
         if var in self.variables:
             return self.variables[var]
         else:
@@ -339,12 +400,39 @@ class VariableHistory(object):
 
     def del_var_history(self, var, f=None, line=None):
         """If file f and line are not given, the entire history of var is deleted"""
+        if self.shared:
+            self._unshare()
         if var in self.variables:
             if f and line:
                 self.variables[var] = [ x for x in self.variables[var] if x['file']!=f and x['line']!=line]
             else:
                 self.variables[var] = []
 
+def _expansion_deps(key, varparse):
+    """
+    The variables whose change invalidates the cached expansion key
+    """
+    deps = set(varparse.references)
+    deps.update(varparse.contains)
+    deps.update(varparse.removerefs)
+    if "[" in key:
+        deps.add(key[:key.index("[")])
+    return deps
+
+class SharedExpansions(object):
+    """
+    Expansions made available read-only to the datastores copied from the
+    datastore that made them, with the overrides that were active at the
+    time and an index of the expansions depending on each variable.
+    """
+    def __init__(self, cache, overrides):
+        self.cache = cache
+        self.overrides = overrides
+        self.refs = {}
+        for key, varparse in cache.iteritems():
+            for dep in _expansion_deps(key, varparse):
+                self.refs.setdefault(dep, set()).add(key)
+
 class DataSmart(MutableMapping):
     def __init__(self):
         self.dict = {}
@@ -354,6 +442,16 @@ class DataSmart(MutableMapping):
         self._tracking = False
 
         self.expand_cache = {}
+        # var -> keys in expand_cache which depend on it
+        self.expand_refs = {}
+        self.expand_volatile = set()
+        # Expansions shared by the datastore this one was copied from and
+        # the variables invalidated in them by changes made since
+        self.expand_shared = None
+        self.expand_invalid = set()
+        # Resolved OVERRIDES by the unexpanded data they were computed from,
+        # shared between copies
+        self.overrides_memo = {}
 
         # cookie monster tribute
         # Need to be careful about writes to overridedata as
@@ -363,6 +461,8 @@ class DataSmart(MutableMapping):
         self.overrides = None
         self.overridevars = set(["OVERRIDES", "FILE"])
         self.inoverride = False
+        # The attributes still shared with an overlay, see createOverlay()
+        self.overlaid = set()
 
     def enableTracking(self):
         self._tracking = True
@@ -375,10 +475,15 @@ class DataSmart(MutableMapping):
         if not isinstance(s, basestring): # sanity check
             return VariableParse(varname, self, s)
 
-        if varname and varname in self.expand_cache:
-            return self.expand_cache[varname]
+        if varname:
+            varparse = self._cached_expansion(varname)
+            # Cached expansions stay around until something they depend on
+            # changes, make sure it is for the same string
+            if varparse is not None and varparse.unexpanded == s:
+                return varparse
 
         varparse = VariableParse(varname, self)
+        varparse.unexpanded = s
 
         while s.find('${') != -1:
             olds = s
@@ -403,25 +508,164 @@ class DataSmart(MutableMapping):
         varparse.value = s
 
         if varname:
+            if "[" not in varname and not varparse.overridedep:
+                varparse.overridedep = self._override_dependent(varname)
             self.expand_cache[varname] = varparse
+            for dep in _expansion_deps(varname, varparse):
+                self.expand_refs.setdefault(dep, set()).add(varname)
+            if varparse.volatile:
+                self.expand_volatile.add(varname)
 
         return varparse
 
     def expand(self, s, varname = None):
         return self.expandWithRefs(s, varname).value
 
+    def _cached_expansion(self, varname):
+        varparse = self.expand_cache.get(varname)
+        if varparse is not None:
+            return varparse
+
+        shared = self.expand_shared
+        if shared and varname in shared.cache and varname not in self.expand_invalid:
+            varparse = shared.cache[varname]
+            if varparse.overridedep:
+                self.need_overrides()
+                if self.overrides != shared.overrides:
+                    return None
+            return varparse
+        return None
+
+    def _override_dependent(self, var):
+        """
+        Whether the value of var itself (not counting the variables it
+        references) depends on which overrides are active
+        """
+        if var in self.overridedata:
+            return True
+        local_var = self._findVar(var)
+        if local_var:
+            for keyword in __setvar_keyword__:
+                for (r, o) in local_var.get(keyword, ()):
+                    if o:
+                        return True
+        return False
+
+    def _ref_overridedep(self, var):
+        varparse = self._cached_expansion(var)
+        if varparse is not None:
+            return varparse.overridedep
+        return self._override_dependent(var)
+
+    def _clear_expand_cache(self):
+        self.expand_cache = {}
+        self.expand_refs = {}
+        self.expand_volatile = set()
+
+    def _invalidate_expand(self, var):
+        """
+        Drop the cached expansions which depend on var, directly or through
+        other variables, along with any volatile ones
+        """
+        todo = [var]
+        # Setting e.g. FOO_bar can change FOO
+        while "_" in var:
+            var = var[:var.rfind("_")]
+            if var:
+                todo.append(var)
+        if self.expand_volatile:
+            todo.extend(self.expand_volatile)
+            self.expand_volatile = set()
+
+        shared = self.expand_shared
+        seen = set()
+        while todo:
+            key = todo.pop()
+            if key in seen:
+                continue
+            seen.add(key)
+            self.expand_cache.pop(key, None)
+            todo.extend(self.expand_refs.pop(key, ()))
+            # expand_invalid also holds everything already walked in the
+            # shared expansions, so each is only walked once
+            if shared and key not in self.expand_invalid:
+                self._unshare("expand_invalid")
+                self.expand_invalid.add(key)
+                todo.extend(shared.refs.get(key, ()))
+
+    def share_expand_cache(self):
+        """
+        Make the expansions cached so far available read-only to the
+        datastores copied from this one from now on. Used for the base
+        configuration so that every recipe doesn't have to expand the same
+        configuration variables again.
+        """
+        self.need_overrides()
+        cache = {}
+        shared = self.expand_shared
+        if shared:
+            for key, varparse in shared.cache.iteritems():
+                if key in self.expand_invalid:
+                    continue
+                if varparse.overridedep and shared.overrides != self.overrides:
+                    continue
+                cache[key] = varparse
+
+        # Volatile expansions and anything using them can't be shared
+        excluded = set()
+        todo = list(self.expand_volatile)
+        while todo:
+            key = todo.pop()
+            if key not in excluded:
+                excluded.add(key)
+                todo.extend(self.expand_refs.get(key, ()))
+        for key, varparse in self.expand_cache.iteritems():
+            if key not in excluded:
+                cache[key] = varparse
+
+        self.expand_shared = SharedExpansions(cache, list(self.overrides))
+        self.expand_invalid = set()
+        self._clear_expand_cache()
+
     def finalize(self, parent = False):
         return
 
     def internal_finalize(self, parent = False):
         """Performs final steps upon the datastore, including application of overrides"""
         self.overrides = None
+        # Anything cached may depend on the overrides
+        self._clear_expand_cache()
+
+    def _overrides_signature(self):
+        """
+        The unexpanded data the value of OVERRIDES is computed from
+        """
+        sig = []
+        for var in sorted(self.overridevars):
+            local_var = self._findVar(var)
+            if local_var:
+                sig.append((var, repr([(k, local_var[k]) for k in ("_content", "_defaultval", "_append", "_prepend", "_remove") if k in local_var])))
+            for (r, o) in self.overridedata.get(var, ()):
+                local_var = self._findVar(r)
+                sig.append((r, repr(local_var and local_var.get("_content"))))
+        return tuple(sig)
 
     def need_overrides(self):
         if self.overrides is not None:
             return
         if self.inoverride:
             return
+
+        # Datastores copied from each other tend to resolve OVERRIDES from
+        # the same data over and over again
+        signature = self._overrides_signature()
+        overrides = self.overrides_memo.get(signature)
+        if overrides is not None:
+            self.overrides = list(overrides)
+            self.overridesset = set(self.overrides)
+            self._clear_expand_cache()
+            return
+
         for count in range(5):
             self.inoverride = True
             # Can end up here recursively so setup dummy values
@@ -430,7 +674,7 @@ class DataSmart(MutableMapping):
             self.overrides = (self.getVar("OVERRIDES", True) or "").split(":") or []
             self.overridesset = set(self.overrides)
             self.inoverride = False
-            self.expand_cache = {}
+            self._clear_expand_cache()
             newoverrides = (self.getVar("OVERRIDES", True) or "").split(":") or []
             if newoverrides == self.overrides:
                 break
@@ -439,8 +683,15 @@ class DataSmart(MutableMapping):
         else:
             bb.fatal("Overrides could not be expanded into a stable state after 5 iterations, overrides must be being referenced by other overridden variables in some recursive fashion. Please provide your configuration to bitbake-devel so we can laugh, er, I mean try and understand how to make it work.")
 
+        # The result can't be reused if OVERRIDES relies on inline python
+        # reading variables we can't track
+        if not self.expand_volatile:
+            if len(self.overrides_memo) > 1000:
+                self.overrides_memo.clear()
+            self.overrides_memo[signature] = list(self.overrides)
+
     def initVar(self, var):
-        self.expand_cache = {}
+        self._invalidate_expand(var)
         if not var in self.dict:
             self.dict[var] = {}
 
@@ -474,7 +725,7 @@ class DataSmart(MutableMapping):
 
         if 'op' not in loginfo:
             loginfo['op'] = "set"
-        self.expand_cache = {}
+        self._invalidate_expand(var)
         match  = __setvar_regexp__.match(var)
         if match and match.group("keyword") in __setvar_keyword__:
             base = match.group('base')
@@ -521,6 +772,7 @@ class DataSmart(MutableMapping):
                             active.append(r)
                 for a in active:
                     self.delVar(a)
+                self._unshare("overridedata")
                 del self.overridedata[var]
 
         # more cookies for the cookie monster
@@ -535,6 +787,7 @@ class DataSmart(MutableMapping):
             self._setvar_update_overridevars(var, value)
 
     def _setvar_update_overridevars(self, var, value):
+        self._unshare("overridevars")
         vardata = self.expandWithRefs(value, var)
         new = vardata.references
         new.update(vardata.contains.keys())
@@ -553,6 +806,7 @@ class DataSmart(MutableMapping):
         override = var[var.rfind('_')+1:]
         shortvar = var[:var.rfind('_')]
         while override and override.islower():
+            self._unshare("overridedata")
             if shortvar not in self.overridedata:
                 self.overridedata[shortvar] = []
             if [var, override] not in self.overridedata[shortvar]:
@@ -591,6 +845,7 @@ class DataSmart(MutableMapping):
             self.setVarFlag(newkey, i, dest, ignore=True)
 
         if key in self.overridedata:
+            self._unshare("overridedata")
             self.overridedata[newkey] = []
             for (v, o) in self.overridedata[key]:
                 self.overridedata[newkey].append([v.replace(key, newkey), o])
@@ -619,9 +874,10 @@ class DataSmart(MutableMapping):
         loginfo['detail'] = ""
         loginfo['op'] = 'del'
         self.varhistory.record(**loginfo)
-        self.expand_cache = {}
+        self._invalidate_expand(var)
         self.dict[var] = {}
         if var in self.overridedata:
+            self._unshare("overridedata")
             del self.overridedata[var]
         if '_' in var:
             override = var[var.rfind('_')+1:]
@@ -629,6 +885,7 @@ class DataSmart(MutableMapping):
             while override and override.islower():
                 try:
                     if shortvar in self.overridedata:
+                        self._unshare("overridedata")
                         # Force CoW by recreating the list first
                         self.overridedata[shortvar] = list(self.overridedata[shortvar])
                         self.overridedata[shortvar].remove([var, override])
@@ -642,7 +899,7 @@ class DataSmart(MutableMapping):
                          override = None
 
     def setVarFlag(self, var, flag, value, **loginfo):
-        self.expand_cache = {}
+        self._invalidate_expand(var)
         if 'op' not in loginfo:
             loginfo['op'] = "set"
         loginfo['flag'] = flag
@@ -728,6 +985,11 @@ class DataSmart(MutableMapping):
                 if match:
                     value = r + value
 
+        if flag == "_content" and local_var is not None and "_remove" in local_var:
+            # Working out the overrides clears the expand cache, do it
+            # before the value is cached so the removals are tracked below
+            self.need_overrides()
+
         if expand and value:
             # Only getvar (flag == _content) hits the expand cache
             cachename = None
@@ -739,6 +1001,8 @@ class DataSmart(MutableMapping):
 
         if value and flag == "_content" and local_var is not None and "_remove" in local_var:
             removes = []
+            removerefs = set()
+            removevolatile = False
             self.need_overrides()
             for (r, o) in local_var["_remove"]:
                 match = True
@@ -747,7 +1011,11 @@ class DataSmart(MutableMapping):
                         if not o2 in self.overrides:
                             match = False                            
                 if match:
-                    removes.extend(self.expand(r).split())
+                    removeparse = self.expandWithRefs(r, None)
+                    removes.extend(removeparse.value.split())
+                    removerefs.update(removeparse.references)
+                    removerefs.update(removeparse.contains)
+                    removevolatile = removevolatile or removeparse.volatile
 
             filtered = filter(lambda v: v not in removes,
                               value.split())
@@ -755,11 +1023,19 @@ class DataSmart(MutableMapping):
             if expand and var in self.expand_cache:
                  # We need to ensure the expand cache has the correct value
                  # flag == "_content" here
-                self.expand_cache[var].value = value
+                varparse = self.expand_cache[var]
+                varparse.value = value
+                # and that it goes when what was removed changes
+                for dep in removerefs - varparse.removerefs:
+                    varparse.removerefs.add(dep)
+                    self.expand_refs.setdefault(dep, set()).add(var)
+                if removevolatile:
+                    varparse.volatile = True
+                    self.expand_volatile.add(var)
         return value
 
     def delVarFlag(self, var, flag, **loginfo):
-        self.expand_cache = {}
+        self._invalidate_expand(var)
         local_var = self._findVar(var)
         if not local_var:
             return
@@ -789,7 +1065,7 @@ class DataSmart(MutableMapping):
         self.setVarFlag(var, flag, newvalue, ignore=True)
 
     def setVarFlags(self, var, flags, **loginfo):
-        self.expand_cache = {}
+        self._invalidate_expand(var)
         infer_caller_details(loginfo)
         if not var in self.dict:
             self._makeShadowCopy(var)
@@ -819,7 +1095,7 @@ class DataSmart(MutableMapping):
 
 
     def delVarFlags(self, var, **loginfo):
-        self.expand_cache = {}
+        self._invalidate_expand(var)
         if not var in self.dict:
             self._makeShadowCopy(var)
 
@@ -852,12 +1128,53 @@ class DataSmart(MutableMapping):
 
         data.overrides = None
         data.overridevars = copy.copy(self.overridevars)
+        data.overrides_memo = self.overrides_memo
+        data.expand_shared = self.expand_shared
+        data.expand_invalid = set(self.expand_invalid)
         # Should really be a deepcopy but has heavy overhead.
         # Instead, we're careful with writes.
         data.overridedata = copy.copy(self.overridedata)
 
         return data
 
+    def createOverlay(self):
+        """
+        Create a copy of self like createCopy() but in constant time, for
+        the short lived copies made in loops.
+
+        Rather than being copied up front, the override data is shared
+        with self and copied by whichever of the two datastores changes it
+        first. Variables set in the overlay go to its own dict as with
+        createCopy() and everything else is looked up in self.
+        """
+        data = DataSmart.__new__(DataSmart)
+        data.__dict__.update(self.__dict__)
+        data.dict = {"_data": self.dict}
+        data.varhistory = self.varhistory.copy()
+        data.varhistory.datasmart = data
+        data.inchistory = self.inchistory.copy()
+
+        data.expand_cache = {}
+        data.expand_refs = {}
+        data.expand_volatile = set()
+        data.overrides = None
+        data.inoverride = False
+        data.overlaid = set(self.__overlay_shared__)
+        self.overlaid.update(self.__overlay_shared__)
+
+        return data
+
+    __overlay_shared__ = ("overridedata", "overridevars", "expand_invalid")
+
+    def _unshare(self, attr):
+        """
+        Take a private copy of attr before changing it if it is still shared
+        with an overlay
+        """
+        if attr in self.overlaid:
+            self.overlaid.discard(attr)
+            setattr(self, attr, copy.copy(getattr(self, attr)))
+
     def expandVarref(self, variable, parents=False):
         """Find all references to variable in the data and expand it
            in place, optionally descending to parent datastores."""
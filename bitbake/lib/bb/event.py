@@ -467,6 +467,26 @@ class ParseProgress(OperationProgress):
     def __init__(self, current, total):
         OperationProgress.__init__(self, current, total, "Recipe parsing")
 
+class ParseTimes(Event):
+    """
+    How long the recipes parsed (not loaded from the cache) took to parse.
+    histogram is a list of (upper bound in seconds, count) pairs, the last
+    bound being None, and slowest lists the (filename, seconds) of the most
+    expensive recipes.
+    """
+    bounds = [0.1, 0.25, 0.5, 1, 2, 5, 10, 30]
+
+    def __init__(self, parsetimes, numslowest=10):
+        Event.__init__(self)
+        counts = [0] * (len(self.bounds) + 1)
+        for seconds in parsetimes.itervalues():
+            i = 0
+            while i < len(self.bounds) and seconds > self.bounds[i]:
+                i += 1
+            counts[i] += 1
+        self.histogram = zip(self.bounds + [None], counts)
+        self.slowest = sorted(parsetimes.iteritems(), key=lambda t: t[1], reverse=True)[:numslowest]
+
 
 class CacheLoadStarted(OperationStarted):
     """Loading of the dependency cache has begun"""
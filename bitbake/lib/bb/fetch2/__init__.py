@@ -29,11 +29,10 @@ from __future__ import absolute_import
 from __future__ import print_function
 import os, re
 import signal
-import glob
+import threading
 import logging
 import urllib
 import urlparse
-import operator
 import bb.persist_data, bb.utils
 import bb.checksum
 from bb import data
@@ -691,7 +690,9 @@ def update_stamp(ud, d):
             # Errors aren't fatal here
             pass
     else:
-        checksums = verify_checksum(ud, d)
+        precomputed = ud.download_checksums
+        ud.download_checksums = {}
+        checksums = verify_checksum(ud, d, precomputed)
         # Store the checksums for later re-verification against the recipe
         with open(ud.donestamp, "wb") as cachefile:
             p = pickle.Pickler(cachefile, pickle.HIGHEST_PROTOCOL)
@@ -905,9 +906,21 @@ def rename_bad_checksum(ud, suffix):
     bb.utils.movefile(ud.localpath, new_localpath)
 
 
+# Held while downloading with a method which doesn't support parallel
+# downloads, e.g. when a url downloaded in a worker thread falls back to a
+# git mirror, as such methods change the working directory
+serial_download_lock = threading.RLock()
+
 def try_mirror_url(fetch, origud, ud, ld, check = False):
     # Return of None or a value means we're finished
     # False means try another url
+    if check or (ud.method.supports_parallel_download(ud) and origud.method.supports_parallel_download(origud)):
+        return _try_mirror_url(fetch, origud, ud, ld, check)
+    with serial_download_lock:
+        os.chdir(ld.getVar("DL_DIR", True))
+        return _try_mirror_url(fetch, origud, ud, ld, check)
+
+def _try_mirror_url(fetch, origud, ud, ld, check):
     try:
         if check:
             found = ud.method.checkstatus(fetch, ud, ld)
@@ -915,7 +928,6 @@ def try_mirror_url(fetch, origud, ud, ld, check = False):
                 return found
             return False
 
-        os.chdir(ld.getVar("DL_DIR", True))
 
         if not verify_donestamp(ud, ld, origud) or ud.method.need_update(ud, ld):
             ud.method.download(ud, ld)
@@ -982,7 +994,7 @@ def try_mirrors(fetch, d, origud, mirrors, check = False):
     uri is the original uri we're trying to download
     mirrors is the list of mirrors we're going to try
     """
-    ld = d.createCopy()
+    ld = d.createOverlay()
 
     uris, uds = build_mirroruris(origud, mirrors, ld)
 
@@ -1108,48 +1120,7 @@ def get_file_checksums(filelist, pn):
     it proceeds
 
     """
-
-    def checksum_file(f):
-        try:
-            checksum = _checksum_cache.get_checksum(f)
-        except OSError as e:
-            bb.warn("Unable to get checksum for %s SRC_URI entry %s: %s" % (pn, os.path.basename(f), e))
-            return None
-        return checksum
-
-    def checksum_dir(pth):
-        # Handle directories recursively
-        dirchecksums = []
-        for root, dirs, files in os.walk(pth):
-            for name in files:
-                fullpth = os.path.join(root, name)
-                checksum = checksum_file(fullpth)
-                if checksum:
-                    dirchecksums.append((fullpth, checksum))
-        return dirchecksums
-
-    checksums = []
-    for pth in filelist.split():
-        exist = pth.split(":")[1]
-        if exist == "False":
-            continue
-        pth = pth.split(":")[0]
-        if '*' in pth:
-            # Handle globs
-            for f in glob.glob(pth):
-                if os.path.isdir(f):
-                    checksums.extend(checksum_dir(f))
-                else:
-                    checksum = checksum_file(f)
-                    checksums.append((f, checksum))
-        elif os.path.isdir(pth):
-            checksums.extend(checksum_dir(pth))
-        else:
-            checksum = checksum_file(pth)
-            checksums.append((pth, checksum))
-
-    checksums.sort(key=operator.itemgetter(1))
-    return checksums
+    return _checksum_cache.get_checksums(filelist, pn)
 
 
 class FetchData(object):
@@ -1193,6 +1164,9 @@ class FetchData(object):
         else:
             self.sha256_expected = d.getVarFlag("SRC_URI", self.sha256_name, False)
         self.ignore_checksums = False
+        # Checksums of localpath computed by the fetch method while
+        # downloading, used once by update_stamp() instead of re-reading
+        self.download_checksums = {}
 
         self.names = self.parm.get("name",'default').split(',')
 
@@ -1332,6 +1306,14 @@ class FetchMethod(object):
         """
         return False
 
+    def supports_parallel_download(self, urldata):
+        """
+        Can this url be downloaded in a thread alongside other urls?
+        Only true for methods which don't change the working directory
+        or other process wide state while downloading.
+        """
+        return False
+
     def download(self, urldata, d):
         """
         Fetch urls
@@ -1564,79 +1546,151 @@ class Fetch(object):
         network = self.d.getVar("BB_NO_NETWORK", True)
         premirroronly = (self.d.getVar("BB_FETCH_PREMIRRORONLY", True) == "1")
 
+        threads = int(self.d.getVar("BB_FETCH_THREADS", True) or 1)
+        parallel = []
+        if threads > 1:
+            parallel = [u for u in urls if self.ud[u].method.supports_parallel_download(self.ud[u])]
+            if len(parallel) < 2:
+                parallel = []
+
         for u in urls:
-            ud = self.ud[u]
-            ud.setup_localpath(self.d)
-            m = ud.method
-            localpath = ""
+            if u not in parallel:
+                self._download(u, self.d, network, premirroronly)
 
-            lf = bb.utils.lockfile(ud.lockfile)
+        if parallel:
+            self._download_parallel(parallel, threads, network, premirroronly)
 
-            try:
-                self.d.setVar("BB_NO_NETWORK", network)
- 
-                if verify_donestamp(ud, self.d) and not m.need_update(ud, self.d):
-                    localpath = ud.localpath
-                elif m.try_premirror(ud, self.d):
-                    logger.debug(1, "Trying PREMIRRORS")
-                    mirrors = mirror_from_string(self.d.getVar('PREMIRRORS', True))
-                    localpath = try_mirrors(self, self.d, ud, mirrors, False)
+    def _download_parallel(self, urls, threads, network, premirroronly):
+        """
+        Download urls using up to threads worker threads, with at most
+        BB_FETCH_THREADS_PER_HOST of them talking to the same host. Each
+        url gets its own overlay of the datastore since _download() changes
+        BB_NO_NETWORK. Mirrors using methods which don't support parallel
+        downloads are tried one at a time under serial_download_lock. The
+        error of the first failing url is raised once all running downloads
+        have finished.
+        """
 
-                if premirroronly:
-                    self.d.setVar("BB_NO_NETWORK", "1")
+        hostlimit = int(self.d.getVar("BB_FETCH_THREADS_PER_HOST", True) or threads)
+        pending = list(urls)
+        active = {}
+        errors = {}
+        cond = threading.Condition()
+        # Creating an overlay writes to the parent, so not in the threads
+        overlays = dict((u, self.d.createOverlay()) for u in urls)
+
+        def next_url():
+            with cond:
+                while pending and not errors:
+                    for u in pending:
+                        host = self.ud[u].host
+                        if active.get(host, 0) < hostlimit:
+                            pending.remove(u)
+                            active[host] = active.get(host, 0) + 1
+                            return u
+                    cond.wait()
+                return None
+
+        def worker():
+            while True:
+                u = next_url()
+                if u is None:
+                    return
+                try:
+                    self._download(u, overlays[u], network, premirroronly)
+                except Exception as e:
+                    with cond:
+                        errors[u] = e
+                finally:
+                    with cond:
+                        active[self.ud[u].host] -= 1
+                        cond.notify_all()
+
+        workers = [threading.Thread(target=worker) for _ in range(min(threads, len(urls)))]
+        for t in workers:
+            t.daemon = True
+            t.start()
+        for t in workers:
+            t.join()
 
-                os.chdir(self.d.getVar("DL_DIR", True))
+        for u in urls:
+            if u in errors:
+                raise errors[u]
 
-                firsterr = None
-                verified_stamp = verify_donestamp(ud, self.d)
-                if not localpath and (not verified_stamp or m.need_update(ud, self.d)):
-                    try:
-                        if not trusted_network(self.d, ud.url):
-                            raise UntrustedUrl(ud.url)
-                        logger.debug(1, "Trying Upstream")
-                        m.download(ud, self.d)
-                        if hasattr(m, "build_mirror_data"):
-                            m.build_mirror_data(ud, self.d)
-                        localpath = ud.localpath
-                        # early checksum verify, so that if checksum mismatched,
-                        # fetcher still have chance to fetch from mirror
-                        update_stamp(ud, self.d)
-
-                    except bb.fetch2.NetworkAccess:
-                        raise
+    def _download(self, u, d, network, premirroronly):
+        ud = self.ud[u]
+        ud.setup_localpath(d)
+        m = ud.method
+        localpath = ""
 
-                    except BBFetchException as e:
-                        if isinstance(e, ChecksumError):
-                            logger.warn("Checksum failure encountered with download of %s - will attempt other sources if available" % u)
-                            logger.debug(1, str(e))
-                            rename_bad_checksum(ud, e.checksum)
-                        elif isinstance(e, NoChecksumError):
-                            raise
-                        else:
-                            logger.warn('Failed to fetch URL %s, attempting MIRRORS if available' % u)
-                            logger.debug(1, str(e))
-                        firsterr = e
-                        # Remove any incomplete fetch
-                        if not verified_stamp:
-                            m.clean(ud, self.d)
-                        logger.debug(1, "Trying MIRRORS")
-                        mirrors = mirror_from_string(self.d.getVar('MIRRORS', True))
-                        localpath = try_mirrors(self, self.d, ud, mirrors)
-
-                if not localpath or ((not os.path.exists(localpath)) and localpath.find("*") == -1):
-                    if firsterr:
-                        logger.error(str(firsterr))
-                    raise FetchError("Unable to fetch URL from any source.", u)
-
-                update_stamp(ud, self.d)
-
-            except BBFetchException as e:
-                if isinstance(e, ChecksumError):
-                    logger.error("Checksum failure fetching %s" % u)
-                raise
+        lf = bb.utils.lockfile(ud.lockfile)
 
-            finally:
-                bb.utils.unlockfile(lf)
+        try:
+            d.setVar("BB_NO_NETWORK", network)
+ 
+            if verify_donestamp(ud, d) and not m.need_update(ud, d):
+                localpath = ud.localpath
+            elif m.try_premirror(ud, d):
+                logger.debug(1, "Trying PREMIRRORS")
+                mirrors = mirror_from_string(d.getVar('PREMIRRORS', True))
+                localpath = try_mirrors(self, d, ud, mirrors, False)
+
+            if premirroronly:
+                d.setVar("BB_NO_NETWORK", "1")
+
+            if not m.supports_parallel_download(ud):
+                os.chdir(d.getVar("DL_DIR", True))
+
+            firsterr = None
+            verified_stamp = verify_donestamp(ud, d)
+            if not localpath and (not verified_stamp or m.need_update(ud, d)):
+                try:
+                    if not trusted_network(d, ud.url):
+                        raise UntrustedUrl(ud.url)
+                    logger.debug(1, "Trying Upstream")
+                    m.download(ud, d)
+                    if hasattr(m, "build_mirror_data"):
+                        m.build_mirror_data(ud, d)
+                    localpath = ud.localpath
+                    # early checksum verify, so that if checksum mismatched,
+                    # fetcher still have chance to fetch from mirror
+                    update_stamp(ud, d)
+
+                except bb.fetch2.NetworkAccess:
+                    raise
+
+                except BBFetchException as e:
+                    if isinstance(e, ChecksumError):
+                        logger.warn("Checksum failure encountered with download of %s - will attempt other sources if available" % u)
+                        logger.debug(1, str(e))
+                        rename_bad_checksum(ud, e.checksum)
+                    elif isinstance(e, NoChecksumError):
+                        raise
+                    else:
+                        logger.warn('Failed to fetch URL %s, attempting MIRRORS if available' % u)
+                        logger.debug(1, str(e))
+                    firsterr = e
+                    # Remove any incomplete fetch
+                    if not verified_stamp:
+                        m.clean(ud, d)
+                    logger.debug(1, "Trying MIRRORS")
+                    mirrors = mirror_from_string(d.getVar('MIRRORS', True))
+                    localpath = try_mirrors(self, d, ud, mirrors)
+
+            if not localpath or ((not os.path.exists(localpath)) and localpath.find("*") == -1):
+                if firsterr:
+                    logger.error(str(firsterr))
+                raise FetchError("Unable to fetch URL from any source.", u)
+
+            update_stamp(ud, d)
+
+        except BBFetchException as e:
+            if isinstance(e, ChecksumError):
+                logger.error("Checksum failure fetching %s" % u)
+            raise
+
+        finally:
+            bb.utils.unlockfile(lf)
 
     def checkstatus(self, urls=None):
         """
@@ -1646,26 +1700,85 @@ class Fetch(object):
         if not urls:
             urls = self.urls
 
+        premirrors = mirror_from_string(self.d.getVar('PREMIRRORS', True))
+        mirrors = mirror_from_string(self.d.getVar('MIRRORS', True))
         for u in urls:
-            ud = self.ud[u]
-            ud.setup_localpath(self.d)
-            m = ud.method
-            logger.debug(1, "Testing URL %s", u)
-            # First try checking uri, u, from PREMIRRORS
-            mirrors = mirror_from_string(self.d.getVar('PREMIRRORS', True))
-            ret = try_mirrors(self, self.d, ud, mirrors, True)
-            if not ret:
-                # Next try checking from the original uri, u
-                try:
-                    ret = m.checkstatus(self, ud, self.d)
-                except:
-                    # Finally, try checking uri, u, from MIRRORS
-                    mirrors = mirror_from_string(self.d.getVar('MIRRORS', True))
-                    ret = try_mirrors(self, self.d, ud, mirrors, True)
-
-            if not ret:
+            if not self._checkstatus(u, premirrors, mirrors):
                 raise FetchError("URL %s doesn't work" % u, u)
 
+    def _checkstatus(self, u, premirrors, mirrors):
+        ud = self.ud[u]
+        ud.setup_localpath(self.d)
+        m = ud.method
+        logger.debug(1, "Testing URL %s", u)
+        # First try checking uri, u, from PREMIRRORS
+        ret = try_mirrors(self, self.d, ud, premirrors, True)
+        if not ret:
+            # Next try checking from the original uri, u
+            try:
+                ret = m.checkstatus(self, ud, self.d)
+            except:
+                # Finally, try checking uri, u, from MIRRORS
+                ret = try_mirrors(self, self.d, ud, mirrors, True)
+        return ret
+
+    def checkstatus_many(self, urls=None, threads=None):
+        """
+        Check which urls exist upstream, probing several at once
+
+        Unlike checkstatus() a missing url is not an error, the list of
+        urls which were found is returned instead. Each worker thread
+        works on its own overlay of this fetcher's datastore, as checks
+        may still write to it (e.g. AUTOREV urls), and keeps its own
+        FetchConnectionCache so probes of the same host reuse a
+        persistent connection.
+        """
+        import Queue, multiprocessing
+
+        if not urls:
+            urls = self.urls
+        if not threads:
+            threads = multiprocessing.cpu_count()
+        threads = min(int(threads), len(urls))
+
+        premirrors = mirror_from_string(self.d.getVar('PREMIRRORS', True))
+        mirrors = mirror_from_string(self.d.getVar('MIRRORS', True))
+
+        queue = Queue.Queue()
+        for u in urls:
+            queue.put(u)
+        found = set()
+
+        def worker(d):
+            import copy
+            fetch = copy.copy(self)
+            fetch.d = d
+            fetch.connection_cache = FetchConnectionCache()
+            try:
+                while True:
+                    try:
+                        u = queue.get_nowait()
+                    except Queue.Empty:
+                        return
+                    try:
+                        if fetch._checkstatus(u, premirrors, mirrors):
+                            found.add(u)
+                    except Exception as e:
+                        logger.debug(1, "Status check of %s failed: %s" % (u, str(e)))
+            finally:
+                fetch.connection_cache.close_connections()
+
+        # Creating an overlay writes to the parent, so not in the threads
+        workers = [threading.Thread(target=worker, args=(self.d.createOverlay(),))
+                   for _ in range(threads)]
+        for t in workers:
+            t.daemon = True
+            t.start()
+        for t in workers:
+            t.join()
+
+        return [u for u in urls if u in found]
+
     def unpack(self, root, urls=None):
         """
         Check all urls exist upstream
@@ -1681,10 +1794,11 @@ class Fetch(object):
             if ud.lockfile:
                 lf = bb.utils.lockfile(ud.lockfile)
 
-            ud.method.unpack(ud, root, self.d)
-
-            if ud.lockfile:
-                bb.utils.unlockfile(lf)
+            try:
+                ud.method.unpack(ud, root, self.d)
+            finally:
+                if ud.lockfile:
+                    bb.utils.unlockfile(lf)
 
     def clean(self, urls=None):
         """
@@ -49,6 +49,22 @@ Supported SRC_URI options are:
    referring to commit which is valid in tag instead of branch.
    The default is "0", set nobranch=1 if needed.
 
+- reference
+   The url of a related git repository whose local mirror in DL_DIR the
+   mirror of this repository borrows objects from (git clone --reference)
+   when it is first cloned, e.g. a kernel tree referencing the mainline
+   tree. The referenced mirror must already exist and must be kept, the
+   borrowing mirror is recloned if it disappears. Only the removal of the
+   whole referenced mirror is noticed: objects it loses to "git gc" or
+   "git prune" are not checked for, so never prune a referenced mirror.
+   Ignored when mirror tarballs are generated since those must be
+   self-contained.
+
+- worktree
+   Unpack with "git worktree add" from the mirror instead of cloning it,
+   leaving a detached HEAD at the revision rather than a local branch.
+   Requires git 2.9 or later. The default is "0", set worktree=1 if needed.
+
 """
 
 #Copyright (C) 2005 Richard Purdie
@@ -69,6 +85,8 @@ Supported SRC_URI options are:
 import errno
 import os
 import re
+import time
+import hashlib
 import bb
 import errno
 from   bb    import data
@@ -79,7 +97,14 @@ from   bb.fetch2 import logger
 class Git(FetchMethod):
     """Class to fetch a module or modules from git repositories"""
     def init(self, d):
-        pass
+        # Drop ls-remote results older than BB_GIT_LSREMOTE_TTL so each
+        # build sees current heads, by default they only last one build
+        ttl = int(d.getVar("BB_GIT_LSREMOTE_TTL", True) or 0)
+        cache = bb.persist_data.persist('BB_GIT_LSREMOTE', d)
+        now = time.time()
+        for repourl, value in cache.items():
+            if now - float(value.split("\n", 1)[0]) >= ttl:
+                del cache[repourl]
 
     def supports(self, ud, d):
         """
@@ -111,6 +136,8 @@ class Git(FetchMethod):
 
         ud.nobranch = ud.parm.get("nobranch","0") == "1"
 
+        ud.worktree = ud.parm.get("worktree","0") == "1"
+
         # bareclone implies nocheckout
         ud.bareclone = ud.parm.get("bareclone","0") == "1"
         if ud.bareclone:
@@ -139,9 +166,7 @@ class Git(FetchMethod):
                     ud.unresolvedrev[name] = ud.revisions[name]
                 ud.revisions[name] = self.latest_revision(ud, d, name)
 
-        gitsrcname = '%s%s' % (ud.host.replace(':', '.'), ud.path.replace('/', '.').replace('*', '.'))
-        if gitsrcname.startswith('.'):
-            gitsrcname = gitsrcname[1:]
+        gitsrcname = self._gitsrcname(ud.host, ud.path)
 
         # for rebaseable git repo, it is necessary to keep mirror tar ball
         # per revision, so that even the revision disappears from the
@@ -155,14 +180,44 @@ class Git(FetchMethod):
         gitdir = d.getVar("GITDIR", True) or (d.getVar("DL_DIR", True) + "/git2/")
         ud.clonedir = os.path.join(gitdir, gitsrcname)
 
+        ud.referencedir = None
+        if "reference" in ud.parm:
+            (_, refhost, refpath, _, _, _) = bb.fetch2.decodeurl(ud.parm["reference"])
+            ud.referencedir = os.path.join(gitdir, self._gitsrcname(refhost, refpath))
+
         ud.localfile = ud.clonedir
 
+    def _gitsrcname(self, host, path):
+        gitsrcname = '%s%s' % (host.replace(':', '.'), path.replace('/', '.').replace('*', '.'))
+        if gitsrcname.startswith('.'):
+            gitsrcname = gitsrcname[1:]
+        return gitsrcname
+
+    def _missing_alternates(self, ud):
+        """
+        Return True if the mirror borrows objects from a repository which
+        no longer exists, leaving it unusable. Objects pruned from a
+        repository which still exists are not noticed, verifying them
+        (git fsck --connectivity-only) would cost too much on every fetch.
+        """
+        alternates = os.path.join(ud.clonedir, "objects", "info", "alternates")
+        if not os.path.exists(alternates):
+            return False
+        with open(alternates) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#") and not os.path.isdir(os.path.join(ud.clonedir, "objects", line)):
+                    return True
+        return False
+
     def localpath(self, ud, d):
         return ud.clonedir
 
     def need_update(self, ud, d):
         if not os.path.exists(ud.clonedir):
             return True
+        if self._missing_alternates(ud):
+            return True
         os.chdir(ud.clonedir)
         for name in ud.names:
             if not self._contains_ref(ud, d, name):
@@ -183,6 +238,10 @@ class Git(FetchMethod):
     def download(self, ud, d):
         """Fetch url"""
 
+        if os.path.exists(ud.clonedir) and self._missing_alternates(ud):
+            logger.warn("Objects borrowed by %s are no longer available, recloning it" % ud.clonedir)
+            bb.utils.remove(ud.clonedir, True)
+
         # If the checkout doesn't exist and the mirror tarball does, extract it
         if not os.path.exists(ud.clonedir) and os.path.exists(ud.fullmirror):
             bb.utils.mkdirhier(ud.clonedir)
@@ -197,6 +256,8 @@ class Git(FetchMethod):
             if repourl.startswith("file://"):
                 repourl = repourl[7:]
             clone_cmd = "%s clone --bare --mirror %s %s" % (ud.basecmd, repourl, ud.clonedir)
+            if ud.referencedir and not ud.write_tarballs and os.path.exists(ud.referencedir):
+                clone_cmd = "%s clone --bare --mirror --reference %s %s %s" % (ud.basecmd, ud.referencedir, repourl, ud.clonedir)
             if ud.proto.lower() != 'file':
                 bb.fetch2.check_network_access(d, clone_cmd)
             runfetchcmd(clone_cmd, d)
@@ -258,6 +319,19 @@ class Git(FetchMethod):
         if os.path.exists(destdir):
             bb.utils.prunedir(destdir)
 
+        if ud.worktree and not ud.bareclone and subdir == "":
+            # This writes to the shared mirror, Fetch.unpack() holds
+            # ud.lockfile so that it cannot race with other unpacks or with
+            # a download updating the mirror.
+            # Forget worktrees whose directories have since been removed
+            os.chdir(ud.clonedir)
+            runfetchcmd("%s worktree prune" % ud.basecmd, d)
+            worktreeflags = "--detach"
+            if ud.nocheckout:
+                worktreeflags += " --no-checkout"
+            runfetchcmd("%s worktree add %s %s %s" % (ud.basecmd, worktreeflags, destdir, ud.revisions[ud.names[0]]), d)
+            return True
+
         cloneflags = "-s -n"
         if ud.bareclone:
             cloneflags += " --mirror"
@@ -344,6 +418,35 @@ class Git(FetchMethod):
         Run git ls-remote with the specified search string
         """
         repourl = self._get_repo_url(ud)
+        if not search:
+            return self._lsremote_cached(ud, d, repourl)
+        return self._run_lsremote(ud, d, repourl, search)
+
+    def _lsremote_cached(self, ud, d, repourl):
+        """
+        Return the complete ls-remote output of repourl. The output is
+        shared by every recipe resolving revisions in the repository
+        through the BB_GIT_LSREMOTE persistent domain. A lock per repository
+        makes parser processes wait for an ls-remote already running
+        rather than start their own.
+        """
+        cache = bb.persist_data.persist('BB_GIT_LSREMOTE', d)
+        if repourl in cache:
+            return cache[repourl].split("\n", 1)[1]
+
+        lockdir = os.path.join(d.getVar("PERSISTENT_DIR", True) or d.getVar("CACHE", True), "git-lsremote-locks")
+        bb.utils.mkdirhier(lockdir)
+        lf = bb.utils.lockfile(os.path.join(lockdir, hashlib.md5(repourl).hexdigest() + ".lock"))
+        try:
+            if repourl in cache:
+                return cache[repourl].split("\n", 1)[1]
+            output = self._run_lsremote(ud, d, repourl, "")
+            cache[repourl] = "%f\n%s" % (time.time(), output)
+            return output
+        finally:
+            bb.utils.unlockfile(lf)
+
+    def _run_lsremote(self, ud, d, repourl, search):
         cmd = "%s ls-remote %s %s" % \
               (ud.basecmd, repourl, search)
         if ud.proto.lower() != 'file':
@@ -365,10 +468,16 @@ class Git(FetchMethod):
         else:
             head = "refs/heads/%s" % ud.unresolvedrev[name]
             tag = "refs/tags/%s" % ud.unresolvedrev[name]
+        # The output lists every ref of the repository, compare whole ref
+        # names so that e.g. "v1" doesn't match the "v1-maint" branch
+        refs = {}
+        for l in output.split('\n'):
+            if l.strip():
+                sha, ref = l.split(None, 1)
+                refs.setdefault(ref.strip(), sha)
         for s in [head, tag + "^{}", tag]:
-            for l in output.split('\n'):
-                if s in l:
-                    return l.split()[0]
+            if s in refs:
+                return refs[s]
         raise bb.fetch2.FetchError("Unable to resolve '%s' in upstream git repository in git ls-remote output for %s" % \
             (ud.unresolvedrev[name], ud.host+ud.path))
 
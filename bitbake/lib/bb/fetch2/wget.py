@@ -52,6 +52,9 @@ class Wget(FetchMethod):
     def recommends_checksum(self, urldata):
         return True
 
+    def supports_parallel_download(self, urldata):
+        return True
+
     def urldata_init(self, ud, d):
         if 'protocol' in ud.parm:
             if ud.parm['protocol'] == 'git':
@@ -75,6 +78,9 @@ class Wget(FetchMethod):
     def download(self, ud, d):
         """Fetch urls"""
 
+        if ud.type in ['http', 'https'] and d.getVar("BB_FETCH_NATIVE_HTTP", True) == "1":
+            return self._download_native(ud, d)
+
         fetchcmd = self.basecmd
 
         if 'downloadfilename' in ud.parm:
@@ -102,6 +108,101 @@ class Wget(FetchMethod):
 
         return True
 
+    def _download_native(self, ud, d):
+        """
+        Download ud without wget. Data is written to ${localpath}.tmp,
+        which is resumed with a Range request if an earlier attempt left
+        it behind, and the md5/sha256 checksums are computed while the
+        data streams in so verification doesn't read the file again.
+        """
+        import urllib2, hashlib, base64
+
+        uri = ud.url.split(";")[0]
+        bb.fetch2.check_network_access(d, "HTTP GET %s" % uri, uri)
+        export_proxies(d)
+
+        bb.utils.mkdirhier(os.path.dirname(ud.localpath))
+        tmpfile = ud.localpath + ".tmp"
+        blocksize = 1024 * 1024
+
+        for attempt in range(2):
+            md5 = hashlib.md5()
+            sha256 = hashlib.sha256()
+            offset = 0
+            if os.path.exists(tmpfile):
+                # Only the part we already have is read back
+                with open(tmpfile, "rb") as f:
+                    for chunk in iter(lambda: f.read(blocksize), ""):
+                        md5.update(chunk)
+                        sha256.update(chunk)
+                        offset += len(chunk)
+
+            r = urllib2.Request(uri)
+            if ud.user and ud.pswd:
+                r.add_header("Authorization", "Basic %s" % base64.b64encode("%s:%s" % (ud.user, ud.pswd)))
+            if offset:
+                r.add_header("Range", "bytes=%d-" % offset)
+
+            try:
+                response = urllib2.urlopen(r, timeout=30)
+            except urllib2.HTTPError as e:
+                if e.code == 416 and offset:
+                    # The partial file can't be resumed, start over
+                    bb.utils.remove(tmpfile)
+                    continue
+                raise FetchError("Fetching %s failed: %s" % (uri, str(e)), uri)
+            except Exception as e:
+                if attempt:
+                    raise FetchError("Fetching %s failed: %s" % (uri, str(e)), uri)
+                continue
+
+            expected = None
+            if offset and response.getcode() == 206:
+                logger.debug(1, "Resuming download of %s at offset %d" % (uri, offset))
+                contentrange = response.info().getheader("Content-Range") or ""
+                if "/" in contentrange and contentrange.rsplit("/", 1)[1].isdigit():
+                    expected = int(contentrange.rsplit("/", 1)[1])
+                mode = "ab"
+            else:
+                if offset:
+                    logger.debug(1, "%s doesn't support resuming, restarting download" % uri)
+                md5 = hashlib.md5()
+                sha256 = hashlib.sha256()
+                offset = 0
+                if response.info().getheader("Content-Length"):
+                    expected = int(response.info().getheader("Content-Length"))
+                mode = "wb"
+
+            size = offset
+            interrupted = False
+            try:
+                with open(tmpfile, mode) as f:
+                    for chunk in iter(lambda: response.read(blocksize), ""):
+                        f.write(chunk)
+                        md5.update(chunk)
+                        sha256.update(chunk)
+                        size += len(chunk)
+            except Exception as e:
+                logger.debug(1, "Download of %s interrupted: %s" % (uri, str(e)))
+                interrupted = True
+            finally:
+                response.close()
+
+            if not interrupted and (expected is None or size == expected):
+                break
+            logger.debug(1, "Download of %s stopped after %d bytes" % (uri, size))
+        else:
+            # The partial .tmp file is kept so a later fetch can resume it
+            raise FetchError("Unable to download %s completely" % uri, uri)
+
+        if size == 0:
+            bb.utils.remove(tmpfile)
+            raise FetchError("The fetch of %s resulted in a zero size file?! Deleting and failing since this isn't right." % (uri), uri)
+
+        os.rename(tmpfile, ud.localpath)
+        ud.download_checksums = {"md5": md5.hexdigest(), "sha256": sha256.hexdigest()}
+        return True
+
     def checkstatus(self, fetch, ud, d):
         import urllib2, socket, httplib
         from urllib import addinfourl
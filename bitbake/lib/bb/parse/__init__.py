@@ -84,6 +84,14 @@ def update_cache(f):
         logger.debug(1, "Updating mtime cache for %s" % f)
         update_mtime(f)
 
+def clear_cache():
+    """
+    Forget the mtimes and statements cached for the files parsed so far as
+    they may have been edited since
+    """
+    __mtime_cache.clear()
+    BBHandler.cached_statements.clear()
+
 def mark_dependency(d, f):
     if f.startswith('./'):
         f = "%s/%s" % (os.getcwd(), f[2:])
@@ -30,6 +30,7 @@ import bb
 import itertools
 from bb import methodpool
 from bb.parse import logger
+import bb.parse.instrument
 
 _bbversions_re = re.compile(r"\[(?P<from>[0-9]+)-(?P<to>[0-9]+)\]")
 
@@ -331,10 +332,15 @@ def finalize(fn, d, variant = None):
 
     bb.data.expandKeys(d)
     bb.data.update_data(d)
-    code = []
-    for funcname in d.getVar("__BBANONFUNCS", False) or []:
-        code.append("%s(d)" % funcname)
-    bb.utils.better_exec("\n".join(code), {"d": d})
+    if bb.parse.instrument.active:
+        for funcname in d.getVar("__BBANONFUNCS", False) or []:
+            with bb.parse.instrument.timed("anonymous", funcname):
+                bb.utils.better_exec("%s(d)" % funcname, {"d": d})
+    else:
+        code = []
+        for funcname in d.getVar("__BBANONFUNCS", False) or []:
+            code.append("%s(d)" % funcname)
+        bb.utils.better_exec("\n".join(code), {"d": d})
     bb.data.update_data(d)
 
     tasklist = d.getVar('__BBTASKS', False) or []
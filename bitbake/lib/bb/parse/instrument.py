@@ -0,0 +1,191 @@
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+"""
+BitBake parse instrumentation
+
+When BB_PARSE_INSTRUMENT is set to "1" the parser processes record where
+the time spent parsing recipes goes: per recipe, per inherited class, per
+anonymous python function and per variable passed to getVar() and
+expandWithRefs(). For each of these the number of calls, the total time
+including anything called from within and the time not attributed to any
+nested entry ("self" time) is kept.
+
+Each parser process writes its figures to parse-instrument-<process>.json
+and the cooker merges these into parse-instrument.json along with a
+summary table in parse-instrument.txt.
+"""
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import json
+import os
+import time
+import bb.data_smart
+
+CATEGORIES = ["recipe", "class", "anonymous", "getVar", "expandWithRefs"]
+
+active = False
+
+# category -> name -> [count, total, self]
+stats = {}
+
+# One entry per timed call in progress holding the time spent in the
+# timed calls nested within it
+_stack = []
+
+def _record(category, name, start, nested):
+    elapsed = time.time() - start
+    entries = stats.setdefault(category, {})
+    entry = entries.get(name)
+    if entry is None:
+        entry = entries[name] = [0, 0.0, 0.0]
+    entry[0] += 1
+    entry[1] += elapsed
+    entry[2] += elapsed - nested
+    if _stack:
+        _stack[-1][0] += elapsed
+
+class timed(object):
+    """
+    Context manager attributing the time spent within it to name in the
+    given category. Does nothing unless instrumentation is enabled.
+    """
+    def __init__(self, category, name):
+        self.category = category
+        self.name = name
+        self.frame = None
+
+    def __enter__(self):
+        if active:
+            self.frame = [0.0]
+            _stack.append(self.frame)
+            self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.frame:
+            _stack.pop()
+            _record(self.category, self.name, self.start, self.frame[0])
+
+def _wrap(category, func, key):
+    def wrapper(self, *args, **kwargs):
+        frame = [0.0]
+        _stack.append(frame)
+        start = time.time()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            _stack.pop()
+            _record(category, key(args, kwargs), start, frame[0])
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    wrapper.instrumented = func
+    return wrapper
+
+def enable():
+    """
+    Start recording. This replaces DataSmart.getVar and
+    DataSmart.expandWithRefs with timing wrappers, so is only meant to be
+    called in processes that exist for parsing.
+    """
+    global active
+    if active:
+        return
+    active = True
+
+    DataSmart = bb.data_smart.DataSmart
+    DataSmart.getVar = _wrap("getVar", DataSmart.__dict__["getVar"],
+                             lambda args, kwargs: args[0] if args else kwargs.get("var"))
+    DataSmart.expandWithRefs = _wrap("expandWithRefs", DataSmart.__dict__["expandWithRefs"],
+                                     lambda args, kwargs: args[1] or "(no variable)")
+
+def disable():
+    global active
+    if not active:
+        return
+    active = False
+
+    DataSmart = bb.data_smart.DataSmart
+    DataSmart.getVar = DataSmart.__dict__["getVar"].instrumented
+    DataSmart.expandWithRefs = DataSmart.__dict__["expandWithRefs"].instrumented
+
+def fragment_name(process_name):
+    return "parse-instrument-%s.json" % process_name
+
+def save(process_name):
+    """
+    Write the figures recorded so far for merging by the cooker and start
+    afresh.
+    """
+    if not stats:
+        return
+    fn = fragment_name(process_name)
+    saved = {}
+    if os.path.exists(fn):
+        with open(fn, "r") as f:
+            saved = json.load(f)
+    merge(saved, stats)
+    with open(fn, "w") as f:
+        json.dump(saved, f)
+    stats.clear()
+
+def merge(dest, source):
+    for category, entries in source.iteritems():
+        dest_entries = dest.setdefault(category, {})
+        for name, (count, total, selftime) in entries.iteritems():
+            entry = dest_entries.setdefault(name, [0, 0.0, 0.0])
+            entry[0] += count
+            entry[1] += total
+            entry[2] += selftime
+
+def summary(merged, top=20):
+    lines = []
+    for category in CATEGORIES:
+        entries = merged.get(category)
+        if not entries:
+            continue
+        lines.append("%s: %d entries, %.2fs self time in total" %
+                     (category, len(entries), sum(e[2] for e in entries.itervalues())))
+        lines.append("  %10s %12s %12s  %s" % ("count", "total(s)", "self(s)", "name"))
+        for name, (count, total, selftime) in sorted(entries.iteritems(), key=lambda e: e[1][1], reverse=True)[:top]:
+            lines.append("  %10d %12.3f %12.3f  %s" % (count, total, selftime, name))
+        lines.append("")
+    return "\n".join(lines)
+
+def process_reports(process_names, pout="parse-instrument"):
+    """
+    Merge the figures written by the given parser processes into
+    <pout>.json and write a summary table to <pout>.txt. Returns the
+    names of the files written, if any.
+    """
+    merged = {}
+    for name in process_names:
+        fn = fragment_name(name)
+        if not os.path.exists(fn):
+            continue
+        with open(fn, "r") as f:
+            merge(merged, json.load(f))
+        os.unlink(fn)
+    if not merged:
+        return []
+
+    report = {}
+    for category, entries in merged.iteritems():
+        report[category] = dict((name, {"count": count, "total": total, "self": selftime})
+                                for name, (count, total, selftime) in entries.iteritems())
+    with open(pout + ".json", "w") as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    with open(pout + ".txt", "w") as f:
+        f.write(summary(merged))
+    return [pout + ".json", pout + ".txt"]
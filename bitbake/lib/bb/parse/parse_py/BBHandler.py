@@ -28,7 +28,7 @@
 from __future__ import absolute_import
 import re, bb, os
 import logging
-import bb.build, bb.utils
+import bb.build, bb.utils, bb.parse.instrument
 from bb import data
 
 from . import ConfHandler
@@ -78,7 +78,8 @@ def inherit(files, fn, lineno, d):
             logger.debug(1, "Inheriting %s (from %s:%d)" % (file, fn, lineno))
             __inherit_cache.append( file )
             d.setVar('__inherit_cache', __inherit_cache)
-            include(fn, file, lineno, d, "inherit")
+            with bb.parse.instrument.timed("class", file):
+                include(fn, file, lineno, d, "inherit")
             __inherit_cache = d.getVar('__inherit_cache', False) or []
 
 def get_statements(filename, absolute_filename, base_name):
@@ -25,6 +25,7 @@ import collections
 import logging
 import os.path
 import sys
+import threading
 import warnings
 from bb.compat import total_ordering
 from collections import Mapping
@@ -40,11 +41,78 @@ if sqlversion[0] < 3 or (sqlversion[0] == 3 and sqlversion[1] < 3):
 
 
 logger = logging.getLogger("BitBake.PersistData")
-if hasattr(sqlite3, 'enable_shared_cache'):
-    try:
-        sqlite3.enable_shared_cache(True)
-    except sqlite3.OperationalError:
-        pass
+
+# The open databases of this process by filename, see database()
+_databases = {}
+_databases_pid = None
+# Databases opened by the process this one was forked from. They must not
+# be used here, closing them included, so they are kept from being freed.
+_inherited_databases = []
+
+class Database(object):
+    """
+    The connection to a database file, shared by all the SQLTables of a
+    process using it, and the values read through it
+    """
+    def __init__(self, cachefile):
+        self.connection = connect(cachefile)
+        self.lock = threading.RLock()
+        # table -> key -> value, see cache()
+        self.caches = {}
+        # Tables known to exist with a unique key index
+        self.tables = set()
+        self.data_version = self._data_version()
+
+    def _data_version(self):
+        # Changes whenever another connection commits to the database,
+        # needs sqlite 3.8.4 or later
+        for row in self.connection.execute("PRAGMA data_version;"):
+            return row[0]
+        return None
+
+    def execute(self, *query):
+        """Execute a query returning all the resulting rows"""
+        with self.lock:
+            return self.connection.execute(*query).fetchall()
+
+    def executemany(self, query, params):
+        """Execute a query for each set of params as one transaction"""
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE;")
+            try:
+                self.connection.executemany(query, params)
+            except:
+                self.connection.execute("ROLLBACK;")
+                raise
+            self.connection.execute("COMMIT;")
+
+    def cache(self, table):
+        """
+        Return the values of table read or written by this process. They
+        are thrown away whenever another process changes the database. If
+        that can't be detected no values are kept.
+        """
+        with self.lock:
+            version = self._data_version()
+            if version is None:
+                return {}
+            if version != self.data_version:
+                self.data_version = version
+                for cache in self.caches.itervalues():
+                    cache.clear()
+            return self.caches.setdefault(table, {})
+
+def database(cachefile):
+    """Return the Database for cachefile, opening it once per process"""
+    global _databases_pid
+    if _databases_pid != os.getpid():
+        # Connections must not be used across a fork
+        _inherited_databases.extend(_databases.values())
+        _databases.clear()
+        _databases_pid = os.getpid()
+    if cachefile not in _databases:
+        _databases[cachefile] = Database(cachefile)
+    return _databases[cachefile]
 
 
 @total_ordering
@@ -53,43 +121,52 @@ class SQLTable(collections.MutableMapping):
     def __init__(self, cachefile, table):
         self.cachefile = cachefile
         self.table = table
-        self.cursor = connect(self.cachefile)
+        self.db = database(cachefile)
+
+        if table not in self.db.tables:
+            self._create()
+            self.db.tables.add(table)
 
+    def _create(self):
+        table = self.table
         self._execute("CREATE TABLE IF NOT EXISTS %s(key TEXT, value TEXT);"
                       % table)
+        try:
+            self._execute("CREATE UNIQUE INDEX IF NOT EXISTS %s_key ON %s(key);"
+                          % (table, table))
+        except sqlite3.IntegrityError:
+            # Left behind by racing writers before keys were unique
+            self._execute("DELETE FROM %s WHERE rowid NOT IN (SELECT max(rowid) FROM %s GROUP BY key);"
+                          % (table, table))
+            self._execute("CREATE UNIQUE INDEX IF NOT EXISTS %s_key ON %s(key);"
+                          % (table, table))
 
     def _execute(self, *query):
-        """Execute a query, waiting to acquire a lock if necessary"""
-        count = 0
-        while True:
-            try:
-                return self.cursor.execute(*query)
-            except sqlite3.OperationalError as exc:
-                if 'database is locked' in str(exc) and count < 500:
-                    count = count + 1
-                    self.cursor.close()
-                    self.cursor = connect(self.cachefile)
-                    continue
-                raise
+        """Execute a query, sqlite waits to acquire a lock if necessary"""
+        return self.db.execute(*query)
 
     def __enter__(self):
-        self.cursor.__enter__()
+        self.db.connection.__enter__()
         return self
 
     def __exit__(self, *excinfo):
-        self.cursor.__exit__(*excinfo)
+        self.db.connection.__exit__(*excinfo)
 
     def __getitem__(self, key):
-        data = self._execute("SELECT * from %s where key=?;" %
-                             self.table, [key])
-        for row in data:
-            return row[1]
+        cache = self.db.cache(self.table)
+        if key in cache:
+            return cache[key]
+        for row in self._execute("SELECT value from %s where key=?;" %
+                                 self.table, [key]):
+            cache[key] = row[0]
+            return row[0]
         raise KeyError(key)
 
     def __delitem__(self, key):
         if key not in self:
             raise KeyError(key)
         self._execute("DELETE from %s where key=?;" % self.table, [key])
+        self.db.cache(self.table).pop(key, None)
 
     def __setitem__(self, key, value):
         if not isinstance(key, basestring):
@@ -97,18 +174,55 @@ class SQLTable(collections.MutableMapping):
         elif not isinstance(value, basestring):
             raise TypeError('Only string values are supported')
 
-        data = self._execute("SELECT * from %s where key=?;" %
-                                   self.table, [key])
-        exists = len(list(data))
-        if exists:
-            self._execute("UPDATE %s SET value=? WHERE key=?;" % self.table,
-                          [value, key])
-        else:
-            self._execute("INSERT into %s(key, value) values (?, ?);" %
-                          self.table, [key, value])
+        cache = self.db.cache(self.table)
+        self._execute("INSERT OR REPLACE INTO %s(key, value) VALUES (?, ?);" %
+                      self.table, [key, value])
+        cache[key] = value
+
+    def get_many(self, keys):
+        """
+        Return a dict with the values of those of keys which are in the
+        table, looked up with as few queries as possible
+        """
+        cache = self.db.cache(self.table)
+        values = {}
+        missing = []
+        for key in keys:
+            if key in cache:
+                values[key] = cache[key]
+            else:
+                missing.append(key)
+        # Stay below sqlite's limit on the number of parameters
+        for i in range(0, len(missing), 500):
+            chunk = missing[i:i + 500]
+            for key, value in self._execute("SELECT key, value FROM %s WHERE key IN (%s);" %
+                                            (self.table, ",".join("?" * len(chunk))), chunk):
+                values[key] = cache[key] = value
+        return values
+
+    def set_many(self, items):
+        """
+        Set the values of several keys at once, items being a dict or
+        iterable of (key, value) pairs
+        """
+        if isinstance(items, Mapping):
+            items = items.items()
+        items = list(items)
+        for key, value in items:
+            if not isinstance(key, basestring) or not isinstance(value, basestring):
+                raise TypeError('Only string keys and values are supported')
+
+        cache = self.db.cache(self.table)
+        self.db.executemany("INSERT OR REPLACE INTO %s(key, value) VALUES (?, ?);" %
+                            self.table, items)
+        cache.update(items)
 
     def __contains__(self, key):
-        return key in set(self)
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
 
     def __len__(self):
         data = self._execute("SELECT COUNT(key) FROM %s;" % self.table)
@@ -141,10 +255,11 @@ class SQLTable(collections.MutableMapping):
         return list(self.iteritems())
 
     def iteritems(self):
-        return self._execute("SELECT * FROM %s;" % self.table)
+        return iter(self._execute("SELECT key, value FROM %s;" % self.table))
 
     def clear(self):
         self._execute("DELETE FROM %s;" % self.table)
+        self.db.cache(self.table).clear()
 
     def has_key(self, key):
         return key in self
@@ -199,8 +314,11 @@ class PersistData(object):
         del self.data[domain][key]
 
 def connect(database):
-    connection = sqlite3.connect(database, timeout=5, isolation_level=None)
+    connection = sqlite3.connect(database, timeout=30, isolation_level=None,
+                                 check_same_thread=False)
     connection.execute("pragma synchronous = off;")
+    # Readers don't block the writer and the other way around
+    connection.execute("pragma journal_mode = WAL;")
     return connection
 
 def persist(domain, d):
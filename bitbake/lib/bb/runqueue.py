@@ -31,10 +31,14 @@ import fcntl
 import errno
 import logging
 import re
+import time
+import heapq
 import bb
+import bb.persist_data
 from bb import msg, data, event
 from bb import monitordisk
 import subprocess
+from collections import defaultdict
 
 try:
     import cPickle as pickle
@@ -106,6 +110,9 @@ class RunQueueScheduler(object):
         self.prio_map = []
         self.prio_map.extend(range(self.numTasks))
 
+        # Task ids until the priorities are known, then a heap of
+        # (priority, taskid) pairs. Tasks which have started running are
+        # only dropped from the heap when they reach the top.
         self.buildable = []
         self.stamps = {}
         for taskid in xrange(self.numTasks):
@@ -117,37 +124,49 @@ class RunQueueScheduler(object):
 
         self.rev_prio_map = None
 
-    def next_buildable_task(self):
+    def init_priorities(self):
         """
-        Return the id of the first task we find that is buildable
+        Build the reverse priority map and the buildable heap once
+        subclasses have set up prio_map
         """
-        self.buildable = [x for x in self.buildable if not self.rq.runq_running[x] == 1]
-        if not self.buildable:
-            return None
-        if len(self.buildable) == 1:
-            taskid = self.buildable[0]
-            stamp = self.stamps[taskid]
-            if stamp not in self.rq.build_stamps.itervalues():
-                return taskid
+        self.rev_prio_map = range(self.numTasks)
+        for taskid in xrange(self.numTasks):
+            self.rev_prio_map[self.prio_map[taskid]] = taskid
+        self.buildable = [(self.rev_prio_map[taskid], taskid) for taskid in self.buildable]
+        heapq.heapify(self.buildable)
 
+    def next_buildable_task(self):
+        """
+        Return the id of the highest priority buildable task which doesn't
+        share its stamp with a running task
+        """
         if not self.rev_prio_map:
-            self.rev_prio_map = range(self.numTasks)
-            for taskid in xrange(self.numTasks):
-                self.rev_prio_map[self.prio_map[taskid]] = taskid
+            self.init_priorities()
 
         best = None
-        bestprio = None
-        for taskid in self.buildable:
-            prio = self.rev_prio_map[taskid]
-            if bestprio is None or bestprio > prio:
-                stamp = self.stamps[taskid]
-                if stamp in self.rq.build_stamps.itervalues():
-                    continue
-                bestprio = prio
-                best = taskid
+        blocked = []
+        while self.buildable:
+            taskid = self.buildable[0][1]
+            if self.rq.runq_running[taskid] == 1:
+                heapq.heappop(self.buildable)
+                continue
+            if self.stamps[taskid] in self.rq.build_stamps2 or not self.fits(taskid):
+                blocked.append(heapq.heappop(self.buildable))
+                continue
+            best = taskid
+            break
+
+        for entry in blocked:
+            heapq.heappush(self.buildable, entry)
 
         return best
 
+    def fits(self, taskid):
+        """
+        Whether the resources task needs are currently available
+        """
+        return not self.rq.resources or self.rq.resources.fits(taskid)
+
     def next(self):
         """
         Return the id of the task we should build next
@@ -156,7 +175,22 @@ class RunQueueScheduler(object):
             return self.next_buildable_task()
 
     def newbuilable(self, task):
-        self.buildable.append(task)
+        if self.rev_prio_map:
+            heapq.heappush(self.buildable, (self.rev_prio_map[task], task))
+        else:
+            self.buildable.append(task)
+
+    def task_started(self, task):
+        """
+        Called when task has been handed to a worker
+        """
+        pass
+
+    def task_completed(self, task):
+        """
+        Called when task has completed successfully
+        """
+        pass
 
 class RunQueueSchedulerSpeed(RunQueueScheduler):
     """
@@ -171,15 +205,9 @@ class RunQueueSchedulerSpeed(RunQueueScheduler):
         """
         RunQueueScheduler.__init__(self, runqueue, rqdata)
 
-        sortweight = sorted(copy.deepcopy(self.rqdata.runq_weight))
-        copyweight = copy.deepcopy(self.rqdata.runq_weight)
-        self.prio_map = []
-
-        for weight in sortweight:
-            idx = copyweight.index(weight)
-            self.prio_map.append(idx)
-            copyweight[idx] = -1
-
+        # Equal weights keep task order before reversing, as the sort is stable
+        weight = self.rqdata.runq_weight
+        self.prio_map = sorted(xrange(self.numTasks), key=lambda taskid: weight[taskid])
         self.prio_map.reverse()
 
 class RunQueueSchedulerCompletion(RunQueueSchedulerSpeed):
@@ -198,21 +226,275 @@ class RunQueueSchedulerCompletion(RunQueueSchedulerSpeed):
         #FIXME - whilst this groups all fnids together it does not reorder the
         #fnid groups optimally.
 
-        basemap = copy.deepcopy(self.prio_map)
-        self.prio_map = []
-        while (len(basemap) > 0):
-            entry = basemap.pop(0)
-            self.prio_map.append(entry)
+        # Each fnid's tasks follow its highest priority task, keeping their
+        # relative order
+        groups = {}
+        fnids = []
+        for entry in self.prio_map:
             fnid = self.rqdata.runq_fnid[entry]
-            todel = []
-            for entry in basemap:
-                entry_fnid = self.rqdata.runq_fnid[entry]
-                if entry_fnid == fnid:
-                    todel.append(basemap.index(entry))
-                    self.prio_map.append(entry)
-            todel.reverse()
-            for idx in todel:
-                del basemap[idx]
+            if fnid not in groups:
+                groups[fnid] = []
+                fnids.append(fnid)
+            groups[fnid].append(entry)
+        self.prio_map = []
+        for fnid in fnids:
+            self.prio_map.extend(groups[fnid])
+
+class RunQueueSchedulerCriticalPath(RunQueueSchedulerSpeed):
+    """
+    A scheduler optimised for wall clock time on machines with many cores.
+    The priority map is sorted by the length of the longest chain of tasks
+    remaining after each task, measured using the durations recorded for each
+    PN and task name in previous builds. Long poles such as toolchain and
+    kernel builds are therefore started as early as possible. Tasks with no
+    recorded duration are assumed to take BB_SCHEDULER_DEFAULT_DURATION
+    seconds and ties are broken by task weight.
+    """
+    name = "criticalpath"
+
+    def __init__(self, runqueue, rqdata):
+        RunQueueSchedulerSpeed.__init__(self, runqueue, rqdata)
+
+        cfgData = self.rq.cfgData
+        default = float(cfgData.getVar("BB_SCHEDULER_DEFAULT_DURATION", True) or 10)
+        self.durations = bb.persist_data.persist('BB_TASK_DURATIONS', cfgData)
+        self.starttimes = {}
+
+        known = dict(self.durations.iteritems())
+        duration = []
+        for taskid in xrange(self.numTasks):
+            if taskid in self.rq.rq.scenequeue_covered:
+                # Will be skipped
+                duration.append(0)
+            else:
+                duration.append(float(known.get(self.durationkey(taskid), default)))
+
+        # Walk the graph from the end points backwards, a task's remaining
+        # path is known once all the tasks depending on it have been visited
+        pathlength = [0] * self.numTasks
+        revdeps_left = [len(self.rqdata.runq_revdeps[taskid]) for taskid in xrange(self.numTasks)]
+        endpoints = [taskid for taskid in xrange(self.numTasks) if revdeps_left[taskid] == 0]
+        while endpoints:
+            taskid = endpoints.pop()
+            pathlength[taskid] = duration[taskid] + max([pathlength[revdep] for revdep in self.rqdata.runq_revdeps[taskid]] or [0])
+            for dep in self.rqdata.runq_depends[taskid]:
+                revdeps_left[dep] -= 1
+                if revdeps_left[dep] == 0:
+                    endpoints.append(dep)
+
+        self.prio_map = sorted(xrange(self.numTasks),
+                               key=lambda taskid: (pathlength[taskid], self.rqdata.runq_weight[taskid]),
+                               reverse=True)
+
+    def durationkey(self, taskid):
+        fn = self.rqdata.taskData.fn_index[self.rqdata.runq_fnid[taskid]]
+        return "%s:%s" % (self.rqdata.dataCache.pkg_fn[fn], self.rqdata.runq_task[taskid])
+
+    def task_started(self, task):
+        self.starttimes[task] = time.time()
+
+    def task_completed(self, task):
+        if task not in self.starttimes:
+            return
+        duration = time.time() - self.starttimes.pop(task)
+        key = self.durationkey(task)
+        # Smooth out variations between builds
+        if key in self.durations:
+            duration = (float(self.durations[key]) + duration) / 2
+        self.durations[key] = str(duration)
+
+class RunQueueResources(object):
+    """
+    Admission control for tasks based on the resources they declare.
+
+    Tasks declare what they use with the 'resources' varflag, e.g.
+    do_compile[resources] = "cpu=8 memory=4 io=1" (memory in GiB, the other
+    resources in arbitrary units); tasks without the flag use "cpu=1". A task
+    is only started if the resources claimed by the running tasks plus its
+    own fit within BB_RESOURCE_LIMITS (cpu defaults to BB_NUMBER_THREADS,
+    other resources are unlimited unless set). Tasks needing memory are also
+    held back while MemAvailable is lower than their declaration, and tasks
+    needing memory or io while the corresponding pressure stall average
+    (avg10 in /proc/pressure) exceeds BB_PRESSURE_MAX_MEMORY or
+    BB_PRESSURE_MAX_IO. One task is always allowed to run so the build can
+    make progress.
+    """
+
+    # Seconds for which /proc readings are reused
+    poll_interval = 1
+
+    def __init__(self, rqexec):
+        self.rqdata = rqexec.rqdata
+        cfgData = rqexec.cfgData
+        self.limits = self.parse(cfgData.getVar("BB_RESOURCE_LIMITS", True) or "")
+        self.limits.setdefault('cpu', rqexec.number_tasks)
+        self.max_pressure = {}
+        for resource in ['memory', 'io']:
+            value = cfgData.getVar("BB_PRESSURE_MAX_%s" % resource.upper(), True)
+            if value:
+                self.max_pressure[resource] = float(value)
+        self.inuse = defaultdict(float)
+        self.claims = {}
+        self.lastpoll = 0
+        self.memavailable = None
+        self.pressure = {}
+
+    @staticmethod
+    def enabled(cfgData):
+        for var in ["BB_RESOURCE_LIMITS", "BB_PRESSURE_MAX_MEMORY", "BB_PRESSURE_MAX_IO"]:
+            if cfgData.getVar(var, True):
+                return True
+        return False
+
+    @staticmethod
+    def parse(value):
+        resources = {}
+        for entry in value.split():
+            try:
+                name, amount = entry.split("=", 1)
+                resources[name] = float(amount)
+            except ValueError:
+                bb.fatal("Invalid resource specification '%s', expected <name>=<amount>" % entry)
+        return resources
+
+    def task_resources(self, task):
+        fn = self.rqdata.taskData.fn_index[self.rqdata.runq_fnid[task]]
+        taskname = self.rqdata.runq_task[task]
+        resources = self.parse(self.rqdata.dataCache.task_deps[fn].get('resources', {}).get(taskname, ""))
+        resources.setdefault('cpu', 1)
+        return resources
+
+    def poll(self):
+        now = time.time()
+        if now - self.lastpoll < self.poll_interval:
+            return
+        self.lastpoll = now
+        self.memavailable = self.read_memavailable()
+        for resource in self.max_pressure:
+            pressure = self.read_pressure(resource)
+            if pressure is None:
+                self.pressure.pop(resource, None)
+            else:
+                self.pressure[resource] = pressure
+
+    def read_memavailable(self):
+        """
+        Return MemAvailable in GiB, or None if unknown
+        """
+        try:
+            with open("/proc/meminfo") as f:
+                for line in f:
+                    if line.startswith("MemAvailable:"):
+                        return float(line.split()[1]) / (1024 * 1024)
+        except IOError:
+            pass
+        return None
+
+    def read_pressure(self, resource):
+        """
+        Return the avg10 'some' pressure stall percentage of memory or io,
+        or None if the kernel doesn't provide it
+        """
+        try:
+            with open("/proc/pressure/%s" % resource) as f:
+                some = f.readline().split()
+            return float(some[1].split("=")[1])
+        except (IOError, IndexError, ValueError):
+            return None
+
+    def fits(self, task):
+        if not self.claims:
+            return True
+        needed = self.task_resources(task)
+        for resource, amount in needed.iteritems():
+            if resource in self.limits and self.inuse[resource] + amount > self.limits[resource]:
+                return False
+        self.poll()
+        if needed.get('memory') and self.memavailable is not None and needed['memory'] > self.memavailable:
+            return False
+        for resource, limit in self.max_pressure.iteritems():
+            if needed.get(resource) and self.pressure.get(resource, 0) > limit:
+                return False
+        return True
+
+    def claim(self, task):
+        needed = self.task_resources(task)
+        for resource, amount in needed.iteritems():
+            self.inuse[resource] += amount
+        self.claims[task] = needed
+
+    def release(self, task):
+        for resource, amount in self.claims.pop(task, {}).iteritems():
+            self.inuse[resource] -= amount
+
+class StampIndex(object):
+    """
+    Caches the existence and mtimes of stamp files.
+
+    Each stamp directory is listed once, so the many checks for stamps which
+    don't exist need no further syscalls, and the mtime of a stamp which
+    does exist is only read once. A directory's entries are dropped whenever
+    a stamp in it may have been written or removed.
+    """
+
+    def __init__(self):
+        # stampdir -> set of names in it
+        self.entries = {}
+        # stampdir -> {name: mtime or None}
+        self.mtimes = {}
+
+    def _entries(self, stampdir):
+        entries = self.entries.get(stampdir)
+        if entries is None:
+            try:
+                entries = set(os.listdir(stampdir))
+            except OSError:
+                entries = set()
+            self.entries[stampdir] = entries
+        return entries
+
+    def mtime(self, f):
+        """
+        Return the mtime of stamp f, or None if it doesn't exist
+        """
+        stampdir, name = os.path.split(f)
+        mtimes = self.mtimes.setdefault(stampdir, {})
+        if name not in mtimes:
+            mtime = None
+            if name in self._entries(stampdir):
+                try:
+                    mtime = os.stat(f)[stat.ST_MTIME]
+                except OSError:
+                    pass
+            mtimes[name] = mtime
+        return mtimes[name]
+
+    def exists(self, f):
+        return self.mtime(f) is not None
+
+    def prefetch(self, stamps, threads):
+        """
+        Look up the given stamps using a pool of threads. On networked
+        filesystems the latency of each listdir/stat dominates, so issuing
+        them in parallel up front is much faster than doing them one by one.
+        """
+        from multiprocessing.pool import ThreadPool
+        stamps = set(f for f in stamps if f)
+        pool = ThreadPool(threads)
+        try:
+            pool.map(self._entries, set(os.path.dirname(f) for f in stamps))
+            pool.map(self.mtime, stamps)
+        finally:
+            pool.close()
+            pool.join()
+
+    def invalidate(self, f):
+        """
+        Forget what is known about the directory containing stamp f
+        """
+        stampdir = os.path.dirname(f)
+        self.entries.pop(stampdir, None)
+        self.mtimes.pop(stampdir, None)
 
 class RunQueueData:
     """
@@ -872,6 +1154,8 @@ class RunQueue:
         # For disk space monitor
         self.dm = monitordisk.diskMonitor(cfgData)
 
+        self.stampindex = StampIndex()
+
         self.rqexe = None
         self.worker = None
         self.workerpipe = None
@@ -967,14 +1251,36 @@ class RunQueue:
             fds.append(self.fakeworkerpipe.input)
         return fds
 
+    def reset_stampindex(self):
+        """
+        Start a new stamp index, prefetching the stamps of all tasks with
+        BB_STAMP_PREFETCH_THREADS threads if set
+        """
+        self.stampindex = StampIndex()
+        threads = int(self.cfgData.getVar("BB_STAMP_PREFETCH_THREADS", True) or 0)
+        if threads > 0:
+            stamps = []
+            for task in xrange(len(self.rqdata.runq_fnid)):
+                fn = self.rqdata.taskData.fn_index[self.rqdata.runq_fnid[task]]
+                taskname = self.rqdata.runq_task[task]
+                stamps.append(bb.build.stampfile(taskname, self.rqdata.dataCache, fn))
+                stamps.append(bb.build.stampfile(taskname + "_setscene", self.rqdata.dataCache, fn))
+            self.stampindex.prefetch(stamps, threads)
+
+    def invalidate_stamps(self, task):
+        """
+        Called when the stamps of task may have changed
+        """
+        fn = self.rqdata.taskData.fn_index[self.rqdata.runq_fnid[task]]
+        stamp = bb.build.stampfile(self.rqdata.runq_task[task], self.rqdata.dataCache, fn)
+        if stamp:
+            self.stampindex.invalidate(stamp)
+
     def check_stamp_task(self, task, taskname = None, recurse = False, cache = None):
         def get_timestamp(f):
-            try:
-                if not os.access(f, os.F_OK):
-                    return None
-                return os.stat(f)[stat.ST_MTIME]
-            except:
+            if not f:
                 return None
+            return self.stampindex.mtime(f)
 
         if self.stamppolicy == "perfile":
             fulldeptree = False
@@ -991,7 +1297,7 @@ class RunQueue:
         stampfile = bb.build.stampfile(taskname, self.rqdata.dataCache, fn)
 
         # If the stamp is missing, it's not current
-        if not os.access(stampfile, os.F_OK):
+        if get_timestamp(stampfile) is None:
             logger.debug(2, "Stampfile %s not available", stampfile)
             return False
         # If it's a 'nostamp' task, it's not current
@@ -1296,10 +1602,11 @@ class RunQueueExecute:
         self.runq_complete = []
 
         self.build_stamps = {}
-        self.build_stamps2 = []
+        self.build_stamps2 = set()
         self.failed_fnids = []
 
         self.stampcache = {}
+        rq.reset_stampindex()
 
         rq.workerpipe.setrunqueueexec(self)
         if rq.fakeworkerpipe:
@@ -1392,6 +1699,10 @@ class RunQueueExecuteTasks(RunQueueExecute):
 
         self.stampcache = {}
 
+        self.resources = None
+        if RunQueueResources.enabled(self.cfgData):
+            self.resources = RunQueueResources(self)
+
         initial_covered = self.rq.scenequeue_covered.copy()
 
         # Mark initial buildable tasks
@@ -1451,6 +1762,7 @@ class RunQueueExecuteTasks(RunQueueExecute):
             fn = self.rqdata.taskData.fn_index[self.rqdata.runq_fnid[task]]
             taskname = self.rqdata.runq_task[task] + '_setscene'
             bb.build.del_stamp(taskname, self.rqdata.dataCache, fn)
+            self.rq.invalidate_stamps(task)
             self.rq.scenequeue_covered.remove(task)
 
         toremove = covered_remove
@@ -1535,6 +1847,9 @@ class RunQueueExecuteTasks(RunQueueExecute):
         self.stats.taskCompleted()
         bb.event.fire(runQueueTaskCompleted(task, self.stats, self.rq), self.cfgData)
         self.task_completeoutright(task)
+        self.sched.task_completed(task)
+        if self.resources:
+            self.resources.release(task)
 
     def task_fail(self, task, exitcode):
         """
@@ -1542,6 +1857,8 @@ class RunQueueExecuteTasks(RunQueueExecute):
         Updates the state engine with the failure
         """
         self.stats.taskFailed()
+        if self.resources:
+            self.resources.release(task)
         fnid = self.rqdata.runq_fnid[task]
         self.failed_fnids.append(fnid)
         bb.event.fire(runQueueTaskFailed(task, self.stats, exitcode, self.rq), self.cfgData)
@@ -1594,6 +1911,7 @@ class RunQueueExecuteTasks(RunQueueExecute):
                 self.stats.taskActive()
                 if not self.cooker.configuration.dry_run:
                     bb.build.make_stamp(taskname, self.rqdata.dataCache, fn)
+                    self.rq.invalidate_stamps(task)
                 self.task_complete(task)
                 return True
             else:
@@ -1618,9 +1936,12 @@ class RunQueueExecuteTasks(RunQueueExecute):
                 self.rq.worker.stdin.flush()
 
             self.build_stamps[task] = bb.build.stampfile(taskname, self.rqdata.dataCache, fn)
-            self.build_stamps2.append(self.build_stamps[task]) 
+            self.build_stamps2.add(self.build_stamps[task])
             self.runq_running[task] = 1
             self.stats.taskActive()
+            self.sched.task_started(task)
+            if self.resources:
+                self.resources.claim(task)
             if self.stats.active < self.number_tasks:
                 return True
 
@@ -1847,6 +2168,7 @@ class RunQueueExecuteScenequeue(RunQueueExecute):
                     noexec.append(task)
                     self.task_skip(task)
                     bb.build.make_stamp(taskname + "_setscene", self.rqdata.dataCache, fn)
+                    self.rq.invalidate_stamps(realtask)
                     continue
 
                 if self.rq.check_stamp_task(realtask, taskname + "_setscene", cache=self.stampcache):
@@ -2202,6 +2524,7 @@ class runQueuePipe():
                     task, status = pickle.loads(self.queue[10:index])
                 except ValueError as e:
                     bb.msg.fatal("RunQueue", "failed load pickle '%s': '%s'" % (e, self.queue[10:index]))
+                self.rq.invalidate_stamps(task)
                 self.rqexec.runqueue_process_waitpid(task, status)
                 found = True
                 self.queue = self.queue[index+11:]
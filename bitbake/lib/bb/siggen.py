@@ -83,6 +83,8 @@ class SignatureGeneratorBasic(SignatureGenerator):
         self.taints = {}
         self.gendeps = {}
         self.lookupcache = {}
+        # (variable, value) -> md5 of the two, for the recipe being finalised
+        self.vardigests = {}
         self.pkgnameextract = re.compile("(?P<fn>.*)\..*")
         self.basewhitelist = set((data.getVar("BB_HASHBASE_WHITELIST", True) or "").split())
         self.taskwhitelist = None
@@ -95,6 +97,27 @@ class SignatureGeneratorBasic(SignatureGenerator):
         else:
             self.twl = None
 
+    def vardigest(self, var, value):
+        """
+        Return the md5 of a variable's name and value. These are cached as
+        most variables are dependencies of several tasks of a recipe.
+
+        The cache is keyed by the full value, so it is only kept for one
+        recipe at a time (finalise() clears it): sharing it between recipes
+        would save some more hashing but keep a copy of every distinct value
+        of every recipe parsed by the process alive.
+        """
+        if value is not None:
+            value = str(value)
+        key = (var, value)
+        digest = self.vardigests.get(key)
+        if digest is None:
+            data = var
+            if value is not None:
+                data = data + value
+            digest = self.vardigests[key] = hashlib.md5(data).hexdigest()
+        return digest
+
     def _build_data(self, fn, d):
 
         tasklist, gendeps, lookupcache = bb.data.generate_dependencies(d)
@@ -108,6 +131,7 @@ class SignatureGeneratorBasic(SignatureGenerator):
             if data is None:
                 bb.error("Task %s from %s seems to be empty?!" % (task, fn))
                 data = ''
+            digests = [self.vardigest(task, data)]
 
             gendeps[task] -= self.basewhitelist
             newdeps = gendeps[task]
@@ -125,11 +149,8 @@ class SignatureGeneratorBasic(SignatureGenerator):
 
             alldeps = sorted(seen)
             for dep in alldeps:
-                data = data + dep
-                var = lookupcache[dep]
-                if var is not None:
-                    data = data + str(var)
-            self.basehash[fn + "." + task] = hashlib.md5(data).hexdigest()
+                digests.append(self.vardigest(dep, lookupcache[dep]))
+            self.basehash[fn + "." + task] = hashlib.md5("".join(digests)).hexdigest()
             taskdeps[task] = alldeps
 
         self.taskdeps[fn] = taskdeps
@@ -148,6 +169,8 @@ class SignatureGeneratorBasic(SignatureGenerator):
         except:
             bb.warn("Error during finalise of %s" % fn)
             raise
+        finally:
+            self.vardigests.clear()
 
         #Slow but can be useful for debugging mismatched basehashes
         #for task in self.taskdeps[fn]:
@@ -239,6 +262,11 @@ class SignatureGeneratorBasic(SignatureGenerator):
                 continue
             data['gendeps'][dep] = self.gendeps[fn][dep]
             data['varvals'][dep] = self.lookupcache[fn][dep]
+        data['vardigests'] = {}
+        for var, value in data['varvals'].iteritems():
+            data['vardigests'][var] = self.vardigest(var, value)
+        # Not kept across recipes, see vardigest()
+        self.vardigests.clear()
 
         if runtime and k in self.taskhash:
             data['runtaskdeps'] = self.runtaskdeps[k]
@@ -411,7 +439,11 @@ def compare_sigfiles(a, b, recursecb = None):
             output.append("Dependency on Variable %s was removed" % (dep))
 
 
-    changed, added, removed = dict_diff(a_data['varvals'], b_data['varvals'])
+    if 'vardigests' in a_data and 'vardigests' in b_data:
+        # Comparing the digests is cheaper than comparing long values
+        changed, added, removed = dict_diff(a_data['vardigests'], b_data['vardigests'])
+    else:
+        changed, added, removed = dict_diff(a_data['varvals'], b_data['varvals'])
     if changed:
         for dep in changed:
             output.append("Variable %s value changed from '%s' to '%s'" % (dep, a_data['varvals'][dep], b_data['varvals'][dep]))
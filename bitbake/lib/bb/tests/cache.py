@@ -0,0 +1,272 @@
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# BitBake Tests for the recipe cache (cache.py)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import unittest
+import tempfile
+import shutil
+import os
+import bb
+import bb.cache
+import bb.data
+
+class DummyRecipeInfo(bb.cache.RecipeInfoCommon):
+    cachefile = "bb_dummycache.dat"
+
+    def __init__(self, value):
+        self.value = value
+        self.skipped = False
+        self.nocache = ''
+        self.pv = '1.0'
+
+    @classmethod
+    def init_cacheData(cls, cachedata):
+        pass
+
+class ShardedCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.d = bb.data.init()
+        self.d.setVar("CACHE", self.tempdir)
+        self.recipes = ["/layer/recipes-%d/foo_%d.bb" % (i, i) for i in range(20)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def newcache(self):
+        return bb.cache.Cache(self.d, "0123", [DummyRecipeInfo])
+
+    def test_roundtrip_lazy(self):
+        cache = self.newcache()
+        for i, fn in enumerate(self.recipes):
+            cache.add_info(fn, [DummyRecipeInfo(i)], None, parsed=True)
+            cache.add_info("virtual:native:" + fn, [DummyRecipeInfo(-i)], None, parsed=True)
+        cache.sync()
+
+        cache = self.newcache()
+        self.assertEqual(len(cache.depends_cache), 2 * len(self.recipes))
+        self.assertEqual(cache.depends_cache.loaded, {})
+        self.assertEqual(cache.depends_cache[self.recipes[5]][0].value, 5)
+        self.assertEqual(cache.depends_cache["virtual:native:" + self.recipes[7]][0].value, -7)
+        self.assertEqual(len(cache.depends_cache.loaded), 2)
+
+    def test_reparse_rewrites_one_shard(self):
+        cache = self.newcache()
+        for i, fn in enumerate(self.recipes):
+            cache.add_info(fn, [DummyRecipeInfo(i)], None, parsed=True)
+        cache.sync()
+
+        cache = self.newcache()
+        before = dict((s, cache.depends_cache.shardstats(s)) for s in range(bb.cache.CACHE_SHARDS))
+        changed = cache.depends_cache.shard(self.recipes[3])
+        cache.add_info(self.recipes[3], [DummyRecipeInfo(42)], None, parsed=True)
+        cache.sync()
+
+        cache = self.newcache()
+        for shard in range(bb.cache.CACHE_SHARDS):
+            if shard != changed:
+                self.assertEqual(before[shard], cache.depends_cache.shardstats(shard))
+        self.assertEqual(cache.depends_cache[self.recipes[3]][0].value, 42)
+        for i, fn in enumerate(self.recipes):
+            if i != 3:
+                self.assertEqual(cache.depends_cache[fn][0].value, i)
+
+    def test_strings_interned(self):
+        cache = self.newcache()
+        for i, fn in enumerate(self.recipes):
+            cache.add_info(fn, [DummyRecipeInfo(["glibc", "zlib", {"do_compile": "do_configure"}])], None, parsed=True)
+        cache.sync()
+
+        cache = self.newcache()
+        a = cache.depends_cache[self.recipes[0]][0].value
+        b = cache.depends_cache[self.recipes[1]][0].value
+        self.assertEqual(a, b)
+        self.assertIs(a[0], b[0])
+        self.assertIs(a[2]["do_compile"], b[2]["do_compile"])
+
+    def test_remove(self):
+        cache = self.newcache()
+        for i, fn in enumerate(self.recipes):
+            cache.add_info(fn, [DummyRecipeInfo(i)], None, parsed=True)
+        cache.sync()
+
+        cache = self.newcache()
+        cache.remove(self.recipes[0])
+        cache.sync()
+
+        cache = self.newcache()
+        self.assertNotIn(self.recipes[0], cache.depends_cache)
+        self.assertEqual(len(cache.depends_cache), len(self.recipes) - 1)
+
+    def test_invalidate(self):
+        cache = self.newcache()
+        for i, fn in enumerate(self.recipes):
+            info = DummyRecipeInfo(i)
+            info.variants = ["", "native"]
+            cache.add_info(fn, [info], None, parsed=True)
+            cache.add_info("virtual:native:" + fn, [DummyRecipeInfo(-i)], None, parsed=True)
+            cache.clean.update([fn, "virtual:native:" + fn])
+            cache.checked[fn] = []
+
+        cache.invalidate(self.recipes[:2])
+        for fn in self.recipes[:2]:
+            self.assertNotIn(fn, cache.clean)
+            self.assertNotIn("virtual:native:" + fn, cache.clean)
+            self.assertNotIn(fn, cache.checked)
+            # Only revalidation is forced, the information is kept
+            self.assertIn(fn, cache.depends_cache)
+        for fn in self.recipes[2:]:
+            self.assertIn(fn, cache.clean)
+            self.assertIn("virtual:native:" + fn, cache.clean)
+            self.assertIn(fn, cache.checked)
+
+    def test_sync_keep(self):
+        cache = self.newcache()
+        for i, fn in enumerate(self.recipes):
+            cache.add_info(fn, [DummyRecipeInfo(i)], None, parsed=True)
+        cache.sync(release=False)
+
+        # Still usable and written again after further changes
+        self.assertEqual(cache.depends_cache[self.recipes[1]][0].value, 1)
+        cache.add_info(self.recipes[1], [DummyRecipeInfo(42)], None, parsed=True)
+        cache.sync()
+        self.assertFalse(hasattr(cache, "depends_cache"))
+
+        cache = self.newcache()
+        self.assertEqual(cache.depends_cache[self.recipes[1]][0].value, 42)
+        self.assertEqual(cache.depends_cache[self.recipes[2]][0].value, 2)
+
+    def test_parsetimes(self):
+        cache = self.newcache()
+        cache.record_parsetime(self.recipes[0], 2.5)
+        cache.sync()
+
+        # Kept when the configuration hash changes
+        cache = bb.cache.Cache(self.d, "4567", [DummyRecipeInfo])
+        self.assertEqual(cache.parsetime(self.recipes[0]), 2.5)
+        self.assertIsNone(cache.parsetime(self.recipes[1]))
+
+        # Recipes which went away are dropped
+        cache.record_parsetime(self.recipes[1], 1.5)
+        cache.prune_parsetimes(self.recipes[1:])
+        cache.sync()
+        cache = self.newcache()
+        self.assertIsNone(cache.parsetime(self.recipes[0]))
+        self.assertEqual(cache.parsetime(self.recipes[1]), 1.5)
+
+class DummyAppendOnlyCache(bb.cache.AppendOnlyCache):
+    cache_file_name = "bb_dummy.log"
+    CACHE_VERSION = 1
+
+    def create_cachedata(self):
+        return [{}, {}]
+
+class AppendOnlyCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.d = bb.data.init()
+        self.d.setVar("PERSISTENT_DIR", self.tempdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def cache(self):
+        cache = DummyAppendOnlyCache()
+        cache.init_cache(self.d)
+        return cache
+
+    def test_processes(self):
+        merger = self.cache()
+        workers = [self.cache(), self.cache()]
+        workers[0].cachedata_extras[0]["a"] = "worker0"
+        workers[1].cachedata_extras[0]["a"] = "worker1"
+        workers[1].cachedata_extras[1]["b"] = "worker1"
+        for worker in workers:
+            worker.save_extras(self.d)
+        # worker1 picked up worker0's entry and only added its own
+        self.assertEqual(workers[1].cachedata, [{"a": "worker0"}, {"b": "worker1"}])
+        self.assertEqual(workers[1].entries, 2)
+
+        size = os.path.getsize(merger.cachefile)
+        merger.cachedata_extras[0]["c"] = "merger"
+        merger.save_merge(self.d)
+        self.assertEqual(merger.cachedata, [{"a": "worker0", "c": "merger"}, {"b": "worker1"}])
+        self.assertGreater(os.path.getsize(merger.cachefile), size)
+        self.assertEqual(self.cache().cachedata, merger.cachedata)
+
+    def test_damaged(self):
+        cache = self.cache()
+        cache.cachedata_extras[0]["a"] = "1"
+        cache.save_extras(self.d)
+        with open(cache.cachefile, "ab") as f:
+            f.write(bb.cache.AppendOnlyCache.MAGIC + "truncated")
+        cache.cachedata_extras[0]["b"] = "2"
+        cache.save_extras(self.d)
+        self.assertEqual(self.cache().cachedata, [{"a": "1", "b": "2"}, {}])
+
+    def test_marker_in_damaged_record(self):
+        cache = self.cache()
+        # A damaged record whose data looks like the start of a record
+        # running past the end of the log, followed by intact records
+        bogus = bb.cache.AppendOnlyCache.RECORD.pack(bb.cache.AppendOnlyCache.MAGIC, 1000000, 0)
+        damaged = bb.cache.AppendOnlyCache.RECORD.pack(bb.cache.AppendOnlyCache.MAGIC, len(bogus) + 4, 0)
+        with open(cache.cachefile, "wb") as f:
+            f.write(cache._record([(0, "a", "1")]))
+            f.write(damaged + "xxxx" + bogus)
+            f.write(cache._record([(0, "b", "2")]))
+
+        cache = self.cache()
+        self.assertEqual(cache.cachedata, [{"a": "1", "b": "2"}, {}])
+        cache.cachedata_extras[1]["c"] = "3"
+        cache.save_extras(self.d)
+        self.assertEqual(self.cache().cachedata, [{"a": "1", "b": "2"}, {"c": "3"}])
+
+    def test_obsolete_files(self):
+        for name in ("bb_dummy.dat", "bb_dummy.dat-1234", "bb_other.dat"):
+            open(os.path.join(self.tempdir, name), "w").close()
+        DummyAppendOnlyCache.obsolete_files = ("bb_dummy.dat", "bb_dummy.dat-*")
+        try:
+            cache = self.cache()
+            self.assertEqual(os.listdir(self.tempdir), ["bb_other.dat"])
+            cache.cachedata_extras[0]["a"] = "1"
+            cache.save_extras(self.d)
+
+            # Only while the log doesn't exist yet
+            open(os.path.join(self.tempdir, "bb_dummy.dat"), "w").close()
+            self.cache()
+            self.assertIn("bb_dummy.dat", os.listdir(self.tempdir))
+        finally:
+            del DummyAppendOnlyCache.obsolete_files
+
+    def test_version(self):
+        cache = self.cache()
+        cache.cachedata_extras[0].update({"a": "1", "b": "1", "c": "1"})
+        cache.save_extras(self.d)
+        DummyAppendOnlyCache.CACHE_VERSION = 2
+        try:
+            cache = self.cache()
+            self.assertEqual(cache.cachedata, [{}, {}])
+            cache.cachedata_extras[0]["b"] = "2"
+            cache.save_merge(self.d)
+            # Mostly outdated so it was rewritten
+            self.assertEqual(cache.entries, 1)
+            self.assertEqual(self.cache().cachedata, [{"b": "2"}, {}])
+        finally:
+            DummyAppendOnlyCache.CACHE_VERSION = 1
@@ -0,0 +1,92 @@
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# BitBake Tests for the local file checksum cache (checksum.py)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import unittest
+import tempfile
+import shutil
+import os
+import bb
+import bb.checksum
+import bb.data
+import bb.utils
+
+class FileChecksumCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.d = bb.data.init()
+        self.d.setVar("PERSISTENT_DIR", os.path.join(self.tempdir, "persist"))
+        self.files = os.path.join(self.tempdir, "files")
+        for i in range(10):
+            self.write("sub%d/file%d" % (i % 2, i), "contents %d" % i)
+        self.hashed = []
+        self.orig_md5_file = bb.utils.md5_file
+        def md5_file(f):
+            self.hashed.append(f)
+            return self.orig_md5_file(f)
+        bb.utils.md5_file = md5_file
+
+    def tearDown(self):
+        bb.utils.md5_file = self.orig_md5_file
+        shutil.rmtree(self.tempdir)
+
+    def write(self, name, contents):
+        fn = os.path.join(self.files, name)
+        bb.utils.mkdirhier(os.path.dirname(fn))
+        with open(fn, "w") as f:
+            f.write(contents)
+
+    def checksums(self, cache):
+        return cache.get_checksums(self.files + ":True", "test")
+
+    def test_dir(self):
+        cache = bb.checksum.FileChecksumCache()
+        cache.init_cache(self.d)
+        checksums = self.checksums(cache)
+        self.assertEqual(len(checksums), 10)
+        self.assertEqual(len(self.hashed), 10)
+        self.assertIn((os.path.join(self.files, "sub1/file3"),
+                       self.orig_md5_file(os.path.join(self.files, "sub1/file3"))),
+                      checksums)
+
+        self.hashed = []
+        self.assertEqual(self.checksums(cache), checksums)
+        self.assertEqual(self.hashed, [])
+
+        # Same size, only the inode or mtime tell the difference
+        os.unlink(os.path.join(self.files, "sub0/file4"))
+        self.write("sub0/file4", "contents X")
+        changed = self.checksums(cache)
+        self.assertEqual(self.hashed, [os.path.join(self.files, "sub0/file4")])
+        self.assertNotEqual(changed, checksums)
+
+    def test_persist(self):
+        cache = bb.checksum.FileChecksumCache()
+        cache.init_cache(self.d)
+        checksums = self.checksums(cache)
+        cache.save_extras(self.d)
+        cache.save_merge(self.d)
+
+        self.hashed = []
+        cache = bb.checksum.FileChecksumCache()
+        cache.init_cache(self.d)
+        self.assertEqual(self.checksums(cache), checksums)
+        self.assertEqual(cache.get_checksum(os.path.join(self.files, "sub0/file0")),
+                         dict(checksums)[os.path.join(self.files, "sub0/file0")])
+        self.assertEqual(self.hashed, [])
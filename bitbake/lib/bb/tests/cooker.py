@@ -0,0 +1,224 @@
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# BitBake Tests for the recipe parsing in cooker.py
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import unittest
+import tempfile
+import shutil
+import os
+import collections
+import bb
+import bb.cache
+import bb.cooker
+import bb.data
+import bb.parse
+import bb.siggen
+
+class PNRecipeInfo(bb.cache.RecipeInfoCommon):
+    cachefile = "bb_pncache.dat"
+
+    def __init__(self, filename, metadata):
+        self.pn = metadata.getVar("PN", True)
+        self.depends = metadata.getVar("__depends", False)
+        self.pid = os.getpid()
+        self.skipped = False
+        self.nocache = ''
+
+    @classmethod
+    def init_cacheData(cls, cachedata):
+        pass
+
+class ParserPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.d = bb.data.init()
+        self.d.setVar("BBPATH", self.tempdir)
+        self.d.setVar("PERSISTENT_DIR", os.path.join(self.tempdir, "persist"))
+        bb.parse.siggen = bb.siggen.init(self.d)
+        self.recipes = []
+        for i in range(10):
+            fn = os.path.join(self.tempdir, "recipe%d_1.0.bb" % i)
+            with open(fn, "w") as f:
+                f.write('PN = "recipe%d"\n' % i)
+            self.recipes.append(fn)
+        self.pool = bb.cooker.ParserPool(self.d, "0123", 2, False)
+
+    def tearDown(self):
+        self.pool.shutdown(clean=False, force=True)
+        shutil.rmtree(self.tempdir)
+
+    def parse(self, recipes):
+        generation = self.pool.submit([[(fn, [], [PNRecipeInfo])] for fn in recipes])
+        results = []
+        while len(results) < len(recipes):
+            result = self.pool.get(generation, 10)
+            self.assertIsNotNone(result)
+            filename, seconds, (parsed, infos) = result
+            self.assertNotIsInstance(infos, Exception)
+            self.assertGreaterEqual(seconds, 0)
+            results.extend(infos)
+        return results
+
+    def test_reuse(self):
+        pids = set(p.pid for p in self.pool.processes)
+        results = self.parse(self.recipes)
+        self.assertEqual(sorted(info[0].pn for fn, info in results),
+                         sorted("recipe%d" % i for i in range(10)))
+        self.assertTrue(self.pool.flush())
+        results = self.parse(self.recipes[:1])
+        self.assertEqual(results[0][1][0].pn, "recipe0")
+        self.assertIn(results[0][1][0].pid, pids)
+        self.assertEqual(pids, set(p.pid for p in self.pool.processes))
+        self.assertTrue(self.pool.usable("0123"))
+        self.assertFalse(self.pool.usable("4567"))
+
+    def test_include_changed(self):
+        inc = os.path.join(self.tempdir, "foo.inc")
+        with open(inc, "w") as f:
+            f.write('PN = "old"\n')
+        with open(self.recipes[0], "w") as f:
+            f.write('require foo.inc\n')
+        results = self.parse(self.recipes[:1] * 2)
+        self.assertEqual([info[0].pn for fn, info in results], ["old", "old"])
+        mtime = dict(results[0][1][0].depends)[inc]
+
+        with open(inc, "w") as f:
+            f.write('PN = "new"\n')
+        os.utime(inc, (mtime + 10, mtime + 10))
+        results = self.parse(self.recipes[:1] * 2)
+        self.assertEqual([info[0].pn for fn, info in results], ["new", "new"])
+        self.assertEqual([dict(info[0].depends)[inc] for fn, info in results], [mtime + 10] * 2)
+
+    def test_cancel(self):
+        self.pool.submit([[(fn, [], [PNRecipeInfo]) for fn in self.recipes]] * 10)
+        self.pool.cancel()
+        results = self.parse(self.recipes[-1:])
+        self.assertEqual([info[0].pn for fn, info in results], ["recipe9"])
+
+class ResidentCacheTest(unittest.TestCase):
+
+    class FakeCooker(bb.cooker.BBCooker):
+        # Only what notifications() and add_file_dependents() need
+        def __init__(self):
+            self.file_dependents = collections.defaultdict(set)
+            self.inotify_modified_files = []
+            self.inotify_modified_recipes = set()
+
+    class FakeEvent(object):
+        def __init__(self, pathname):
+            self.path = os.path.dirname(pathname)
+            self.pathname = pathname
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.d = bb.data.init()
+        self.d.setVar("BBPATH", self.tempdir)
+        self.d.setVar("CACHE", os.path.join(self.tempdir, "cache"))
+        bb.parse.siggen = bb.siggen.init(self.d)
+        self.inc = os.path.join(self.tempdir, "foo.inc")
+        with open(self.inc, "w") as f:
+            f.write('FOO = "1"\n')
+        self.recipes = []
+        for i in range(4):
+            fn = os.path.join(self.tempdir, "recipe%d_1.0.bb" % i)
+            with open(fn, "w") as f:
+                if i < 2:
+                    f.write('require foo.inc\n')
+                f.write('do_build() {\n:\n}\naddtask build\n')
+            self.recipes.append(fn)
+        self.cooker = self.FakeCooker()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_revalidate_dependents(self):
+        cache = bb.cache.Cache(self.d, "0123", [bb.cache.CoreRecipeInfo])
+        cachedata = bb.cache.CacheData([bb.cache.CoreRecipeInfo])
+        for fn in self.recipes:
+            for virtualfn, info_array in cache.parse(fn, [], self.d, cache.caches_array):
+                cache.add_info(virtualfn, info_array, cachedata, parsed=True)
+                self.cooker.add_file_dependents(virtualfn, info_array[0].file_depends)
+            self.assertTrue(cache.cacheValid(fn, []))
+        self.assertEqual(self.cooker.file_dependents[self.inc], set(self.recipes[:2]))
+        cache.sync(release=False)
+
+        mtime = os.stat(self.inc).st_mtime
+        os.utime(self.inc, (mtime + 10, mtime + 10))
+        self.cooker.notifications(self.FakeEvent(self.inc))
+        self.assertEqual(self.cooker.inotify_modified_recipes, set(self.recipes[:2]))
+        for p in self.cooker.inotify_modified_files:
+            bb.parse.update_cache(p)
+
+        rechecked = []
+        orig = cache.cacheValidUpdate
+        def cacheValidUpdate(fn, appends):
+            rechecked.append(fn)
+            return orig(fn, appends)
+        cache.cacheValidUpdate = cacheValidUpdate
+
+        cache.invalidate(self.cooker.inotify_modified_recipes)
+        self.assertEqual([cache.cacheValid(fn, []) for fn in self.recipes],
+                         [False, False, True, True])
+        self.assertEqual(sorted(rechecked), self.recipes[:2])
+        # The unaffected recipes are still served from the cache
+        for fn in self.recipes[2:]:
+            self.assertIn(fn, cache.depends_cache)
+
+class ParseScheduleTest(unittest.TestCase):
+
+    class DummyCache(object):
+        def __init__(self, parsetimes):
+            self.parsetimes = parsetimes
+
+        def parsetime(self, fn):
+            return self.parsetimes.get(fn)
+
+    def schedule(self, parsetimes, recipes, num_processes):
+        parser = object.__new__(bb.cooker.CookerParser)
+        parser.bb_cache = self.DummyCache(parsetimes)
+        parser.willparse = [(fn, [], []) for fn in recipes]
+        return [[job[0] for job in chunk] for chunk in parser.schedule(num_processes)]
+
+    def test_expensive_first(self):
+        recipes = ["r%d.bb" % i for i in range(40)]
+        parsetimes = dict((fn, 0.1) for fn in recipes)
+        parsetimes["r39.bb"] = 20
+        parsetimes["r38.bb"] = 10
+        chunks = self.schedule(parsetimes, recipes, 4)
+        self.assertEqual(chunks[0], ["r39.bb"])
+        self.assertEqual(chunks[1], ["r38.bb"])
+        self.assertEqual(sorted(sum(chunks, [])), sorted(recipes))
+        # Chunks of cheap recipes get smaller towards the end
+        self.assertGreater(len(chunks[2]), len(chunks[-1]))
+        self.assertEqual(len(chunks[-1]), 1)
+
+    def test_unknown(self):
+        recipes = ["r%d.bb" % i for i in range(8)]
+        chunks = self.schedule({"r3.bb": 5, "r4.bb": 1, "r5.bb": 1}, recipes, 2)
+        self.assertEqual(chunks[0], ["r3.bb"])
+        self.assertEqual(sorted(sum(chunks, [])), sorted(recipes))
+
+    def test_histogram(self):
+        event = bb.event.ParseTimes({"a.bb": 0.05, "b.bb": 0.3, "c.bb": 0.4, "d.bb": 45})
+        histogram = dict(event.histogram)
+        self.assertEqual(histogram[0.1], 1)
+        self.assertEqual(histogram[0.5], 2)
+        self.assertEqual(histogram[None], 1)
+        self.assertEqual(sum(histogram.values()), 4)
+        self.assertEqual(event.slowest[0], ("d.bb", 45))
@@ -21,6 +21,8 @@
 #
 
 import unittest
+import time
+import sys
 import bb
 import bb.data
 import bb.parse
@@ -377,6 +379,196 @@ class TestOverrides(unittest.TestCase):
         self.d.setVar("OVERRIDES", "foo:bar:some_val")
         self.assertEqual(self.d.getVar("TEST", True), "testvalue3")
 
+class TestExpandCache(unittest.TestCase):
+    def setUp(self):
+        self.d = bb.data.init()
+        self.d.setVar("OVERRIDES", "foo")
+        self.d.setVar("A", "${B}")
+        self.d.setVar("B", "${C}")
+        self.d.setVar("C", "c")
+        self.d.setVar("OTHER", "${UNRELATED}")
+
+    def test_unrelated_write(self):
+        self.assertEqual(self.d.getVar("A", True), "c")
+        self.d.setVar("UNRELATED", "x")
+        self.assertIn("A", self.d.expand_cache)
+        self.assertEqual(self.d.getVar("A", True), "c")
+
+    def test_indirect_write(self):
+        self.assertEqual(self.d.getVar("A", True), "c")
+        self.d.setVar("C", "c2")
+        self.assertNotIn("A", self.d.expand_cache)
+        self.assertEqual(self.d.getVar("A", True), "c2")
+        self.d.appendVar("C", "3")
+        self.assertEqual(self.d.getVar("A", True), "c23")
+        self.d.delVar("C")
+        self.assertEqual(self.d.getVar("A", True), "${C}")
+
+    def test_override_write(self):
+        self.assertEqual(self.d.getVar("A", True), "c")
+        self.d.setVar("C_foo", "cfoo")
+        self.assertEqual(self.d.getVar("A", True), "cfoo")
+        self.d.setVar("C_append_foo", "+")
+        self.assertEqual(self.d.getVar("A", True), "cfoo+")
+
+    def test_overrides_change(self):
+        self.d.setVar("C_bar", "cbar")
+        self.assertEqual(self.d.getVar("A", True), "c")
+        self.d.setVar("OVERRIDES", "bar")
+        self.assertEqual(self.d.getVar("A", True), "cbar")
+
+    def test_flag(self):
+        self.d.setVarFlag("A", "doc", "${C}")
+        self.assertEqual(self.d.getVarFlag("A", "doc", True), "c")
+        self.d.setVarFlag("A", "doc", "${B}!")
+        self.assertEqual(self.d.getVarFlag("A", "doc", True), "c!")
+
+    def test_python(self):
+        self.d.setVar("P", "${@d.getVar('C', True) + '!'}")
+        self.d.setVar("NAME", "C")
+        self.d.setVar("Q", "${@d.getVar('NA' + 'ME', True)}")
+        self.assertEqual(self.d.getVar("P", True), "c!")
+        self.assertEqual(self.d.getVar("Q", True), "C")
+        self.assertNotIn("P", self.d.expand_volatile)
+        self.assertIn("Q", self.d.expand_volatile)
+        self.d.setVar("C", "d")
+        self.d.setVar("NAME", "D")
+        self.assertEqual(self.d.getVar("P", True), "d!")
+        self.assertEqual(self.d.getVar("Q", True), "D")
+
+    def test_shared(self):
+        self.d.setVar("C_bar", "cbar")
+        self.assertEqual(self.d.getVar("A", True), "c")
+        self.assertEqual(self.d.getVar("OTHER", True), "${UNRELATED}")
+        self.d.share_expand_cache()
+
+        copy = self.d.createCopy()
+        self.assertEqual(copy.getVar("OTHER", True), "${UNRELATED}")
+        self.assertNotIn("OTHER", copy.expand_cache)
+        copy.setVar("C", "copied")
+        self.assertEqual(copy.getVar("A", True), "copied")
+        self.assertEqual(copy.getVar("OTHER", True), "${UNRELATED}")
+        self.assertEqual(self.d.getVar("A", True), "c")
+
+        # The shared expansion of A depends on the overrides
+        copy = self.d.createCopy()
+        copy.setVar("OVERRIDES", "bar")
+        self.assertEqual(copy.getVar("A", True), "cbar")
+        self.assertEqual(self.d.getVar("A", True), "c")
+
+    def test_remove(self):
+        # A fresh datastore, whose overrides are first worked out for FOO
+        self.d = bb.data.init()
+        self.d.setVar("FOO", "a b c")
+        self.d.setVar("FOO_remove", "${BAR}")
+        self.d.setVar("BAR", "a")
+        self.d.setVar("Z", "${FOO}")
+        self.assertEqual(self.d.getVar("Z", True), "b c")
+        self.d.setVar("BAR", "c")
+        self.assertEqual(self.d.getVar("Z", True), "a b")
+
+        self.d.share_expand_cache()
+        copy = self.d.createCopy()
+        copy.setVar("BAR", "b")
+        self.assertEqual(copy.getVar("Z", True), "a c")
+        self.assertEqual(self.d.getVar("Z", True), "a b")
+
+    def test_expanded_other_string(self):
+        self.assertEqual(self.d.getVar("A", True), "c")
+        # Caches an expansion under B which isn't B's value
+        self.assertEqual(self.d.expand("${C}${C}", "B"), "cc")
+        self.assertEqual(self.d.expand("${B}"), "c")
+        self.assertEqual(self.d.expand("x${B}"), "xc")
+
+    def test_overrides_memo(self):
+        self.d.setVar("B_foo", "${C}foo")
+        self.assertEqual(self.d.getVar("A", True), "cfoo")
+        copy = self.d.createCopy()
+        self.assertEqual(copy.getVar("A", True), "cfoo")
+        self.assertEqual(len(self.d.overrides_memo), 1)
+        copy.setVar("OVERRIDES", "bar")
+        self.assertEqual(copy.getVar("A", True), "c")
+        self.assertEqual(len(self.d.overrides_memo), 2)
+
+class TestOverlay(unittest.TestCase):
+    def setUp(self):
+        self.d = bb.data.init()
+        self.d.setVar("OVERRIDES", "foo:bar")
+        self.d.setVar("A", "${B}")
+        self.d.setVar("B", "b")
+        self.d.setVar("B_foo", "bfoo")
+
+    def test_read(self):
+        overlay = self.d.createOverlay()
+        self.assertEqual(overlay.getVar("A", True), "bfoo")
+        self.assertItemsEqual(overlay.keys(), self.d.keys())
+
+    def test_write(self):
+        overlay = bb.data.createOverlay(self.d)
+        overlay.setVar("B", "b2")
+        overlay.setVar("B_bar", "bbar")
+        overlay.setVar("C_foo", "c")
+        self.assertEqual(overlay.getVar("A", True), "bbar")
+        self.assertEqual(overlay.getVar("C", True), "c")
+        self.assertEqual(self.d.getVar("A", True), "bfoo")
+        self.assertEqual(self.d.getVar("C", True), None)
+        self.assertNotIn("C", self.d.overridedata)
+
+    def test_parent_write(self):
+        overlay = self.d.createOverlay()
+        copy = self.d.createCopy()
+        self.d.setVar("D_foo", "d")
+        self.d.delVar("B_foo")
+        self.assertIn("B", overlay.overridedata)
+        for data in (overlay, copy):
+            self.assertEqual(data.getVar("D", True), copy.getVar("D", True))
+            self.assertEqual(data.getVar("A", True), copy.getVar("A", True))
+
+    def test_history(self):
+        self.d.enableTracking()
+        overlay = self.d.createOverlay()
+        overlay.setVar("B", "b2")
+        self.assertEqual(len(overlay.varhistory.variable("B")), 1)
+        self.assertEqual(len(self.d.varhistory.variable("B")), 0)
+
+    def test_many_overrides(self):
+        # Recipes carry thousands of override variables, which overlays
+        # must see without copying them
+        for i in range(1000):
+            self.d.setVar("VAR%d_foo" % i, "foo")
+        self.d.getVar("A", True)
+
+        for create in (self.d.createCopy, self.d.createOverlay):
+            data = create()
+            data.setVar("DL_DIR", "${B}/downloads")
+            data.setVar("VAR1_bar", "bar")
+            self.assertEqual(data.getVar("DL_DIR", True), "bfoo/downloads")
+            self.assertEqual(data.getVar("VAR0", True), "foo")
+            self.assertEqual(data.getVar("VAR1", True), "bar")
+        self.assertEqual(self.d.getVar("DL_DIR", True), None)
+        self.assertEqual(self.d.getVar("VAR1", True), "foo")
+
+    def test_benchmark(self):
+        """
+        Create 10000 copies and 10000 overlays of a datastore with many
+        override variables and report the time taken
+        """
+        for i in range(1000):
+            self.d.setVar("VAR%d_foo" % i, "foo")
+        self.d.getVar("A", True)
+
+        def time_copies(create):
+            start = time.time()
+            for i in range(10000):
+                data = create()
+                data.setVar("DL_DIR", "${B}/downloads")
+                data.getVar("DL_DIR", True)
+            return time.time() - start
+
+        copytime = time_copies(self.d.createCopy)
+        overlaytime = time_copies(self.d.createOverlay)
+        sys.stderr.write("\n10000 copies took %.2fs, 10000 overlays %.2fs " % (copytime, overlaytime))
+
 class TestKeyExpansion(unittest.TestCase):
     def setUp(self):
         self.d = bb.data.init()
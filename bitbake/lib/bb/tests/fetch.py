@@ -477,6 +477,191 @@ class FetcherLocalTest(FetcherTest):
         tree = self.fetchUnpack(['file://dir/subdir/e;subdir=bar'])
         self.assertEqual(tree, ['bar/dir/subdir/e'])
 
+    def test_local_parallel(self):
+        self.d.setVar("BB_FETCH_THREADS", "4")
+        self.d.setVar("BB_FETCH_THREADS_PER_HOST", "2")
+        tree = self.fetchUnpack(['file://a', 'file://b', 'file://dir/c', 'file://dir/subdir/e'])
+        self.assertEqual(tree, ['a', 'b', 'dir/c', 'dir/subdir/e'])
+
+    def test_local_parallel_failure(self):
+        self.d.setVar("BB_FETCH_THREADS", "4")
+        fetcher = bb.fetch.Fetch(['file://a', 'file://missing', 'file://b'], self.d)
+        with self.assertRaises(bb.fetch2.FetchError):
+            fetcher.download()
+
+    def test_local_parallel_serial_mirror(self):
+        # Mirrors whose method can't download in parallel are tried one at
+        # a time, from DL_DIR
+        supports_parallel_download = bb.fetch2.local.Local.supports_parallel_download
+        download = bb.fetch2.local.Local.download
+        mirrored = []
+        def serial_mirror(method, ud):
+            return not ud.url.startswith("file://" + self.localsrcdir)
+        def checking_download(method, ud, d):
+            if not serial_mirror(method, ud):
+                mirrored.append((bb.fetch2.serial_download_lock._is_owned(), os.getcwd()))
+            return download(method, ud, d)
+        self.d.setVar("BB_FETCH_THREADS", "4")
+        self.d.setVar("FILESPATH", self.dldir)
+        self.d.setVar("PREMIRRORS", "file://.* file://%s/PATH" % self.localsrcdir)
+        bb.fetch2.local.Local.supports_parallel_download = serial_mirror
+        bb.fetch2.local.Local.download = checking_download
+        try:
+            fetcher = bb.fetch.Fetch(['file://a', 'file://b', 'file://dir/c'], self.d)
+            fetcher.download()
+        finally:
+            bb.fetch2.local.Local.supports_parallel_download = supports_parallel_download
+            bb.fetch2.local.Local.download = download
+        self.assertEqual(mirrored, [(True, self.dldir)] * 3)
+
+    def test_local_checkstatus_many(self):
+        uris = ['file://a', 'file://missing', 'file://dir/c', 'file://dir/missing']
+        fetcher = bb.fetch.Fetch(uris, self.d, cache=False)
+        self.assertEqual(fetcher.checkstatus_many(threads=2), ['file://a', 'file://dir/c'])
+
+    def test_local_checkstatus_many_writes(self):
+        # Checks may write to the datastore, each thread gets its own
+        method = bb.fetch2.local.Local.checkstatus
+        datastores = []
+        def checkstatus(self, fetch, ud, d):
+            d.setVar("__BB_DONT_CACHE", "1")
+            datastores.append(d)
+            return method(self, fetch, ud, d)
+        bb.fetch2.local.Local.checkstatus = checkstatus
+        try:
+            fetcher = bb.fetch.Fetch(['file://a', 'file://dir/c'], self.d, cache=False)
+            self.assertEqual(fetcher.checkstatus_many(threads=2), ['file://a', 'file://dir/c'])
+        finally:
+            bb.fetch2.local.Local.checkstatus = method
+        self.assertEqual(len(datastores), 2)
+        self.assertNotIn(fetcher.d, datastores)
+        self.assertIsNone(fetcher.d.getVar("__BB_DONT_CACHE", False))
+
+    def test_local_checkstatus_many_premirror(self):
+        self.d.setVar("FILESPATH", self.dldir)
+        self.d.setVar("PREMIRRORS", "file://.* file://%s/PATH" % self.localsrcdir)
+        uris = ['file://a', 'file://missing', 'file://dir/subdir/e']
+        fetcher = bb.fetch.Fetch(uris, self.d, cache=False)
+        self.assertEqual(fetcher.checkstatus_many(), ['file://a', 'file://dir/subdir/e'])
+
+class FetcherLocalGitTest(FetcherTest):
+    def setUp(self):
+        super(FetcherLocalGitTest, self).setUp()
+        self.srcdir = os.path.join(self.tempdir, "gitsrc")
+        os.makedirs(self.srcdir)
+        self.git("init -q", self.srcdir)
+        self.git("symbolic-ref HEAD refs/heads/master", self.srcdir)
+        self.commit(self.srcdir, "a")
+
+    def git(self, cmd, cwd):
+        return bb.process.run("git -c user.name=test -c user.email=test@example.com %s" % cmd, cwd=cwd)[0]
+
+    def commit(self, repo, name):
+        with open(os.path.join(repo, name), "w") as f:
+            f.write(name)
+        self.git("add %s" % name, repo)
+        self.git("commit -q -m %s" % name, repo)
+        self.d.setVar("SRCREV", self.git("rev-parse HEAD", repo).strip())
+
+    def test_reference(self):
+        bb.fetch.Fetch(["git://%s;protocol=file" % self.srcdir], self.d).download()
+
+        related = os.path.join(self.tempdir, "related")
+        self.git("clone -q %s %s" % (self.srcdir, related), self.tempdir)
+        self.commit(related, "b")
+        url = "git://%s;protocol=file;reference=git://%s" % (related, self.srcdir)
+        fetcher = bb.fetch.Fetch([url], self.d)
+        fetcher.download()
+        ud = fetcher.ud[url]
+        self.assertTrue(os.path.exists(os.path.join(ud.clonedir, "objects", "info", "alternates")))
+
+        # The mirror is recloned once the referenced repository is gone
+        bb.utils.prunedir(ud.referencedir)
+        self.assertTrue(ud.method.need_update(ud, self.d))
+        fetcher.download()
+        self.assertFalse(os.path.exists(os.path.join(ud.clonedir, "objects", "info", "alternates")))
+
+    def test_latest_revision_exact(self):
+        tagged = self.d.getVar("SRCREV", True)
+        self.git("tag -a -m v1 v1", self.srcdir)
+        self.git("checkout -q -b v1-maint", self.srcdir)
+        self.commit(self.srcdir, "b")
+        # The v1-maint branch must not be mistaken for a v1 branch
+        self.d.setVar("SRCREV", "v1")
+        url = "git://%s;protocol=file" % self.srcdir
+        fetcher = bb.fetch.Fetch([url], self.d, cache=False)
+        self.assertEqual(fetcher.ud[url].revisions["default"], tagged)
+
+    def test_lsremote_shared(self):
+        lsremote = []
+        runfetchcmd = bb.fetch2.git.runfetchcmd
+        def counting_runfetchcmd(cmd, d, *args, **kwargs):
+            if "ls-remote" in cmd:
+                lsremote.append(cmd)
+            return runfetchcmd(cmd, d, *args, **kwargs)
+
+        head = self.d.getVar("SRCREV", True)
+        self.d.setVar("SRCREV", "master")
+        url = "git://%s;protocol=file" % self.srcdir
+        bb.fetch2.git.runfetchcmd = counting_runfetchcmd
+        try:
+            for pn in ["recipe1", "recipe2"]:
+                self.d.setVar("PN", pn)
+                fetcher = bb.fetch.Fetch([url], self.d, cache=False)
+                self.assertEqual(fetcher.ud[url].revisions["default"], head)
+            self.assertEqual(len(lsremote), 1)
+
+            # A new build drops the results unless BB_GIT_LSREMOTE_TTL keeps them
+            self.d.setVar("BB_GIT_LSREMOTE_TTL", "3600")
+            bb.fetch2.git.Git().init(self.d)
+            bb.persist_data.persist('BB_URI_HEADREVS', self.d).clear()
+            bb.fetch.Fetch([url], self.d, cache=False)
+            self.assertEqual(len(lsremote), 1)
+
+            self.d.delVar("BB_GIT_LSREMOTE_TTL")
+            bb.fetch2.git.Git().init(self.d)
+            bb.persist_data.persist('BB_URI_HEADREVS', self.d).clear()
+            bb.fetch.Fetch([url], self.d, cache=False)
+            self.assertEqual(len(lsremote), 2)
+        finally:
+            bb.fetch2.git.runfetchcmd = runfetchcmd
+
+    def test_worktree(self):
+        url = "git://%s;protocol=file;worktree=1" % self.srcdir
+        fetcher = bb.fetch.Fetch([url], self.d)
+        fetcher.download()
+        fetcher.unpack(self.unpackdir)
+        gitdir = os.path.join(self.unpackdir, "git")
+        self.assertTrue(os.path.isfile(os.path.join(gitdir, ".git")))
+        self.assertTrue(os.path.exists(os.path.join(gitdir, "a")))
+
+        # Unpacking again replaces the stale worktree
+        fetcher.unpack(self.unpackdir)
+        self.assertTrue(os.path.exists(os.path.join(gitdir, "a")))
+
+    def test_worktree_locked(self):
+        # The worktree commands write to the mirror, they must hold its lock
+        runfetchcmd = bb.fetch2.git.runfetchcmd
+        unlocked = []
+        def checking_runfetchcmd(cmd, d, *args, **kwargs):
+            if " worktree " in cmd:
+                lf = bb.utils.lockfile(fetcher.ud[url].lockfile, retry=False)
+                if lf:
+                    unlocked.append(cmd)
+                    bb.utils.unlockfile(lf)
+            return runfetchcmd(cmd, d, *args, **kwargs)
+
+        url = "git://%s;protocol=file;worktree=1" % self.srcdir
+        fetcher = bb.fetch.Fetch([url], self.d)
+        fetcher.download()
+        bb.fetch2.git.runfetchcmd = checking_runfetchcmd
+        try:
+            fetcher.unpack(self.unpackdir)
+        finally:
+            bb.fetch2.git.runfetchcmd = runfetchcmd
+        self.assertTrue(os.path.exists(os.path.join(self.unpackdir, "git", "a")))
+        self.assertEqual(unlocked, [])
+
 class FetcherNetworkTest(FetcherTest):
 
     if os.environ.get("BB_SKIP_NETTESTS") == "yes":
@@ -769,3 +954,89 @@ class FetchCheckStatusTest(FetcherTest):
                 self.assertTrue(ret, msg="URI %s, can't check status" % (u))
 
             connection_cache.close_connections()
+
+        def test_wget_checkstatus_many(self):
+            fetch = bb.fetch2.Fetch(self.test_wget_uris, self.d)
+            self.assertEqual(fetch.checkstatus_many(), self.test_wget_uris)
+
+class FetchNativeHTTPTest(FetcherTest):
+    payload = "".join(chr(i % 251) for i in range(300000))
+
+    def setUp(self):
+        import BaseHTTPServer, threading, hashlib
+
+        super(FetchNativeHTTPTest, self).setUp()
+        test = self
+        self.ranges = []
+        self.support_range = True
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                start = 0
+                rangehdr = self.headers.getheader("Range")
+                test.ranges.append(rangehdr)
+                if rangehdr and test.support_range:
+                    start = int(rangehdr.split("=")[1].rstrip("-"))
+                    self.send_response(206)
+                    self.send_header("Content-Range", "bytes %d-%d/%d" % (start, len(test.payload) - 1, len(test.payload)))
+                else:
+                    self.send_response(200)
+                self.send_header("Content-Length", str(len(test.payload) - start))
+                self.end_headers()
+                self.wfile.write(test.payload[start:])
+
+            def log_message(self, *args):
+                pass
+
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.d.setVar("BB_FETCH_NATIVE_HTTP", "1")
+        self.url = "http://127.0.0.1:%d/payload.bin;md5sum=%s;sha256sum=%s" % \
+            (self.server.server_address[1], hashlib.md5(self.payload).hexdigest(),
+             hashlib.sha256(self.payload).hexdigest())
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        super(FetchNativeHTTPTest, self).tearDown()
+
+    def fetch(self, partial=None):
+        fetcher = bb.fetch2.Fetch([self.url], self.d, cache=False)
+        localpath = fetcher.localpath(self.url)
+        if partial:
+            with open(localpath + ".tmp", "wb") as f:
+                f.write(partial)
+        fetcher.download()
+        with open(localpath, "rb") as f:
+            self.assertEqual(f.read(), self.payload)
+        self.assertFalse(os.path.exists(localpath + ".tmp"))
+
+    def test_download(self):
+        # The checksums come from the download, the file isn't read again
+        def unexpected(fn):
+            raise AssertionError("%s was re-read for its checksum" % fn)
+        md5_file, sha256_file = bb.utils.md5_file, bb.utils.sha256_file
+        bb.utils.md5_file = bb.utils.sha256_file = unexpected
+        try:
+            self.fetch()
+        finally:
+            bb.utils.md5_file, bb.utils.sha256_file = md5_file, sha256_file
+        self.assertEqual(self.ranges, [None])
+
+    def test_resume(self):
+        self.fetch(self.payload[:100000])
+        self.assertEqual(self.ranges, ["bytes=100000-"])
+
+    def test_resume_unsupported(self):
+        self.support_range = False
+        self.fetch("garbage")
+        self.assertEqual(self.ranges, ["bytes=7-"])
+
+    def test_checksum_mismatch(self):
+        self.url = self.url.replace("md5sum=", "md5sum=0")
+        fetcher = bb.fetch2.Fetch([self.url], self.d, cache=False)
+        with self.assertRaises(bb.fetch2.FetchError):
+            fetcher.download()
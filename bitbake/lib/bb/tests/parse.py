@@ -22,12 +22,15 @@
 import unittest
 import tempfile
 import logging
+import shutil
+import json
 import bb
 import os
 
 logger = logging.getLogger('BitBake.TestParse')
 
 import bb.parse
+import bb.parse.instrument
 import bb.data
 import bb.siggen
 
@@ -145,3 +148,64 @@ python () {
         self.assertEqual(d1.getVar("VAR_var", True), "B")
         self.assertEqual(d2.getVar("VAR_var", True), None)
 
+
+class ParseInstrumentTest(unittest.TestCase):
+
+    instrumentclass = """
+CLASSVAR = "${A}"
+python () {
+    d.setVar("ANON", d.getVar("CLASSVAR", True))
+}
+"""
+
+    instrumenttest = """
+A = "1"
+inherit ###CLASS###
+"""
+
+    def setUp(self):
+        self.d = bb.data.init()
+        bb.parse.siggen = bb.siggen.init(self.d)
+        self.tempdir = tempfile.mkdtemp()
+        bb.parse.instrument.enable()
+
+    def write(self, name, content):
+        fn = os.path.join(self.tempdir, name)
+        with open(fn, "w") as f:
+            f.write(content)
+        return fn
+
+    def tearDown(self):
+        bb.parse.instrument.disable()
+        bb.parse.instrument.stats.clear()
+        shutil.rmtree(self.tempdir)
+
+    def test_instrument(self):
+        cls = self.write("instrument.bbclass", self.instrumentclass)
+        recipe = self.write("instrument.bb", self.instrumenttest.replace("###CLASS###", cls))
+        with bb.parse.instrument.timed("recipe", recipe):
+            d = bb.parse.handle(recipe, self.d)['']
+        self.assertEqual(d.getVar("ANON", True), "1")
+
+        stats = bb.parse.instrument.stats
+        self.assertEqual(stats["recipe"][recipe][0], 1)
+        self.assertEqual(stats["class"][cls][0], 1)
+        self.assertEqual(len(stats["anonymous"]), 1)
+        self.assertIn("CLASSVAR", stats["getVar"])
+        self.assertIn("CLASSVAR", stats["expandWithRefs"])
+        # Nested time is only counted once as self time
+        recipestats = stats["recipe"][recipe]
+        self.assertLessEqual(recipestats[2], recipestats[1])
+
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(self.tempdir)
+        bb.parse.instrument.save("test")
+        self.assertEqual(bb.parse.instrument.stats, {})
+        reports = bb.parse.instrument.process_reports(["test"])
+        self.assertEqual(reports, ["parse-instrument.json", "parse-instrument.txt"])
+        self.assertFalse(os.path.exists(bb.parse.instrument.fragment_name("test")))
+        with open("parse-instrument.json") as report:
+            merged = json.load(report)
+        self.assertEqual(merged["class"][cls]["count"], 1)
+        with open("parse-instrument.txt") as summary:
+            self.assertIn(cls, summary.read())
@@ -0,0 +1,143 @@
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# BitBake Tests for the persistent data store (persist_data.py)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import unittest
+import tempfile
+import shutil
+import multiprocessing
+import os
+import sys
+import time
+import bb
+import bb.data
+import bb.persist_data
+
+def writer(d, num, count, results):
+    try:
+        start = time.time()
+        table = bb.persist_data.persist("BENCH", d)
+        for i in range(count):
+            table["key%d" % (i % 100)] = "%d-%d" % (num, i)
+        results.put((num, None, time.time() - start))
+    except Exception as exc:
+        results.put((num, repr(exc), 0))
+
+def reader(d, num, count, results):
+    try:
+        start = time.time()
+        table = bb.persist_data.persist("BENCH", d)
+        for i in range(count):
+            table.get("key%d" % (i % 100))
+        results.put((num, None, time.time() - start))
+    except Exception as exc:
+        results.put((num, repr(exc), 0))
+
+class PersistDataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.d = bb.data.init()
+        self.d.setVar("PERSISTENT_DIR", self.tempdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_table(self):
+        table = bb.persist_data.persist("TEST", self.d)
+        table["a"] = "1"
+        table["a"] = "2"
+        table["b"] = "3"
+        self.assertEqual(table["a"], "2")
+        self.assertEqual(len(table), 2)
+        self.assertIn("b", table)
+        self.assertNotIn("c", table)
+        del table["b"]
+        self.assertNotIn("b", table)
+        self.assertRaises(KeyError, table.__getitem__, "b")
+        self.assertEqual(table.items(), [("a", "2")])
+        self.assertEqual(bb.persist_data.persist("OTHER", self.d).items(), [])
+
+    def test_many(self):
+        table = bb.persist_data.persist("TEST", self.d)
+        values = dict(("key%d" % i, str(i)) for i in range(1200))
+        table.set_many(values)
+        table["key0"] = "changed"
+        values["key0"] = "changed"
+        self.assertEqual(table.get_many(list(values) + ["missing"]), values)
+        self.assertEqual(dict(table.items()), values)
+
+    def test_other_process(self):
+        table = bb.persist_data.persist("BENCH", self.d)
+        table["key0"] = "old"
+        self.assertEqual(table["key0"], "old")
+        results = multiprocessing.Queue()
+        p = multiprocessing.Process(target=writer, args=(self.d, 0, 1, results))
+        p.start()
+        self.assertEqual(results.get(timeout=30)[:2], (0, None))
+        p.join()
+        # The value cached by this process must not hide the new one
+        self.assertEqual(table["key0"], "0-0")
+        self.assertEqual(table.get_many(["key0"]), {"key0": "0-0"})
+
+    def test_fork(self):
+        table = bb.persist_data.persist("BENCH", self.d)
+        table["key0"] = "parent"
+        parentdb = table.db
+        pid = os.fork()
+        if pid == 0:
+            # Never return into the test runner in the child
+            status = 1
+            try:
+                table = bb.persist_data.persist("BENCH", self.d)
+                table["key1"] = "child"
+                # A connection of its own, the inherited one is left untouched
+                if table.db is not parentdb and parentdb in bb.persist_data._inherited_databases \
+                        and table["key0"] == "parent":
+                    status = 0
+            finally:
+                os._exit(status)
+        self.assertEqual(os.waitpid(pid, 0)[1], 0)
+        self.assertEqual(table["key1"], "child")
+
+    def test_parallel(self):
+        """
+        Read and write a table from several processes at once and report
+        the throughput
+        """
+        readers, writers, count = 8, 4, 500
+        bb.persist_data.persist("BENCH", self.d)["key0"] = ""
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=writer, args=(self.d, i, count, results))
+                     for i in range(writers)]
+        processes += [multiprocessing.Process(target=reader, args=(self.d, i, count * 4, results))
+                      for i in range(writers, writers + readers)]
+        for p in processes:
+            p.start()
+        done = [results.get(timeout=120) for p in processes]
+        for p in processes:
+            p.join()
+        self.assertEqual([result for result in done if result[1]], [])
+        writetime = max(elapsed for (num, _, elapsed) in done if num < writers)
+        readtime = max(elapsed for (num, _, elapsed) in done if num >= writers)
+        sys.stderr.write("\n%d writers: %.0f writes/second, %d readers: %.0f reads/second " %
+                         (writers, writers * count / max(writetime, 1e-6),
+                          readers, readers * count * 4 / max(readtime, 1e-6)))
+        table = bb.persist_data.persist("BENCH", self.d)
+        self.assertEqual(len(table), 100)
+        self.assertEqual(table["key99"].split("-")[1], str(count - 1))
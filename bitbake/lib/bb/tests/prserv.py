@@ -0,0 +1,97 @@
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# BitBake Tests for the PR service database (prserv/db.py)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+from __future__ import absolute_import
+import unittest
+import tempfile
+import shutil
+import os
+import prserv.db
+
+class PRDataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.dbfile = os.path.join(self.tempdir, "prserv.sqlite3")
+        self.dbs = []
+
+    def tearDown(self):
+        for db in self.dbs:
+            db.disconnect()
+        shutil.rmtree(self.tempdir)
+
+    def table(self, nohist, cachesize=2):
+        # A small cache so that most lookups go to the database
+        db = prserv.db.PRData(self.dbfile, nohist=nohist, cachesize=cachesize)
+        self.dbs.append(db)
+        return db["PRMAIN"]
+
+    def test_hist(self):
+        table = self.table(False)
+        values = [table.getValue("1.0", "arm", "sum%d" % i) for i in range(5)]
+        self.assertEqual(values, [0, 1, 2, 3, 4])
+        self.assertEqual(table.getValue("1.0", "arm", "sum0"), 0)
+        self.assertEqual(table.getValue("1.0", "x86", "sum0"), 0)
+        self.assertEqual(table.getValues([("1.0", "arm", "sum3"), ("1.0", "arm", "sum5")]), [3, 5])
+
+    def test_nohist(self):
+        table = self.table(True)
+        self.assertEqual(table.getValue("1.0", "arm", "sum0"), 0)
+        self.assertEqual(table.getValue("1.0", "arm", "sum1"), 1)
+        self.assertEqual(table.getValue("1.0", "arm", "sum2"), 2)
+        # Returning to an earlier checksum never decrements the value
+        self.assertEqual(table.getValue("1.0", "arm", "sum0"), 3)
+        self.assertEqual(table.getValue("1.0", "arm", "sum0"), 3)
+        self.assertEqual(table.getValue("1.0", "arm", "sum2"), 4)
+
+    def test_committed(self):
+        # Values are in the database before they are handed out, as if the
+        # server had been killed before its next sync
+        for nohist in (False, True):
+            table = self.table(nohist)
+            values = [table.getValue("1.0", "arm", "sum%d" % i) for i in range(3)]
+            self.assertEqual(values, [0, 1, 2])
+            other = self.table(nohist)
+            self.assertEqual(other.getValue("1.0", "arm", "sum2"), 2)
+            self.assertEqual(other.getValue("1.0", "arm", "sum3"), 3)
+
+    def test_import_hist(self):
+        table = self.table(False)
+        self.assertEqual(table.getValue("1.0", "arm", "sum0"), 0)
+        # Existing values are kept, new ones taken over
+        self.assertEqual(table.importone("1.0", "arm", "sum0", 7), 0)
+        self.assertEqual(table.importmany([("1.0", "arm", "sum1", 10),
+                                           ("1.0", "arm", "sum1", 11)]), [10, 10])
+        self.assertEqual(table.getValue("1.0", "arm", "sum1"), 10)
+        self.assertEqual(table.getValue("1.0", "arm", "sum2"), 11)
+        table.sync()
+        _, rows = table.export(None, None, None, False)
+        self.assertEqual(sorted((row["checksum"], row["value"]) for row in rows),
+                         [("sum0", 0), ("sum1", 10), ("sum2", 11)])
+
+    def test_import_nohist(self):
+        table = self.table(True)
+        self.assertEqual(table.getValue("1.0", "arm", "sum0"), 0)
+        # Higher values replace the stored one, lower ones don't
+        self.assertEqual(table.importone("1.0", "arm", "sum0", 5), 5)
+        self.assertEqual(table.importone("1.0", "arm", "sum0", 3), 5)
+        self.assertEqual(table.getValue("1.0", "arm", "sum0"), 5)
+        self.assertEqual(table.getValue("1.0", "arm", "sum1"), 6)
+        _, rows = table.export("1.0", "arm", None, False)
+        self.assertEqual([(row["checksum"], row["value"]) for row in rows], [("sum1", 6)])
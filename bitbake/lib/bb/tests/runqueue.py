@@ -0,0 +1,382 @@
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# BitBake Tests for the runqueue schedulers (runqueue.py)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import unittest
+import tempfile
+import shutil
+import random
+import time
+import sys
+import os
+import bb
+import bb.data
+import bb.parse
+import bb.siggen
+import bb.cache
+import bb.taskdata
+import bb.runqueue
+import bb.persist_data
+
+class FakeStats(object):
+    def __init__(self):
+        self.active = 0
+
+class FakeRunQueueData(object):
+    """
+    A synthetic task graph: recipes with a chain of tasks each, where the
+    configure task of a recipe depends on the last task of a few earlier
+    recipes
+    """
+    tasknames = ["do_fetch", "do_unpack", "do_patch", "do_configure",
+                 "do_compile", "do_install", "do_populate_sysroot",
+                 "do_package", "do_packagedata", "do_package_write"]
+
+    def __init__(self, recipes, stampdir):
+        rand = random.Random(42)
+        self.stampdir = stampdir
+        self.taskData = bb.taskdata.TaskData(False)
+        self.dataCache = bb.cache.CacheData([bb.cache.CoreRecipeInfo])
+        self.runq_fnid = []
+        self.runq_task = []
+        self.runq_depends = []
+        self.runq_revdeps = []
+
+        for fnid in xrange(recipes):
+            self.addrecipe()
+            for i, taskname in enumerate(self.tasknames):
+                taskid = self.addtask(fnid, taskname)
+                if i:
+                    self.adddep(taskid, taskid - 1)
+                if taskname == "do_configure" and fnid:
+                    for dep in rand.sample(xrange(fnid), min(fnid, 3)):
+                        self.adddep(taskid, dep * len(self.tasknames) + self.tasknames.index("do_populate_sysroot"))
+
+        self.setweights()
+
+    def addrecipe(self):
+        fnid = len(self.taskData.fn_index)
+        fn = "/layer/recipe-%d.bb" % fnid
+        self.taskData.fn_index.append(fn)
+        self.dataCache.pkg_fn[fn] = "recipe-%d" % fnid
+        self.dataCache.stamp[fn] = os.path.join(self.stampdir, "recipe-%d" % fnid)
+        self.dataCache.stamp_extrainfo[fn] = {}
+        return fnid
+
+    def addtask(self, fnid, taskname):
+        self.runq_fnid.append(fnid)
+        self.runq_task.append(taskname)
+        self.runq_depends.append(set())
+        self.runq_revdeps.append(set())
+        return len(self.runq_task) - 1
+
+    def adddep(self, task, dep):
+        self.runq_depends[task].add(dep)
+        self.runq_revdeps[dep].add(task)
+
+    def setweights(self):
+        self.runq_weight = [len(revdeps) + 1 for revdeps in self.runq_revdeps]
+
+class FakeRunQueueExecute(object):
+    """
+    Drives a scheduler the way RunQueueExecuteTasks does, completing the
+    oldest running task whenever no new task can be started
+    """
+    def __init__(self, rqdata, number_tasks, cfgData=None):
+        self.rqdata = rqdata
+        self.number_tasks = number_tasks
+        self.cfgData = cfgData
+        self.rq = self
+        self.scenequeue_covered = set()
+        self.stats = FakeStats()
+        self.resources = None
+        self.build_stamps = {}
+        self.build_stamps2 = set()
+        self.runq_running = []
+        self.runq_complete = []
+        self.runq_buildable = []
+        for task in xrange(len(rqdata.runq_task)):
+            self.runq_running.append(0)
+            self.runq_complete.append(0)
+            self.runq_buildable.append(int(not rqdata.runq_depends[task]))
+
+    def run(self, schedulerclass):
+        sched = schedulerclass(self, self.rqdata)
+        running = []
+        order = []
+        ticks = 0
+        total = len(self.rqdata.runq_task)
+        while len(order) < total:
+            ticks += 1
+            task = sched.next()
+            if task is not None:
+                self.runq_running[task] = 1
+                self.stats.active += 1
+                self.build_stamps[task] = sched.stamps[task]
+                self.build_stamps2.add(sched.stamps[task])
+                running.append(task)
+                continue
+
+            task = running.pop(0)
+            self.stats.active -= 1
+            self.build_stamps2.remove(self.build_stamps.pop(task))
+            self.runq_complete[task] = 1
+            order.append(task)
+            for revdep in self.rqdata.runq_revdeps[task]:
+                if all(self.runq_complete[dep] for dep in self.rqdata.runq_depends[revdep]):
+                    self.runq_buildable[revdep] = 1
+                    sched.newbuilable(revdep)
+        return order, ticks
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        bb.parse.siggen = bb.siggen.init(bb.data.init())
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def check_order(self, rqdata, order):
+        self.assertEqual(sorted(order), range(len(rqdata.runq_task)))
+        position = dict((task, i) for (i, task) in enumerate(order))
+        for task, deps in enumerate(rqdata.runq_depends):
+            for dep in deps:
+                self.assertLess(position[dep], position[task])
+
+    def test_schedulers(self):
+        rqdata = FakeRunQueueData(200, self.tempdir)
+        for schedulerclass in [bb.runqueue.RunQueueScheduler,
+                               bb.runqueue.RunQueueSchedulerSpeed,
+                               bb.runqueue.RunQueueSchedulerCompletion]:
+            order, _ = FakeRunQueueExecute(rqdata, 8).run(schedulerclass)
+            self.check_order(rqdata, order)
+
+    def criticalpath_order(self, durations):
+        """
+        Schedule a small graph one task at a time: recipe-0 (fetch, compile)
+        is needed by recipe-2 and recipe-3, recipe-1 (fetch, compile) by
+        recipe-2 only
+        """
+        rqdata = FakeRunQueueData(0, self.tempdir)
+        for fnid in xrange(4):
+            rqdata.addrecipe()
+        fetch0 = rqdata.addtask(0, "do_fetch")
+        compile0 = rqdata.addtask(0, "do_compile")
+        fetch1 = rqdata.addtask(1, "do_fetch")
+        compile1 = rqdata.addtask(1, "do_compile")
+        rootfs2 = rqdata.addtask(2, "do_rootfs")
+        install3 = rqdata.addtask(3, "do_install")
+        rqdata.adddep(compile0, fetch0)
+        rqdata.adddep(compile1, fetch1)
+        rqdata.adddep(rootfs2, compile0)
+        rqdata.adddep(rootfs2, compile1)
+        rqdata.adddep(install3, fetch0)
+        rqdata.setweights()
+
+        cfgData = bb.data.init()
+        cfgData.setVar("PERSISTENT_DIR", os.path.join(self.tempdir, "persist"))
+        bb.persist_data.persist('BB_TASK_DURATIONS', cfgData).set_many(durations)
+        order, _ = FakeRunQueueExecute(rqdata, 1, cfgData).run(bb.runqueue.RunQueueSchedulerCriticalPath)
+        self.check_order(rqdata, order)
+        return [(rqdata.dataCache.pkg_fn[rqdata.taskData.fn_index[rqdata.runq_fnid[task]]], rqdata.runq_task[task])
+                for task in order]
+
+    def test_criticalpath(self):
+        # The long recipe-1 compile goes first although recipe-0 is needed more
+        order = self.criticalpath_order({"recipe-1:do_compile": "100"})
+        self.assertEqual(order, [("recipe-1", "do_fetch"), ("recipe-1", "do_compile"),
+                                 ("recipe-0", "do_fetch"), ("recipe-0", "do_compile"),
+                                 ("recipe-2", "do_rootfs"), ("recipe-3", "do_install")])
+
+    def test_criticalpath_no_durations(self):
+        # All tasks take the default duration, the heavier recipe-0 wins ties
+        order = self.criticalpath_order({})
+        self.assertEqual(order, [("recipe-0", "do_fetch"), ("recipe-1", "do_fetch"),
+                                 ("recipe-0", "do_compile"), ("recipe-1", "do_compile"),
+                                 ("recipe-2", "do_rootfs"), ("recipe-3", "do_install")])
+
+    def test_benchmark(self):
+        """
+        Drive the speed scheduler with a synthetic 50k task graph and
+        report the scheduling rate
+        """
+        rqdata = FakeRunQueueData(5000, self.tempdir)
+        start = time.time()
+        order, ticks = FakeRunQueueExecute(rqdata, 64).run(bb.runqueue.RunQueueSchedulerSpeed)
+        elapsed = time.time() - start
+        self.check_order(rqdata, order)
+        sys.stderr.write("\n%d tasks scheduled in %d ticks, %.0f ticks/second " % (len(order), ticks, ticks / max(elapsed, 1e-6)))
+
+class FakeResourcesExecute(object):
+    def __init__(self, rqdata, cfgData, number_tasks):
+        self.rqdata = rqdata
+        self.cfgData = cfgData
+        self.number_tasks = number_tasks
+
+class StubbedResources(bb.runqueue.RunQueueResources):
+    """
+    Resource admission with the /proc readings replaced by set values
+    """
+    memavailable_value = None
+    pressure_values = {}
+
+    def read_memavailable(self):
+        return self.memavailable_value
+
+    def read_pressure(self, resource):
+        return self.pressure_values.get(resource)
+
+class ResourcesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.cfgData = bb.data.init()
+        self.rqdata = FakeRunQueueData(0, self.tempdir)
+        self.tasks = {}
+        for fnid, resources in enumerate(["cpu=4 memory=2", "io=1", "memory=1 io=2", None]):
+            self.rqdata.addrecipe()
+            self.tasks[resources] = self.rqdata.addtask(fnid, "do_compile")
+            fn = self.rqdata.taskData.fn_index[fnid]
+            self.rqdata.dataCache.task_deps[fn] = {}
+            if resources:
+                self.rqdata.dataCache.task_deps[fn]['resources'] = {"do_compile": resources}
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def resources(self, number_tasks=4):
+        resources = StubbedResources(FakeResourcesExecute(self.rqdata, self.cfgData, number_tasks))
+        resources.poll_interval = 0
+        return resources
+
+    def test_parse(self):
+        self.assertEqual(bb.runqueue.RunQueueResources.parse("cpu=4 memory=2.5"), {"cpu": 4, "memory": 2.5})
+        self.assertEqual(bb.runqueue.RunQueueResources.parse(""), {})
+        for value in ["cpu", "cpu=many", "memory=1 io"]:
+            self.assertRaises(bb.BBHandledException, bb.runqueue.RunQueueResources.parse, value)
+
+    def test_task_resources(self):
+        resources = self.resources()
+        self.assertEqual(resources.task_resources(self.tasks["cpu=4 memory=2"]), {"cpu": 4, "memory": 2})
+        self.assertEqual(resources.task_resources(self.tasks["io=1"]), {"cpu": 1, "io": 1})
+        self.assertEqual(resources.task_resources(self.tasks[None]), {"cpu": 1})
+
+    def test_limits(self):
+        self.assertFalse(bb.runqueue.RunQueueResources.enabled(self.cfgData))
+        self.cfgData.setVar("BB_RESOURCE_LIMITS", "memory=3 io=2")
+        self.assertTrue(bb.runqueue.RunQueueResources.enabled(self.cfgData))
+        resources = self.resources(number_tasks=5)
+        self.assertEqual(resources.limits, {"cpu": 5, "memory": 3, "io": 2})
+
+        self.cfgData.setVar("BB_RESOURCE_LIMITS", "cpu")
+        self.assertRaises(bb.BBHandledException, self.resources)
+
+    def test_claim_release(self):
+        self.cfgData.setVar("BB_RESOURCE_LIMITS", "memory=3 io=2")
+        resources = self.resources(number_tasks=5)
+        big, io, mixed, plain = (self.tasks[r] for r in ["cpu=4 memory=2", "io=1", "memory=1 io=2", None])
+
+        # Nothing running, anything fits
+        self.assertTrue(resources.fits(mixed))
+        resources.claim(big)
+        self.assertTrue(resources.fits(plain))
+        self.assertTrue(resources.fits(mixed))
+        resources.claim(mixed)
+        # cpu 5 of 5, memory 3 of 3, io 2 of 2 are in use
+        self.assertFalse(resources.fits(plain))
+        self.assertFalse(resources.fits(io))
+        resources.release(big)
+        self.assertTrue(resources.fits(plain))
+        self.assertFalse(resources.fits(io))
+        resources.release(mixed)
+        self.assertTrue(resources.fits(io))
+        self.assertEqual(resources.claims, {})
+        self.assertEqual(dict((r, v) for (r, v) in resources.inuse.items() if v), {})
+        # Releasing a task which holds nothing is harmless
+        resources.release(io)
+
+    def test_memavailable(self):
+        resources = self.resources(number_tasks=8)
+        resources.claim(self.tasks[None])
+        resources.memavailable_value = 1.5
+        self.assertFalse(resources.fits(self.tasks["cpu=4 memory=2"]))
+        self.assertTrue(resources.fits(self.tasks["memory=1 io=2"]))
+        self.assertTrue(resources.fits(self.tasks["io=1"]))
+        resources.memavailable_value = None
+        self.assertTrue(resources.fits(self.tasks["cpu=4 memory=2"]))
+
+    def test_pressure(self):
+        self.cfgData.setVar("BB_PRESSURE_MAX_IO", "20")
+        self.assertTrue(bb.runqueue.RunQueueResources.enabled(self.cfgData))
+        resources = self.resources(number_tasks=8)
+        self.assertEqual(resources.max_pressure, {"io": 20})
+        resources.claim(self.tasks[None])
+
+        resources.pressure_values = {"io": 35.5, "memory": 90}
+        self.assertFalse(resources.fits(self.tasks["io=1"]))
+        # Only tasks declaring the resource are held back, and memory
+        # pressure isn't limited
+        self.assertTrue(resources.fits(self.tasks["cpu=4 memory=2"]))
+        resources.pressure_values = {"io": 10}
+        self.assertTrue(resources.fits(self.tasks["io=1"]))
+        # No pressure information, no limit
+        resources.pressure_values = {}
+        self.assertTrue(resources.fits(self.tasks["memory=1 io=2"]))
+
+        # One task always runs
+        resources.release(self.tasks[None])
+        resources.pressure_values = {"io": 100}
+        self.assertTrue(resources.fits(self.tasks["io=1"]))
+
+class StampIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.stampdir = os.path.join(self.tempdir, "foo")
+        os.mkdir(self.stampdir)
+        self.stamp = os.path.join(self.stampdir, "1.0-r0.do_compile")
+        open(self.stamp, "w").close()
+        os.utime(self.stamp, (1000, 1000))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_lookup(self):
+        index = bb.runqueue.StampIndex()
+        self.assertEqual(index.mtime(self.stamp), 1000)
+        self.assertTrue(index.exists(self.stamp))
+        self.assertFalse(index.exists(os.path.join(self.stampdir, "1.0-r0.do_install")))
+        self.assertFalse(index.exists(os.path.join(self.tempdir, "missing", "1.0-r0.do_install")))
+
+    def test_invalidate(self):
+        index = bb.runqueue.StampIndex()
+        install = os.path.join(self.stampdir, "1.0-r0.do_install")
+        self.assertFalse(index.exists(install))
+        open(install, "w").close()
+        os.utime(self.stamp, (2000, 2000))
+        self.assertFalse(index.exists(install))
+        index.invalidate(install)
+        self.assertTrue(index.exists(install))
+        self.assertEqual(index.mtime(self.stamp), 2000)
+
+    def test_prefetch(self):
+        index = bb.runqueue.StampIndex()
+        missing = os.path.join(self.stampdir, "1.0-r0.do_install")
+        index.prefetch([self.stamp, missing, None], 4)
+        self.assertEqual(index.mtimes[self.stampdir], {"1.0-r0.do_compile": 1000, "1.0-r0.do_install": None})
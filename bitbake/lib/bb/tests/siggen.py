@@ -0,0 +1,90 @@
+# ex:ts=4:sw=4:sts=4:et
+# -*- tab-width: 4; c-basic-offset: 4; indent-tabs-mode: nil -*-
+#
+# BitBake Tests for the signature generators (siggen.py)
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License version 2 as
+# published by the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+
+import unittest
+import tempfile
+import shutil
+import os
+import bb
+import bb.data
+import bb.siggen
+
+class BasicHashTest(unittest.TestCase):
+
+    class DataCache(object):
+        def __init__(self, siggen, tempdir):
+            self.basetaskhash = siggen.basehash
+            self.pkg_fn = {"recipe.bb": "recipe"}
+            self.file_checksums = {"recipe.bb": {}}
+            self.task_deps = {"recipe.bb": {}}
+            self.stamp = {"recipe.bb": os.path.join(tempdir, "stamp")}
+
+    def setUp(self):
+        self.d = bb.data.init()
+        self.d.setVar("BB_SIGNATURE_HANDLER", "basichash")
+        self.d.setVar("BB_HASHBASE_WHITELIST", "DATE")
+        self.d.setVar("__BBTASKS", ["do_compile", "do_install"])
+        self.d.setVar("__exportlist", set())
+        self.d.setVar("do_compile", "make ${CFLAGS} ${DATE}")
+        self.d.setVarFlag("do_compile", "func", "1")
+        self.d.setVar("do_install", "install ${D}")
+        self.d.setVarFlag("do_install", "func", "1")
+        self.d.setVar("CFLAGS", "-O2")
+        self.d.setVar("D", "/image")
+        self.d.setVar("DATE", "today")
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def basehashes(self, siggen=None):
+        siggen = siggen or bb.siggen.init(self.d)
+        siggen.finalise("recipe.bb", self.d, None)
+        return dict((task, siggen.basehash["recipe.bb." + task])
+                    for task in ("do_compile", "do_install"))
+
+    def test_basehash(self):
+        siggen = bb.siggen.init(self.d)
+        hashes = self.basehashes(siggen)
+        self.assertEqual(hashes, self.basehashes())
+        # Only kept while a recipe is being finalised
+        self.assertEqual(siggen.vardigests, {})
+
+        self.d.setVar("DATE", "tomorrow")
+        self.assertEqual(hashes, self.basehashes())
+
+        self.d.setVar("CFLAGS", "-O3")
+        changed = self.basehashes()
+        self.assertNotEqual(hashes["do_compile"], changed["do_compile"])
+        self.assertEqual(hashes["do_install"], changed["do_install"])
+
+    def test_compare_sigfiles(self):
+        sigfiles = []
+        for cflags in ("-O2", "-O3"):
+            self.d.setVar("CFLAGS", cflags)
+            siggen = bb.siggen.init(self.d)
+            siggen.finalise("recipe.bb", self.d, None)
+            siggen.get_taskhash("recipe.bb", "do_compile", [], self.DataCache(siggen, self.tempdir))
+            sigfile = os.path.join(self.tempdir, cflags)
+            siggen.dump_sigtask("recipe.bb", "do_compile", sigfile, "customfile")
+            sigfiles.append(sigfile)
+
+        output = bb.siggen.compare_sigfiles(*sigfiles)
+        self.assertIn("Variable CFLAGS value changed from '-O2' to '-O3'", output)
+        self.assertEqual(len([l for l in output if l.startswith("Variable ")]), 1)
@@ -243,7 +243,7 @@ def _log_settings_from_server(server):
 
 _evt_list = [ "bb.runqueue.runQueueExitWait", "bb.event.LogExecTTY", "logging.LogRecord",
               "bb.build.TaskFailed", "bb.build.TaskBase", "bb.event.ParseStarted",
-              "bb.event.ParseProgress", "bb.event.ParseCompleted", "bb.event.CacheLoadStarted",
+              "bb.event.ParseProgress", "bb.event.ParseCompleted", "bb.event.ParseTimes", "bb.event.CacheLoadStarted",
               "bb.event.CacheLoadProgress", "bb.event.CacheLoadCompleted", "bb.command.CommandFailed",
               "bb.command.CommandExit", "bb.command.CommandCompleted",  "bb.cooker.CookerExit",
               "bb.event.MultipleProviders", "bb.event.NoProvider", "bb.runqueue.sceneQueueTaskStarted",
@@ -414,6 +414,20 @@ def main(server, eventHandler, params, tf = TerminalFilter):
                 print(("Parsing of %d .bb files complete (%d cached, %d parsed). %d targets, %d skipped, %d masked, %d errors."
                     % ( event.total, event.cached, event.parsed, event.virtuals, event.skipped, event.masked, event.errors)))
                 continue
+            if isinstance(event, bb.event.ParseTimes):
+                counts = []
+                last = 0
+                for bound, count in event.histogram:
+                    if count:
+                        if bound is None:
+                            counts.append("%d over %gs" % (count, last))
+                        else:
+                            counts.append("%d up to %gs" % (count, bound))
+                    last = bound
+                logger.verbose("Recipe parse times: %s", ", ".join(counts))
+                logger.verbose("Slowest recipes to parse: %s",
+                               ", ".join("%s (%.2fs)" % (os.path.basename(fn), seconds) for fn, seconds in event.slowest))
+                continue
 
             if isinstance(event, bb.event.CacheLoadStarted):
                 cacheprogress = new_progress("Loading cache", event.total).start()
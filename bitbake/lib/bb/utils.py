@@ -521,8 +521,8 @@ def md5_file(filename):
         m = md5.new()
 
     with open(filename, "rb") as f:
-        for line in f:
-            m.update(line)
+        for chunk in iter(lambda: f.read(65536), b""):
+            m.update(chunk)
     return m.hexdigest()
 
 def sha256_file(filename):
@@ -1,8 +1,8 @@
 import logging
 import os.path
 import errno
+import collections
 import prserv
-import time
 
 try:
     import sqlite3
@@ -25,8 +25,11 @@ if sqlversion[0] < 3 or (sqlversion[0] == 3 and sqlversion[1] < 3):
 # Value can decrement if returning to a previous build.
 #
 
+# The number of (version, pkgarch, checksum) values kept in memory per table
+CACHE_SIZE = 100000
+
 class PRTable(object):
-    def __init__(self, conn, table, nohist):
+    def __init__(self, conn, table, nohist, cachesize=CACHE_SIZE):
         self.conn = conn
         self.nohist = nohist
         self.dirty = False
@@ -42,80 +45,102 @@ class PRTable(object):
                     value INTEGER, \
                     PRIMARY KEY (version, pkgarch, checksum));" % self.table)
 
+        # The statements are built once so that the text is identical for
+        # every call and sqlite3's statement cache can reuse them prepared
+        self.sql_select = "SELECT value FROM %s WHERE version=? AND pkgarch=? AND checksum=?;" % self.table
+        self.sql_max = "SELECT max(value) FROM %s WHERE version=? AND pkgarch=?;" % self.table
+        self.sql_insert = "INSERT INTO %s VALUES (?, ?, ?, ?);" % self.table
+        self.sql_replace = "INSERT OR REPLACE INTO %s VALUES (?, ?, ?, ?);" % self.table
+        self.sql_update = "UPDATE %s SET value=? WHERE version=? AND pkgarch=? AND checksum=? AND value<?" % self.table
+        self.sql_select_atleast = "SELECT value FROM %s WHERE version=? AND pkgarch=? AND checksum=? AND value>=?;" % self.table
+
+        # Most lookups are for values handed out before, so the recently
+        # used ones are kept in memory along with the highest value of each
+        # (version, pkgarch), which assumes this is the only process writing
+        # to the database. New values are committed before they are handed
+        # out so that a crash can't lead to them being handed out again.
+        self.cache = collections.OrderedDict()
+        self.cachesize = cachesize
+        self.maxvalues = {}
+        self._warm()
+
     def _execute(self, *query):
-        """Execute a query, waiting to acquire a lock if necessary"""
-        start = time.time()
-        end = start + 20
-        while True:
-            try:
-                return self.conn.execute(*query)
-            except sqlite3.OperationalError as exc:
-                if 'is locked' in str(exc) and end > time.time():
-                    continue
-                raise exc
+        """Execute a query, sqlite waits up to 20s for a lock if necessary"""
+        return self.conn.execute(*query)
+
+    def _warm(self):
+        for row in self._execute("SELECT version, pkgarch, max(value) FROM %s GROUP BY version, pkgarch;" % self.table):
+            self.maxvalues[(row[0], row[1])] = row[2]
+        # Fill the cache with the most recently added values
+        for row in self._execute("SELECT version, pkgarch, checksum, value FROM \
+                                  (SELECT rowid, * FROM %s ORDER BY rowid DESC LIMIT ?) ORDER BY rowid;" % self.table,
+                                 (self.cachesize,)):
+            self._remember((row[0], row[1], row[2]), row[3])
 
     def sync(self):
         self.conn.commit()
-        self._execute("BEGIN EXCLUSIVE TRANSACTION")
 
     def sync_if_dirty(self):
         if self.dirty:
             self.sync()
             self.dirty = False
 
-    def _getValueHist(self, version, pkgarch, checksum):
-        data=self._execute("SELECT value FROM %s WHERE version=? AND pkgarch=? AND checksum=?;" % self.table,
-                           (version, pkgarch, checksum))
-        row=data.fetchone()
-        if row != None:
-            return row[0]
+    def _remember(self, key, value):
+        self.cache[key] = value
+        if len(self.cache) > self.cachesize:
+            self.cache.popitem(last=False)
+
+    def _lookup(self, key):
+        """Return the value stored for key, or None"""
+        value = self.cache.pop(key, None)
+        if value is None:
+            row = self._execute(self.sql_select, key).fetchone()
+            if row is None:
+                return None
+            value = row[0]
+        self._remember(key, value)
+        return value
+
+    def _maxvalue(self, version, pkgarch):
+        key = (version, pkgarch)
+        if key not in self.maxvalues:
+            self.maxvalues[key] = self._execute(self.sql_max, key).fetchone()[0]
+        return self.maxvalues[key]
+
+    def _newvalue(self, key):
+        """Hand out the next value for key's (version, pkgarch)"""
+        maxvalue = self._maxvalue(key[0], key[1])
+        if maxvalue is None:
+            value = 0
         else:
-            #no value found, try to insert
-            try:
-                self._execute("INSERT INTO %s VALUES (?, ?, ?, (select ifnull(max(value)+1,0) from %s where version=? AND pkgarch=?));"
-                           % (self.table,self.table),
-                           (version,pkgarch, checksum,version, pkgarch))
-            except sqlite3.IntegrityError as exc:
-                logger.error(str(exc))
+            value = maxvalue + 1
+        self._execute(self.sql_replace, key + (value,))
+        self.conn.commit()
+        self.maxvalues[key[:2]] = value
+        self.cache.pop(key, None)
+        self._remember(key, value)
+        return value
 
-            self.dirty = True
+    def _forget(self, version, pkgarch, checksum):
+        """Drop what is known about a value changed in the database"""
+        self.cache.pop((version, pkgarch, checksum), None)
+        self.maxvalues.pop((version, pkgarch), None)
 
-            data=self._execute("SELECT value FROM %s WHERE version=? AND pkgarch=? AND checksum=?;" % self.table,
-                               (version, pkgarch, checksum))
-            row=data.fetchone()
-            if row != None:
-                return row[0]
-            else:
-                raise prserv.NotFoundError
+    def _getValueHist(self, version, pkgarch, checksum):
+        key = (version, pkgarch, checksum)
+        value = self._lookup(key)
+        if value is None:
+            value = self._newvalue(key)
+        return value
 
     def _getValueNohist(self, version, pkgarch, checksum):
-        data=self._execute("SELECT value FROM %s \
-                            WHERE version=? AND pkgarch=? AND checksum=? AND \
-                            value >= (select max(value) from %s where version=? AND pkgarch=?);" 
-                            % (self.table, self.table),
-                            (version, pkgarch, checksum, version, pkgarch))
-        row=data.fetchone()
-        if row != None:
-            return row[0]
-        else:
-            #no value found, try to insert
-            try:
-                self._execute("INSERT OR REPLACE INTO %s VALUES (?, ?, ?, (select ifnull(max(value)+1,0) from %s where version=? AND pkgarch=?));"
-                               % (self.table,self.table),
-                               (version, pkgarch, checksum, version, pkgarch))
-            except sqlite3.IntegrityError as exc:
-                logger.error(str(exc))
-                self.conn.rollback()
-
-            self.dirty = True
-
-            data=self._execute("SELECT value FROM %s WHERE version=? AND pkgarch=? AND checksum=?;" % self.table,
-                               (version, pkgarch, checksum))
-            row=data.fetchone()
-            if row != None:
-                return row[0]
-            else:
-                raise prserv.NotFoundError
+        # Only the highest value of the (version, pkgarch) is returned,
+        # older ones are replaced by a new highest value
+        key = (version, pkgarch, checksum)
+        value = self._lookup(key)
+        if value is None or value < self._maxvalue(version, pkgarch):
+            value = self._newvalue(key)
+        return value
 
     def getValue(self, version, pkgarch, checksum):
         if self.nohist:
@@ -123,25 +148,30 @@ class PRTable(object):
         else:
             return self._getValueHist(version, pkgarch, checksum)
 
+    def getValues(self, queries):
+        """
+        Look up the values for several (version, pkgarch, checksum) tuples
+        at once, with None for any that can't be found
+        """
+        return [self.getValue(version, pkgarch, checksum)
+                for (version, pkgarch, checksum) in queries]
+
     def _importHist(self, version, pkgarch, checksum, value):
         val = None 
-        data = self._execute("SELECT value FROM %s WHERE version=? AND pkgarch=? AND checksum=?;" % self.table,
-                           (version, pkgarch, checksum))
+        data = self._execute(self.sql_select, (version, pkgarch, checksum))
         row = data.fetchone()
         if row != None:
             val=row[0]
         else:
             #no value found, try to insert
             try:
-                self._execute("INSERT INTO %s VALUES (?, ?, ?, ?);"  % (self.table),
-                           (version, pkgarch, checksum, value))
+                self._execute(self.sql_insert, (version, pkgarch, checksum, value))
             except sqlite3.IntegrityError as exc:
                 logger.error(str(exc))
 
             self.dirty = True
 
-            data = self._execute("SELECT value FROM %s WHERE version=? AND pkgarch=? AND checksum=?;" % self.table,
-                           (version, pkgarch, checksum))
+            data = self._execute(self.sql_select, (version, pkgarch, checksum))
             row = data.fetchone()
             if row != None:
                 val = row[0]
@@ -150,21 +180,17 @@ class PRTable(object):
     def _importNohist(self, version, pkgarch, checksum, value):
         try:
             #try to insert
-            self._execute("INSERT INTO %s VALUES (?, ?, ?, ?);"  % (self.table),
-                           (version, pkgarch, checksum,value))
+            self._execute(self.sql_insert, (version, pkgarch, checksum,value))
         except sqlite3.IntegrityError as exc:
             #already have the record, try to update
             try:
-                self._execute("UPDATE %s SET value=? WHERE version=? AND pkgarch=? AND checksum=? AND value<?"  
-                              % (self.table),
-                               (value,version,pkgarch,checksum,value))
+                self._execute(self.sql_update, (value,version,pkgarch,checksum,value))
             except sqlite3.IntegrityError as exc:
                 logger.error(str(exc))
 
         self.dirty = True
 
-        data = self._execute("SELECT value FROM %s WHERE version=? AND pkgarch=? AND checksum=? AND value>=?;" % self.table,
-                            (version,pkgarch,checksum,value))
+        data = self._execute(self.sql_select_atleast, (version,pkgarch,checksum,value))
         row=data.fetchone()
         if row != None:
             return row[0]
@@ -172,10 +198,21 @@ class PRTable(object):
             return None
 
     def importone(self, version, pkgarch, checksum, value):
-        if self.nohist:
-            return self._importNohist(version, pkgarch, checksum, value)
-        else:
-            return self._importHist(version, pkgarch, checksum, value)
+        try:
+            if self.nohist:
+                return self._importNohist(version, pkgarch, checksum, value)
+            else:
+                return self._importHist(version, pkgarch, checksum, value)
+        finally:
+            self._forget(version, pkgarch, checksum)
+
+    def importmany(self, rows):
+        """
+        importone() for each (version, pkgarch, checksum, value) in a list,
+        returning the resulting values
+        """
+        return [self.importone(version, pkgarch, checksum, value)
+                for (version, pkgarch, checksum, value) in rows]
 
     def export(self, version, pkgarch, checksum, colinfo):
         metainfo = {}
@@ -233,16 +270,21 @@ class PRTable(object):
 
 class PRData(object):
     """Object representing the PR database"""
-    def __init__(self, filename, nohist=True):
+    def __init__(self, filename, nohist=True, cachesize=CACHE_SIZE):
         self.filename=os.path.abspath(filename)
         self.nohist=nohist
+        self.cachesize=cachesize
         #build directory hierarchy
         try:
             os.makedirs(os.path.dirname(self.filename))
         except OSError as e:
             if e.errno != errno.EEXIST:
                 raise e
-        self.connection=sqlite3.connect(self.filename, isolation_level="EXCLUSIVE", check_same_thread = False)
+        # Write transactions start with the first statement which writes and
+        # end with sync(), rather than holding the database locked between
+        # requests
+        self.connection=sqlite3.connect(self.filename, isolation_level="IMMEDIATE", timeout=20,
+                                        check_same_thread = False)
         self.connection.row_factory=sqlite3.Row
         self.connection.execute("pragma synchronous = off;")
         self.connection.execute("PRAGMA journal_mode = WAL;")
@@ -258,7 +300,7 @@ class PRData(object):
         if tblname in self._tables:
             return self._tables[tblname]
         else:
-            tableobj = self._tables[tblname] = PRTable(self.connection, tblname, self.nohist)
+            tableobj = self._tables[tblname] = PRTable(self.connection, tblname, self.nohist, self.cachesize)
             return tableobj
 
     def __delitem__(self, tblname):
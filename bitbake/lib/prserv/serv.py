@@ -2,8 +2,8 @@ import os,sys,logging
 import signal, time
 from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
 import threading
-import Queue
 import socket
+import xmlrpclib
 
 try:
     import sqlite3
@@ -22,6 +22,11 @@ if sys.hexversion < 0x020600F0:
     sys.exit(1)
 
 class Handler(SimpleXMLRPCRequestHandler):
+    # Let clients keep their connection open between requests, closing
+    # it if they have been idle for a while
+    protocol_version = "HTTP/1.1"
+    timeout = 60
+
     def _dispatch(self,method,params):
         try:
             value=self.server.funcs[method](*params)
@@ -39,7 +44,7 @@ class PRServer(SimpleXMLRPCServer):
     def __init__(self, dbfile, logfile, interface, daemon=True):
         ''' constructor '''
         try:
-            SimpleXMLRPCServer.__init__(self, interface,
+            SimpleXMLRPCServer.__init__(self, interface, requestHandler=Handler,
                                         logRequests=False, allow_none=True)
         except socket.error:
             ip=socket.gethostbyname(interface[0])
@@ -56,67 +61,84 @@ class PRServer(SimpleXMLRPCServer):
         self.pidfile=PIDPREFIX % (self.host, self.port)
 
         self.register_function(self.getPR, "getPR")
+        self.register_function(self.getPRs, "getPRs")
         self.register_function(self.quit, "quit")
         self.register_function(self.ping, "ping")
         self.register_function(self.export, "export")
         self.register_function(self.importone, "importone")
+        self.register_function(self.importmany, "importmany")
         self.register_introspection_functions()
 
-        self.requestqueue = Queue.Queue()
-        self.handlerthread = threading.Thread(target = self.process_request_thread)
-        self.handlerthread.daemon = False
-
-    def process_request_thread(self):
-        """Same as in BaseServer but as a thread.
-
-        In addition, exception handling is done here.
-
-        """
-        iter_count = 1
-        # 60 iterations between syncs or sync if dirty every ~30 seconds
-        iterations_between_sync = 60
+        # Clients keep their connections open, so each is served by its
+        # own thread and the database accesses are serialised by dblock
+        self.dblock = threading.RLock()
 
-        bb.utils.set_process_name("PRServ Handler")
+        # Imports are committed every 60 requests or ~30 seconds, new values
+        # are committed right away by the table
+        self.requestcount = 0
+        self.syncthread = threading.Thread(target = self.sync_thread)
+        self.syncthread.daemon = True
+        self.syncevent = threading.Event()
 
+    def sync_thread(self):
         while not self.quit:
-            try:
-                (request, client_address) = self.requestqueue.get(True, 30)
-            except Queue.Empty:
+            self.syncevent.wait(30)
+            with self.dblock:
                 self.table.sync_if_dirty()
-                continue
-            try:
-                self.finish_request(request, client_address)
-                self.shutdown_request(request)
-                iter_count = (iter_count + 1) % iterations_between_sync
-                if iter_count == 0:
-                    self.table.sync_if_dirty()
-            except:
-                self.handle_error(request, client_address)
-                self.shutdown_request(request)
-                self.table.sync()
+
+    def request_done(self):
+        """Called with dblock held after each request changing the table"""
+        self.requestcount = (self.requestcount + 1) % 60
+        if self.requestcount == 0:
             self.table.sync_if_dirty()
 
+    def process_request_thread(self, request, client_address):
+        """Same as in ThreadingMixIn, serving one client connection"""
+        try:
+            self.finish_request(request, client_address)
+        except:
+            self.handle_error(request, client_address)
+        self.shutdown_request(request)
+
     def sigint_handler(self, signum, stack):
         if self.table:
-            self.table.sync()
+            with self.dblock:
+                self.table.sync()
 
     def sigterm_handler(self, signum, stack):
         if self.table:
-            self.table.sync()
+            with self.dblock:
+                self.table.sync()
         self.quit=True
 
     def process_request(self, request, client_address):
-        self.requestqueue.put((request, client_address))
+        thread = threading.Thread(target=self.process_request_thread,
+                                  args=(request, client_address))
+        thread.daemon = True
+        thread.start()
 
     def export(self, version=None, pkgarch=None, checksum=None, colinfo=True):
         try:
-            return self.table.export(version, pkgarch, checksum, colinfo)
+            with self.dblock:
+                return self.table.export(version, pkgarch, checksum, colinfo)
         except sqlite3.Error as exc:
             logger.error(str(exc))
             return None
 
     def importone(self, version, pkgarch, checksum, value):
-        return self.table.importone(version, pkgarch, checksum, value)
+        with self.dblock:
+            try:
+                return self.table.importone(version, pkgarch, checksum, value)
+            finally:
+                self.request_done()
+
+    def importmany(self, rows):
+        """importone() for a list of (version, pkgarch, checksum, value)"""
+        with self.dblock:
+            try:
+                return self.table.importmany(rows)
+            finally:
+                self.request_done()
 
     def ping(self):
         return not self.quit
@@ -126,7 +148,11 @@ class PRServer(SimpleXMLRPCServer):
 
     def getPR(self, version, pkgarch, checksum):
         try:
-            return self.table.getValue(version, pkgarch, checksum)
+            with self.dblock:
+                try:
+                    return self.table.getValue(version, pkgarch, checksum)
+                finally:
+                    self.request_done()
         except prserv.NotFoundError:
             logger.error("can not find value for (%s, %s)",version, checksum)
             return None
@@ -134,6 +160,20 @@ class PRServer(SimpleXMLRPCServer):
             logger.error(str(exc))
             return None
 
+    def getPRs(self, queries):
+        """
+        getPR() for a list of (version, pkgarch, checksum)
+        """
+        try:
+            with self.dblock:
+                try:
+                    return self.table.getValues(queries)
+                finally:
+                    self.request_done()
+        except sqlite3.Error as exc:
+            logger.error(str(exc))
+            return [None] * len(queries)
+
     def quit(self):
         self.quit=True
         return
@@ -151,11 +191,13 @@ class PRServer(SimpleXMLRPCServer):
         logger.info("Started PRServer with DBfile: %s, IP: %s, PORT: %s, PID: %s" %
                      (self.dbfile, self.host, self.port, str(os.getpid())))
 
-        self.handlerthread.start()
+        self.syncthread.start()
         while not self.quit:
             self.handle_request()
-        self.handlerthread.join()
-        self.db.disconnect()
+        self.syncevent.set()
+        with self.dblock:
+            self.table.sync_if_dirty()
+            self.db.disconnect()
         logger.info("PRServer: stopping...")
         self.server_close()
         return
@@ -165,6 +207,7 @@ class PRServer(SimpleXMLRPCServer):
             pid = self.daemonize()
         else:
             pid = self.fork()
+        self.pid = pid
 
         # Ensure both the parent sees this and the child from the work_forever log entry above
         logger.info("Started PRServer with DBfile: %s, IP: %s, PORT: %s, PID: %s" %
@@ -270,6 +313,7 @@ class PRServerConnection(object):
             host, port = singleton.getinfo()
         self.host = host
         self.port = port
+        # The transport keeps the HTTP connection open between calls
         self.connection, self.transport = bb.server.xmlrpc._create_server(self.host, self.port)
 
     def terminate(self):
@@ -282,6 +326,17 @@ class PRServerConnection(object):
     def getPR(self, version, pkgarch, checksum):
         return self.connection.getPR(version, pkgarch, checksum)
 
+    def getPRs(self, queries):
+        """
+        Get the PR values for a list of (version, pkgarch, checksum) in
+        one round trip
+        """
+        try:
+            return self.connection.getPRs(queries)
+        except xmlrpclib.Fault:
+            # Older servers only know about getPR
+            return [self.getPR(*query) for query in queries]
+
     def ping(self):
         return self.connection.ping()
 
@@ -291,6 +346,13 @@ class PRServerConnection(object):
     def importone(self, version, pkgarch, checksum, value):
         return self.connection.importone(version, pkgarch, checksum, value)
 
+    def importmany(self, rows):
+        try:
+            return self.connection.importmany(rows)
+        except xmlrpclib.Fault:
+            # Older servers only know about importone
+            return [self.importone(*row) for row in rows]
+
     def getinfo(self):
         return self.host, self.port
 
@@ -22,7 +22,13 @@ confirm=
 fsym=
 total_deleted=0
 verbose=
+write_index=
+index_file=
 debug=0
+# Archive formats of the sstate objects, as in SSTATE_ARCHIVE_TYPES
+archive_types="tgz tar.zst"
+# Regular expression matching any of them, e.g. "\(tgz\|tar\.zst\)"
+archive_re="\($(echo $archive_types | sed -e 's/\./\\./g' -e 's/ /\\|/g')\)"
 
 usage () {
   cat << EOF
@@ -68,6 +74,13 @@ Options:
 
         Conflicts with --remove-duplicated.
 
+  --write-mirror-index[=<file>]
+        Write an index of the sstate objects in the cache directory to
+        <file> (default: sstate-index.txt) at its top level, for use by
+        SSTATE_MIRROR_INDEX when the directory is served as a mirror.
+        An existing index is also rewritten whenever --remove-duplicated
+        or --stamps-dir is used, other runs leave it alone.
+
   -L, --follow-symlink
         Remove both the symbol link and the destination file, default: no.
 
@@ -81,6 +94,9 @@ Options:
   -D, --debug
         Show debug info, repeat for more debug info.
 
+The sstate-index.log maintained by builds with SSTATE_INDEX enabled is
+updated with the files which are removed.
+
 EOF
 }
 
@@ -120,12 +136,34 @@ echo_error () {
   exit 1
 }
 
+# Write the mirror index of the sstate objects in the cache directory
+write_mirror_index () {
+  local index="$cache_dir/${index_file:-sstate-index.txt}"
+  [ -n "$verbose" ] && echo "Writing mirror index $index"
+  (cd $cache_dir && find . -name 'sstate:*' \( -type f -o -type l \) \
+     ! -name '*.done' | sed -e 's#^\./##' | sort) > $index.tmp
+  mv $index.tmp $index
+}
+
+# Record the removed files in the sstate-index.log written when
+# SSTATE_INDEX is enabled, so the build doesn't consider them present.
+#
+# $@: files with the lists of removed files
+log_removed () {
+  local index_log="$cache_dir/sstate-index.log"
+  [ -e "$index_log" ] || return 0
+  cat "$@" | sort -u | sed -ne "s#^$cache_dir/*#- #p" > $index_log.removed
+  # Builds rewrite the log under this lock when compacting it
+  flock "$index_log.lock" sh -c 'cat "$1" >> "$2"' sh $index_log.removed $index_log
+  rm -f $index_log.removed
+}
+
 # Generate the remove list:
 #
 # * Add .done/.siginfo to the remove list
 # * Add destination of symlink to the remove list
 #
-# $1: output file, others: sstate cache file (.tgz)
+# $1: output file, others: sstate cache file (.tgz, .tar.zst)
 gen_rmlist (){
   local rmlist_file="$1"
   shift
@@ -142,7 +180,7 @@ gen_rmlist (){
               dest="`readlink -e $i`"
               if [ -n "$dest" ]; then
                   echo $dest >> $rmlist_file
-                  # Remove the .siginfo when .tgz is removed
+                  # Remove the .siginfo when the archive is removed
                   if [ -f "$dest.siginfo" ]; then
                       echo $dest.siginfo >> $rmlist_file
                   fi
@@ -199,10 +237,10 @@ remove_duplicated () {
   total_files=`find $cache_dir -name 'sstate*' | wc -l`
   # Save all the sstate files in a file
   sstate_files_list=`mktemp` || exit 1
-  find $cache_dir -name 'sstate:*:*:*:*:*:*:*.tgz*' >$sstate_files_list
+  find $cache_dir -name 'sstate:*:*:*:*:*:*:*' | grep "\.$archive_re" >$sstate_files_list
 
   echo "Figuring out the suffixes in the sstate cache dir ... "
-  sstate_suffixes="`sed 's%.*/sstate:[^:]*:[^:]*:[^:]*:[^:]*:[^:]*:[^:]*:[^_]*_\([^:]*\)\.tgz.*%\1%g' $sstate_files_list | sort -u`"
+  sstate_suffixes="`sed 's%.*/sstate:[^:]*:[^:]*:[^:]*:[^:]*:[^:]*:[^:]*:[^_]*_\([^:]*\)\.'"$archive_re"'.*%\1%g' $sstate_files_list | sort -u`"
   echo "Done"
   echo "The following suffixes have been found in the cache dir:"
   echo $sstate_suffixes
@@ -211,10 +249,10 @@ remove_duplicated () {
   # Using this SSTATE_PKGSPEC definition it's 6th colon separated field
   # SSTATE_PKGSPEC    = "sstate:${PN}:${PACKAGE_ARCH}${TARGET_VENDOR}-${TARGET_OS}:${PV}:${PR}:${SSTATE_PKGARCH}:${SSTATE_VERSION}:"
   for arch in $all_archs; do
-      grep -q ".*/sstate:[^:]*:[^:]*:[^:]*:[^:]*:$arch:[^:]*:[^:]*\.tgz$" $sstate_files_list
+      grep -q ".*/sstate:[^:]*:[^:]*:[^:]*:[^:]*:$arch:[^:]*:[^:]*\.$archive_re$" $sstate_files_list
       [ $? -eq 0 ] && ava_archs="$ava_archs $arch"
       # ${builder_arch}_$arch used by toolchain sstate
-      grep -q ".*/sstate:[^:]*:[^:]*:[^:]*:[^:]*:${builder_arch}_$arch:[^:]*:[^:]*\.tgz$" $sstate_files_list
+      grep -q ".*/sstate:[^:]*:[^:]*:[^:]*:[^:]*:${builder_arch}_$arch:[^:]*:[^:]*\.$archive_re$" $sstate_files_list
       [ $? -eq 0 ] && ava_archs="$ava_archs ${builder_arch}_$arch"
   done
   echo "Done"
@@ -230,13 +268,13 @@ remove_duplicated () {
           continue
       fi
       # Total number of files including .siginfo and .done files
-      total_files_suffix=`grep ".*/sstate:[^:]*:[^:]*:[^:]*:[^:]*:[^:]*:[^:]*:[^:_]*_$suffix\.tgz.*" $sstate_files_list | wc -l 2>/dev/null`
-      total_tgz_suffix=`grep ".*/sstate:[^:]*:[^:]*:[^:]*:[^:]*:[^:]*:[^:]*:[^:_]*_$suffix\.tgz$" $sstate_files_list | wc -l 2>/dev/null`
+      total_files_suffix=`grep ".*/sstate:[^:]*:[^:]*:[^:]*:[^:]*:[^:]*:[^:]*:[^:_]*_$suffix\.$archive_re.*" $sstate_files_list | wc -l 2>/dev/null`
+      total_archives_suffix=`grep ".*/sstate:[^:]*:[^:]*:[^:]*:[^:]*:[^:]*:[^:]*:[^:_]*_$suffix\.$archive_re$" $sstate_files_list | wc -l 2>/dev/null`
       # Save the file list to a file, some suffix's file may not exist
-      grep ".*/sstate:[^:]*:[^:]*:[^:]*:[^:]*:[^:]*:[^:]*:[^:_]*_$suffix\.tgz.*" $sstate_files_list >$list_suffix 2>/dev/null
-      local deleted_tgz=0
+      grep ".*/sstate:[^:]*:[^:]*:[^:]*:[^:]*:[^:]*:[^:]*:[^:_]*_$suffix\.$archive_re.*" $sstate_files_list >$list_suffix 2>/dev/null
+      local deleted_archives=0
       local deleted_files=0
-      for ext in tgz tgz.siginfo tgz.done; do
+      for ext in `for type in $archive_types; do echo $type $type.siginfo $type.done; done`; do
           echo "Figuring out the sstate:xxx_$suffix.$ext ... "
           # Uniq BPNs
           file_names=`for arch in $ava_archs ""; do
@@ -279,10 +317,10 @@ remove_duplicated () {
               done
           done
       done
-      deleted_tgz=`cat $rm_list.* 2>/dev/null | grep ".tgz$" | wc -l`
+      deleted_archives=`cat $rm_list.* 2>/dev/null | grep "\.$archive_re$" | wc -l`
       deleted_files=`cat $rm_list.* 2>/dev/null | wc -l`
       [ "$deleted_files" -gt 0 -a $debug -gt 0 ] && cat $rm_list.*
-      echo "($deleted_tgz from $total_tgz_suffix .tgz files for $suffix suffix will be removed or $deleted_files from $total_files_suffix when counting also .siginfo and .done files)"
+      echo "($deleted_archives from $total_archives_suffix archives for $suffix suffix will be removed or $deleted_files from $total_files_suffix when counting also .siginfo and .done files)"
       let total_deleted=$total_deleted+$deleted_files
   done
   deleted_tgz=0
@@ -300,13 +338,14 @@ remove_duplicated () {
       read_confirm
       if [ "$confirm" = "y" -o "$confirm" = "Y" ]; then
           for list in `ls $remove_listdir/`; do
-              echo "Removing $list.tgz (`cat $remove_listdir/$list | wc -w` files) ... "
+              echo "Removing $list (`cat $remove_listdir/$list | wc -w` files) ... "
               # Remove them one by one to avoid the argument list too long error
               for i in `cat $remove_listdir/$list`; do
                   rm -f $verbose $i
               done
               echo "Done"
           done
+          log_removed $remove_listdir/*
           echo "$total_deleted files have been removed!"
       else
           do_nothing
@@ -333,7 +372,7 @@ rm_by_stamps (){
   find $cache_dir -type f -name 'sstate*' | sort -u -o $cache_list
 
   echo "Figuring out the suffixes in the sstate cache dir ... "
-  local sstate_suffixes="`sed 's%.*/sstate:[^:]*:[^:]*:[^:]*:[^:]*:[^:]*:[^:]*:[^_]*_\([^:]*\)\.tgz.*%\1%g' $cache_list | sort -u`"
+  local sstate_suffixes="`sed 's%.*/sstate:[^:]*:[^:]*:[^:]*:[^:]*:[^:]*:[^:]*:[^_]*_\([^:]*\)\.'"$archive_re"'.*%\1%g' $cache_list | sort -u`"
   echo "Done"
   echo "The following suffixes have been found in the cache dir:"
   echo $sstate_suffixes
@@ -371,6 +410,7 @@ rm_by_stamps (){
               for i in `cat $rm_list | sort -u`; do
                   rm -f $verbose $i
               done
+              log_removed $rm_list
               echo "$total_deleted files have been removed"
           else
               do_nothing
@@ -433,6 +473,16 @@ while [ -n "$1" ]; do
       done
       shift
         ;;
+    --write-mirror-index)
+      write_index="y"
+      shift
+        ;;
+    --write-mirror-index=*)
+      write_index="y"
+      index_file=`echo $1 | sed -e 's#^--write-mirror-index=##'`
+      [ -n "$index_file" ] || echo_error "Invalid mirror index file"
+      shift
+        ;;
     --verbose|-v)
       verbose="-v"
       shift
@@ -464,6 +514,10 @@ done
 
 [ "$rm_duplicated" = "y" ] && remove_duplicated
 [ -n "$stamps" ] && rm_by_stamps
-[ -z "$rm_duplicated" -a -z "$stamps" ] && \
+# Keep an existing mirror index in step with what was removed
+[ -n "$rm_duplicated$stamps" -a -e "$cache_dir/${index_file:-sstate-index.txt}" ] && \
+    write_index="y"
+[ "$write_index" = "y" ] && write_mirror_index
+[ -z "$rm_duplicated" -a -z "$stamps" -a -z "$write_index" ] && \
     echo "What do you want to do?"
 exit 0